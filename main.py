@@ -1,9 +1,8 @@
 import flet as ft
-import json
-import os
 import threading
+import time
 from datetime import datetime
-from script import Connectivity, export, server
+from script import Connectivity, export, server, chain, rotation, health, pool
 
 # ---------- 表格行 ----------
 def proxy_row(item, header=False, on_click_callback=None):
@@ -78,14 +77,7 @@ def main(page: ft.Page):
     # ---------- 数据 ----------
     data = []
     try:
-        base = os.path.dirname(os.path.abspath(__file__))
-        with open(os.path.join(base, "assets", "pool.json"), encoding="utf-8") as f:
-            data = json.load(f)
-        
-        # 确保每个代理都有fail_count字段
-        for item in data:
-            if "fail_count" not in item:
-                item["fail_count"] = 0
+        data = pool.load_pool()
     except Exception as e:
         print(e)
 
@@ -135,6 +127,26 @@ def main(page: ft.Page):
             log_list.controls.pop(0)
         
         log_list.update()
+    
+    def append_logs(messages):
+        """批量添加日志，只刷新一次界面（供服务器日志线程调用）"""
+        timestamp = get_timestamp()
+        for msg in messages:
+            log_list.controls.append(
+                ft.Text(
+                    f"[{timestamp}]{msg}",
+                    size=11,
+                    color=ft.Colors.WHITE,
+                    selectable=True,
+                )
+            )
+        
+        # 限制日志数量，避免内存占用过大
+        overflow = len(log_list.controls) - 500
+        if overflow > 0:
+            del log_list.controls[:overflow]
+        
+        log_list.update()
 
     # ---------- 表格 ----------
     # 表头（固定）
@@ -284,30 +296,30 @@ def main(page: ft.Page):
         # 在后台线程中执行测试
         def test_in_background():
             nonlocal data
-            results = Connectivity.test_proxies(proxies, progress_callback=on_progress)
+            # 每条结果测试完成后立即写入代理池存储
+            stream = pool.ResultStream(data, progress_callback=on_progress)
+            results = Connectivity.test_proxies(proxies, progress_callback=stream)
             
             # 处理结果
-            process_results(results)
+            process_results(results, tested_at=stream.tested_at)
         
         threading.Thread(target=test_in_background, daemon=True).start()
     
     def retest_all_proxies(e):
-        """重新测试所有代理"""
+        """重新测试所有代理（最近有实际转发成功的代理直接保留，不再测试）"""
         nonlocal data
         if not data:
             append_log("[重测] 没有代理可测试")
             return
         
         # 提取所有代理地址
-        proxies = []
-        for item in data:
-            protocol = item.get("protocol", "").lower()
-            address = item.get("address", "")
-            if address:
-                proxy = f"{protocol}://{address}"
-                proxies.append(proxy)
+        proxies, kept = pool.retest_targets(data)
         
+        if kept:
+            append_log(f"[重测] {len(kept)} 条代理最近有实际转发成功，跳过测试")
         if not proxies:
+            if kept:
+                return
             append_log("[重测] 没有有效的代理地址")
             return
         
@@ -330,8 +342,9 @@ def main(page: ft.Page):
         # 在后台线程中执行测试
         def test_in_background():
             nonlocal data
-            results = Connectivity.test_proxies(proxies, progress_callback=on_progress)
-            process_results(results)
+            stream = pool.ResultStream(data, progress_callback=on_progress)
+            results = Connectivity.test_proxies(proxies, progress_callback=stream)
+            process_results(results, kept, tested_at=stream.tested_at)
         
         threading.Thread(target=test_in_background, daemon=True).start()
     
@@ -348,91 +361,36 @@ def main(page: ft.Page):
         except Exception as ex:
             append_log(f"[导出] 导出失败: {ex}")
     
-    def process_results(results):
-        """处理测试结果并更新UI"""
-        nonlocal data
-        
-        # 创建现有代理的映射（用于保留fail_count）
-        existing_proxies = {}
-        for item in data:
-            key = f"{item.get('protocol', '').upper()}://{item.get('address', '')}"
-            existing_proxies[key] = item.get('fail_count', 0)
-        
-        new_data = []
-        available_count = 0
-        unavailable_count = 0
+    def save_pool():
+        """把当前代理池写入代理池数据库（只写入有变化的代理），成功返回True"""
+        try:
+            pool.save_pool(data)
+            return True
+        except Exception as ex:
+            append_log(f"[导入] 写入代理池失败: {ex}")
+            return False
+    
+    def process_results(results, kept=(), tested_at=None):
+        """
+        处理测试结果并更新UI
         
-        for item in results:
-            status = "可用" if item.get("con") == "success" else "不可用"
-            
-            # 统计数量
-            if status == "可用":
-                available_count += 1
-            else:
-                unavailable_count += 1
-            
-            anonymity = item.get("Anonymity", "")
-            if anonymity == "Elite":
-                anonymity_display = "高匿"
-            elif anonymity == "Anonymous":
-                anonymity_display = "普匿"
-            elif anonymity == "Transparent":
-                anonymity_display = "透明"
-            else:
-                anonymity_display = ""
-            protocol_raw = item.get("Agreement", "")
-            protocol_display = protocol_raw.upper()
-            address = item.get("ip", "")
-            latency_ms = item.get("ms", 0.0)
-            latency_str = f"{latency_ms:.1f}ms" if latency_ms else ""
-            speed_mbps = item.get("mbps", 0.0)
-            speed_mb_s = speed_mbps / 8.0 if speed_mbps else 0.0
-            speed_str = f"{speed_mb_s:.1f} MB/s" if speed_mb_s else ""
-            
-            # 获取或初始化fail_count
-            proxy_key = f"{protocol_display}://{address}"
-            fail_count = existing_proxies.get(proxy_key, 0)
-            
-            # 更新fail_count
-            if status == "可用":
-                fail_count = 0  # 可用时重置为0
-            else:
-                fail_count += 1  # 不可用时+1
-            
-            # 如果fail_count >= 5，跳过该代理（删除）
-            if fail_count >= 5:
-                append_log(f"[清理] 删除失败次数过多的代理: {address} (失败{fail_count}次)")
-                continue
-            
-            new_data.append(
-                {
-                    "status": status,
-                    "score": item.get("Score", 0.0),
-                    "anonymity": anonymity_display,
-                    "protocol": protocol_display,
-                    "address": address,
-                    "latency": latency_str,
-                    "speed": speed_str,
-                    "country": item.get("country", ""),
-                    "city": item.get("city", ""),
-                    "fail_count": fail_count,
-                }
-            )
+        Args:
+            results: 测试结果
+            kept: 未参与本次测试、原样保留的代理条目
+            tested_at: 测试时间（ResultStream 逐条写入时使用的时间）
+        """
+        nonlocal data
         
-        # 按分数从高到低排序
-        data = sorted(new_data, key=lambda x: x.get("score", 0), reverse=True)
+        data, available_count, unavailable_count = pool.merge_results(
+            data, results, kept, log=append_log, tested_at=tested_at
+        )
         
         # 更新筛选选项的数量
         update_filter_options()
         
-        base = os.path.dirname(os.path.abspath(__file__))
-        try:
-            with open(os.path.join(base, "assets", "pool.json"), "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        if save_pool():
             append_log(f"[完成] 已完成测试 {len(data)} 条代理")
             append_log(f"[统计] 当前可用代理 {available_count} 个，不可用代理 {unavailable_count} 个")
-        except Exception as ex:
-            append_log(f"[导入] 写入 pool.json 失败: {ex}")
         
         refresh_table()
         page.update()
@@ -474,6 +432,66 @@ def main(page: ft.Page):
     # 在后台线程获取公网IP
     threading.Thread(target=fetch_public_ip, daemon=True).start()
     
+    # ---------- 代理链优化 ----------
+    def optimize_chain(e):
+        """按实测延迟为多层代理挑选最优链路（出口国家取当前国家筛选）"""
+        if not data:
+            append_log("[链路] 没有代理可选")
+            return
+        
+        country_value = country_dropdown.value
+        if country_value and " (" in country_value:
+            country_value = country_value.split(" (")[0]
+        countries = None if not country_value or country_value == "全部国家" else {country_value}
+        
+        append_log(f"[链路] 正在测量候选节点延迟，出口国家: {country_value or '全部国家'}")
+        
+        def optimize_in_background():
+            chains = chain.find_best_chains(
+                data,
+                hops=2,
+                k=5,
+                countries=countries,
+                log_callback=append_log,
+            )
+            if not chains:
+                append_log("[链路] 没有找到可用的代理链")
+                return
+            
+            for rank, (cost, hops) in enumerate(chains, start=1):
+                path = " -> ".join(item.get("address", "") for item in hops)
+                append_log(f"[链路] #{rank} {cost:.1f}ms {path}")
+            
+            _, best = chains[0]
+            for node_ip, node_selected, item in (
+                (proxy_server_2_ip, proxy_server_2_selected, best[0]),
+                (proxy_server_3_ip, proxy_server_3_selected, best[1]),
+            ):
+                node_ip.value = item.get("address", "")
+                node_selected["protocol"] = item.get("protocol", "socks5").lower()
+                node_ip.update()
+            append_log("[链路] 已将最优链路填入多层代理节点")
+            
+            if proxy_running["value"] and flow_container.content == multi_layer_flow:
+                switch_running_chain()
+        
+        threading.Thread(target=optimize_in_background, daemon=True).start()
+    
+    # ---------- 流量统计 ----------
+    def show_traffic_stats(e):
+        """在日志中输出各上游的流量和平均连接耗时"""
+        summary = server.get_metrics_summary()
+        append_log(
+            f"[统计] 活动连接 {summary['active']}，累计连接 {summary['connections']}，"
+            f"上行 {format_bytes(summary['bytes_up'])}，下行 {format_bytes(summary['bytes_down'])}"
+        )
+        if not summary["upstreams"]:
+            append_log("[统计] 暂无上游流量")
+            return
+        for upstream, down, latency in summary["upstreams"][:10]:
+            latency_str = f"{latency * 1000:.0f}ms" if latency is not None else "-"
+            append_log(f"[统计] {upstream} 下行 {format_bytes(down)} 平均连接耗时 {latency_str}")
+    
     # ---------- 更多操作菜单 ----------
     more_menu = ft.PopupMenuButton(
         content=ft.Container(
@@ -493,6 +511,16 @@ def main(page: ft.Page):
                 icon=ft.Icons.DOWNLOAD,
                 on_click=export_to_excel,
             ),
+            ft.PopupMenuItem(
+                text="优化代理链",
+                icon=ft.Icons.ROUTE,
+                on_click=optimize_chain,
+            ),
+            ft.PopupMenuItem(
+                text="流量统计",
+                icon=ft.Icons.INSIGHTS,
+                on_click=show_traffic_stats,
+            ),
             ft.PopupMenuItem(
                 text="获取公网IP",
                 icon=ft.Icons.PUBLIC,
@@ -513,6 +541,7 @@ def main(page: ft.Page):
             proxy_server_1_ip.value = address
             proxy_server_1_ip.update()
             proxy_server_1_selected["value"] = False
+            proxy_server_1_selected["protocol"] = protocol
             
             # 恢复节点背景颜色
             if proxy_server_1_selected["container"]:
@@ -522,16 +551,23 @@ def main(page: ft.Page):
             
             append_log(f"[设置] 代理服务器 -> {address}")
             
-            # 如果代理服务器正在运行，动态切换上游代理
+            # 如果代理服务器正在运行，验证新代理后动态切换上游代理
             if proxy_running["value"]:
-                append_log(f"[切换] 正在切换上游代理...")
-                server.switch_upstream_proxy(address, protocol)
-                append_log(f"[切换] 上游代理已切换到 {address}")
+                append_log(f"[切换] 正在验证并切换上游代理...")
+                
+                def switch_in_background():
+                    if server.switch_upstream_proxy(address, protocol):
+                        append_log(f"[切换] 上游代理已切换到 {address}")
+                    else:
+                        append_log(f"[切换] {address} 验证失败，保持当前上游代理")
+                
+                threading.Thread(target=switch_in_background, daemon=True).start()
             
         elif proxy_server_2_selected["value"]:
             proxy_server_2_ip.value = address
             proxy_server_2_ip.update()
             proxy_server_2_selected["value"] = False
+            proxy_server_2_selected["protocol"] = protocol
             
             # 恢复节点背景颜色
             if proxy_server_2_selected["container"]:
@@ -541,10 +577,15 @@ def main(page: ft.Page):
             
             append_log(f"[设置] 代理服务器(1) -> {address}")
             
+            # 如果代理服务器正在运行，动态切换代理链
+            if proxy_running["value"]:
+                switch_running_chain()
+            
         elif proxy_server_3_selected["value"]:
             proxy_server_3_ip.value = address
             proxy_server_3_ip.update()
             proxy_server_3_selected["value"] = False
+            proxy_server_3_selected["protocol"] = protocol
             
             # 恢复节点背景颜色
             if proxy_server_3_selected["container"]:
@@ -553,9 +594,31 @@ def main(page: ft.Page):
                 proxy_server_3_selected["container"].update()
             
             append_log(f"[设置] 代理服务器(2) -> {address}")
+            
+            # 如果代理服务器正在运行，动态切换代理链
+            if proxy_running["value"]:
+                switch_running_chain()
         else:
             append_log("[提示] 请先点击左侧代理服务器节点进行选中")
     
+    def switch_running_chain():
+        """多层模式运行中修改节点时，动态切换代理链"""
+        hops = [
+            (proxy_server_2_ip.value, proxy_server_2_selected["protocol"]),
+            (proxy_server_3_ip.value, proxy_server_3_selected["protocol"]),
+        ]
+        if any(address == "未选择" for address, _ in hops):
+            return
+        append_log("[切换] 正在验证并切换代理链...")
+        
+        def switch_in_background():
+            if server.switch_upstream_chain(hops):
+                append_log(f"[切换] 代理链已切换到 {' -> '.join(address for address, _ in hops)}")
+            else:
+                append_log("[切换] 新代理链验证失败，保持当前代理链")
+        
+        threading.Thread(target=switch_in_background, daemon=True).start()
+    
     def refresh_table(e=None):
         table_list.controls.clear()
 
@@ -607,9 +670,9 @@ def main(page: ft.Page):
 
     # ---------- 左侧导航（代理流程图）----------
     # 代理服务器节点状态和容器引用
-    proxy_server_1_selected = {"value": False, "container": None}
-    proxy_server_2_selected = {"value": False, "container": None}
-    proxy_server_3_selected = {"value": False, "container": None}
+    proxy_server_1_selected = {"value": False, "container": None, "protocol": "socks5"}
+    proxy_server_2_selected = {"value": False, "container": None, "protocol": "socks5"}
+    proxy_server_3_selected = {"value": False, "container": None, "protocol": "socks5"}
     proxy_server_1_text = ft.Text("代理服务器", size=11, color=ft.Colors.WHITE, text_align=ft.TextAlign.CENTER)
     proxy_server_2_text = ft.Text("代理服务器(1)", size=11, color=ft.Colors.WHITE, text_align=ft.TextAlign.CENTER)
     proxy_server_3_text = ft.Text("代理服务器(2)", size=11, color=ft.Colors.WHITE, text_align=ft.TextAlign.CENTER)
@@ -781,8 +844,10 @@ def main(page: ft.Page):
                     # 启用轮换按钮
                     rotation_button.disabled = False
                     rotation_interval.disabled = False
+                    rotation_strategy.disabled = False
                     rotation_button.update()
                     rotation_interval.update()
+                    rotation_strategy.update()
             
             dialog = ft.AlertDialog(
                 modal=True,
@@ -805,8 +870,10 @@ def main(page: ft.Page):
             # 启用轮换按钮
             rotation_button.disabled = False
             rotation_interval.disabled = False
+            rotation_strategy.disabled = False
             rotation_button.update()
             rotation_interval.update()
+            rotation_strategy.update()
     
     def switch_to_multi(e):
         # 如果代理正在运行，弹出确认对话框
@@ -832,8 +899,10 @@ def main(page: ft.Page):
                     # 禁用轮换按钮
                     rotation_button.disabled = True
                     rotation_interval.disabled = True
+                    rotation_strategy.disabled = True
                     rotation_button.update()
                     rotation_interval.update()
+                    rotation_strategy.update()
             
             dialog = ft.AlertDialog(
                 modal=True,
@@ -856,8 +925,10 @@ def main(page: ft.Page):
             # 禁用轮换按钮
             rotation_button.disabled = True
             rotation_interval.disabled = True
+            rotation_strategy.disabled = True
             rotation_button.update()
             rotation_interval.update()
+            rotation_strategy.update()
     
     # 代理模式菜单
     proxy_mode_menu = ft.PopupMenuButton(
@@ -900,15 +971,15 @@ def main(page: ft.Page):
                 append_log("[启动] 单层代理模式")
                 append_log(f"[启动] 上游代理: {proxy_address}")
                 
-                # 解析协议
-                protocol = "socks5"  # 默认使用socks5
+                # 解析协议（选择代理时记录，默认使用socks5）
+                protocol = proxy_server_1_selected["protocol"]
                 
                 # 在后台线程启动服务器
                 def start_server():
                     success = server.start_proxy_server(
                         proxy_address,
                         protocol,
-                        log_callback=lambda msg: append_log(f"[服务器] {msg}")
+                        log_batch_callback=lambda msgs: append_logs([f"[服务器] {msg}" for msg in msgs])
                     )
                     
                     if success:
@@ -919,14 +990,44 @@ def main(page: ft.Page):
                         append_log(f"[启动] 代理服务器启动成功")
                         append_log(f"[启动] SOCKS5: 127.0.0.1:{socks5_port}")
                         append_log(f"[启动] HTTP: 127.0.0.1:{http_port}")
+                        start_traffic_monitor()
                     else:
                         append_log("[错误] 代理服务器启动失败")
                 
                 threading.Thread(target=start_server, daemon=True).start()
                 
             else:
-                # 多层代理模式
-                append_log("[提示] 多层代理模式暂未实现")
+                # 多层代理模式：代理服务器(1) -> 代理服务器(2) -> Internet
+                hops = [
+                    (proxy_server_2_ip.value, proxy_server_2_selected["protocol"]),
+                    (proxy_server_3_ip.value, proxy_server_3_selected["protocol"]),
+                ]
+                if any(address == "未选择" for address, _ in hops):
+                    append_log("[错误] 请先选择代理服务器(1)和代理服务器(2)")
+                    return
+                
+                append_log("[启动] 多层代理模式")
+                append_log(f"[启动] 代理链: {' -> '.join(address for address, _ in hops)}")
+                
+                def start_chain_server():
+                    success = server.start_proxy_chain(
+                        hops,
+                        log_batch_callback=lambda msgs: append_logs([f"[服务器] {msg}" for msg in msgs])
+                    )
+                    
+                    if success:
+                        proxy_running["value"] = True
+                        start_button.text = "停止"
+                        start_button.bgcolor = "#EF5350"
+                        start_button.update()
+                        append_log(f"[启动] 代理服务器启动成功")
+                        append_log(f"[启动] SOCKS5: 127.0.0.1:{socks5_port}")
+                        append_log(f"[启动] HTTP: 127.0.0.1:{http_port}")
+                        start_traffic_monitor()
+                    else:
+                        append_log("[错误] 代理服务器启动失败")
+                
+                threading.Thread(target=start_chain_server, daemon=True).start()
         else:
             # 停止代理服务器
             append_log("[停止] 正在停止代理服务器...")
@@ -957,6 +1058,65 @@ def main(page: ft.Page):
         text_align=ft.TextAlign.CENTER,
     )
     
+    # 流量统计显示
+    traffic_text = ft.Text("", size=9, color="#B39DDB", text_align=ft.TextAlign.CENTER)
+    
+    def format_bytes(size):
+        """字节数转为易读的字符串"""
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024:
+                return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+            size /= 1024
+        return f"{size:.1f}TB"
+    
+    def apply_live_health():
+        """把代理服务实际转发的统计写回代理池，有代理状态变化时保存并刷新表格"""
+        changed = health.apply_to_pool(data, rescore=pool.rescore_proxy)
+        if not changed:
+            return
+        append_log(f"[健康] 根据实际转发结果更新了 {changed} 条代理的状态")
+        save_pool()
+        update_filter_options()
+        refresh_table()
+        page.update()
+    
+    def pinned_candidates():
+        """端口固定出口的候选上游：可用代理按分数从高到低"""
+        return pool.pinned_candidates(data)
+    
+    # 流量刷新线程：同一时间只运行一个，停止后在2秒内重新启动时继续使用原线程
+    traffic_monitor = {"thread": None, "lock": threading.Lock()}
+    
+    def start_traffic_monitor():
+        """代理服务运行期间每2秒刷新一次流量统计、被动健康状态和端口固定出口的候选"""
+        def monitor():
+            while True:
+                with traffic_monitor["lock"]:
+                    if not proxy_running["value"]:
+                        traffic_monitor["thread"] = None
+                        traffic_text.value = ""
+                        traffic_text.update()
+                        return
+                try:
+                    summary = server.get_metrics_summary()
+                    traffic_text.value = (
+                        f"连接 {summary['active']} / {summary['connections']}\n"
+                        f"↑{format_bytes(summary['bytes_up'])} ↓{format_bytes(summary['bytes_down'])}"
+                    )
+                    traffic_text.update()
+                    apply_live_health()
+                    server.set_pinned_pool(pinned_candidates())
+                    server.set_pool_index(data)
+                except Exception as ex:
+                    append_log(f"[健康] 更新流量统计和代理状态失败: {ex}")
+                time.sleep(2)
+        
+        with traffic_monitor["lock"]:
+            if traffic_monitor["thread"] is not None:
+                return
+            traffic_monitor["thread"] = threading.Thread(target=monitor, daemon=True)
+            traffic_monitor["thread"].start()
+    
     left_nav = ft.Container(
         width=150,
         bgcolor="#2D1B4E",
@@ -983,6 +1143,7 @@ def main(page: ft.Page):
                 flow_container,
                 ft.Container(height=10),
                 port_info_text,
+                traffic_text,
                 ft.Container(height=5),
                 start_button,
             ],
@@ -991,7 +1152,7 @@ def main(page: ft.Page):
 
     # ---------- 顶部栏 ----------
     # ---------- IP轮换功能 ----------
-    rotation_running = {"value": False, "timer": None}
+    rotation_running = {"value": False, "scheduler": None}
     
     rotation_interval = ft.TextField(
         value="10",
@@ -1011,6 +1172,20 @@ def main(page: ft.Page):
         height=35,
     )
     
+    # 轮换策略：轮询可用代理 / 按分数加权
+    rotation_strategy = ft.Dropdown(
+        width=85,
+        color=ft.Colors.WHITE,
+        border=ft.InputBorder.UNDERLINE,
+        content_padding=ft.padding.symmetric(horizontal=4, vertical=2),
+        text_size=11,
+        value=server.CONFIG.get("rotation_strategy", "round_robin"),
+        options=[
+            ft.dropdown.Option("round_robin", "轮询"),
+            ft.dropdown.Option("weighted", "加权"),
+        ],
+    )
+    
     def toggle_ip_rotation(e):
         """启用/停止IP轮换"""
         # 检查是否为单层代理模式
@@ -1022,81 +1197,69 @@ def main(page: ft.Page):
             # 启用轮换
             try:
                 interval = int(rotation_interval.value)
-                if interval < 1:
-                    append_log("[轮换] 间隔时间必须大于0秒")
+                if interval < 0:
+                    append_log("[轮换] 间隔时间不能小于0秒")
                     return
             except ValueError:
                 append_log("[轮换] 请输入有效的数字")
                 return
             
-            if not data:
-                append_log("[轮换] 没有可用的代理")
+            # 按连接数、流量和失败次数触发的条件在 config.yaml 中配置
+            every_connections = server.CONFIG.get("rotation_every_connections", 0)
+            every_bytes = server.CONFIG.get("rotation_every_bytes", 0)
+            on_error = server.CONFIG.get("rotation_on_error", 3)
+            if not (interval or every_connections or every_bytes or on_error):
+                append_log("[轮换] 未设置任何切换条件，请填写间隔时间")
                 return
             
-            # 筛选可用代理
-            available_proxies = [item for item in data if item.get("status") == "可用"]
-            if not available_proxies:
+            if not any(item.get("status") == "可用" for item in data):
                 append_log("[轮换] 没有可用的代理")
                 return
             
+            def switch(address, protocol):
+                # 代理服务未启动时只更新显示
+                if not proxy_running["value"]:
+                    return True
+                return server.switch_upstream_proxy(address, protocol)
+            
+            def on_switch(item, reason):
+                proxy_server_1_ip.value = item.get("address", "")
+                proxy_server_1_selected["protocol"] = item.get("protocol", "socks5").lower()
+                proxy_server_1_ip.update()
+            
+            # 候选代理从当前代理池实时读取，重新测试后的状态和分数立即生效
+            scheduler = rotation.RotationScheduler(
+                lambda: data,
+                switch,
+                strategy=rotation_strategy.value or "round_robin",
+                interval=interval,
+                every_connections=every_connections,
+                every_bytes=every_bytes,
+                on_error=on_error,
+                log_callback=append_log,
+                on_switch=on_switch,
+            )
             rotation_running["value"] = True
-            rotation_running["current_index"] = 0
-            rotation_running["proxies"] = available_proxies
+            rotation_running["scheduler"] = scheduler
             
             rotation_button.text = "停止轮换"
             rotation_button.bgcolor = "#EF5350"
             rotation_button.update()
             
-            append_log(f"[轮换] 启用IP轮换，间隔 {interval} 秒，共 {len(available_proxies)} 个代理")
-            
-            # 立即切换到第一个代理
-            switch_to_next_proxy()
-            
-            # 启动定时器
-            def rotation_timer():
-                import time
-                while rotation_running["value"]:
-                    time.sleep(interval)
-                    if rotation_running["value"]:
-                        switch_to_next_proxy()
-            
-            rotation_running["timer"] = threading.Thread(target=rotation_timer, daemon=True)
-            rotation_running["timer"].start()
+            strategy_text = "加权" if scheduler.strategy == "weighted" else "轮询"
+            append_log(f"[轮换] 启用IP轮换（{strategy_text}），间隔 {interval} 秒")
+            scheduler.start()
         else:
             # 停止轮换
             rotation_running["value"] = False
+            if rotation_running["scheduler"]:
+                rotation_running["scheduler"].stop()
+                rotation_running["scheduler"] = None
             rotation_button.text = "启用轮换"
             rotation_button.bgcolor = "#BA68C8"
             rotation_button.update()
             append_log("[轮换] 已停止IP轮换")
     
-    def switch_to_next_proxy():
-        """切换到下一个代理"""
-        if not rotation_running["value"]:
-            return
-        
-        proxies = rotation_running["proxies"]
-        current_index = rotation_running["current_index"]
-        
-        # 获取下一个代理
-        proxy_item = proxies[current_index]
-        address = proxy_item.get("address", "")
-        protocol = proxy_item.get("protocol", "socks5").lower()
-        
-        # 更新左侧显示
-        proxy_server_1_ip.value = address
-        proxy_server_1_ip.update()
-        
-        # 如果代理服务器正在运行，切换上游代理
-        if proxy_running["value"]:
-            server.switch_upstream_proxy(address, protocol)
-            append_log(f"[轮换] 切换到 {address}")
-        else:
-            append_log(f"[轮换] 下一个代理: {address} (代理服务未启动)")
-        
-        # 更新索引
-        rotation_running["current_index"] = (current_index + 1) % len(proxies)
-    
     rotation_button.on_click = toggle_ip_rotation
     
     # ---------- 顶部栏 ----------
@@ -1115,6 +1278,7 @@ def main(page: ft.Page):
                 ft.Row(
                     spacing=5,
                     controls=[
+                        rotation_strategy,
                         rotation_button,
                         rotation_interval,
                         ft.Text("秒", size=12, color="#B39DDB"),
@@ -0,0 +1,95 @@
+import bisect
+import hashlib
+import ipaddress
+
+# 每个上游在哈希环上的虚拟节点数，越多分布越均匀
+VIRTUAL_NODES = 160
+
+# 支持的粘性模式
+AFFINITY_MODES = ("off", "client", "username", "domain")
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    一致性哈希环
+
+    每个节点映射为 VIRTUAL_NODES 个虚拟点，键落在环上顺时针遇到的第一个点所属的节点。
+    增删一个节点只会让约 1/N 的键改变归属，其余键保持原来的上游。
+    """
+
+    def __init__(self, nodes=(), replicas=VIRTUAL_NODES):
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        self.nodes = []
+        if nodes:
+            self.rebuild(nodes)
+
+    def rebuild(self, nodes):
+        """用新的节点列表重建哈希环（节点为字符串标识）"""
+        points = []
+        for node in dict.fromkeys(nodes):
+            for replica in range(self.replicas):
+                points.append((_hash(f"{node}#{replica}"), node))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+        self.nodes = list(dict.fromkeys(nodes))
+
+    def get(self, key):
+        """返回 key 所属的节点，环为空时返回 None"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._owners[index]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def site_key(host):
+    """
+    目标站点的粘性键：取主域名（近似的 eTLD+1），
+    使 www.example.com 和 api.example.com 走同一个上游；IP 地址原样返回
+    """
+    host = (host or '').strip('.').lower()
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+    labels = host.split('.')
+    if len(labels) <= 2:
+        return host
+    # 形如 example.co.uk、example.com.cn 的二级后缀保留三段
+    if len(labels[-2]) <= 3 and len(labels[-1]) == 2:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def affinity_key(mode, client_address=None, username=None, target_host=None, port_group=0):
+    """
+    按粘性模式计算连接的哈希键，无法得到键时返回 None（回退到默认上游）
+
+    Args:
+        mode: client 按客户端地址（及端口分组），username 按代理认证用户名，domain 按目标站点
+        client_address: 客户端 (ip, port)
+        username: SOCKS5 或 HTTP 代理认证中的用户名
+        target_host: 目标主机
+        port_group: client 模式下的端口分组大小，0 表示只按客户端 IP
+    """
+    if mode == 'client' and client_address:
+        if port_group:
+            return f"{client_address[0]}:{client_address[1] // port_group}"
+        return client_address[0]
+    if mode == 'username' and username:
+        return username
+    if mode == 'domain' and target_host:
+        return site_key(target_host)
+    return None
@@ -0,0 +1,464 @@
+"""
+本机回环压测：不需要外网，测量 SOCKS5 / HTTP 代理端口的性能
+
+启动三个部分：
+  - 源站进程：回显/下载源站，以及模拟的 SOCKS5 / HTTP 上游代理（可注入握手延迟和连接丢弃）
+  - 代理进程：ProxyServer（默认 1080）和 HTTPProxyServer（默认 1081），上游指向模拟代理或直连
+  - 当前进程：N 个并发客户端在指定时间内反复建立连接并传输数据
+
+报告每秒连接数、吞吐量、建立连接和首字节时间的 p50 / p99，可输出 JSON 用于跟踪性能回归。
+
+用法：
+  python -m script.bench --clients 50 --duration 10 --bytes 1024
+  python -m script.bench --upstream socks5 --latency-ms 20 --loss 0.01 --bytes 67108864 --clients 4
+  python -m script.bench --socket-profile bulk-throughput --output bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+# 源站每次发送的数据块
+CHUNK = 65536
+_PAYLOAD = bytes(CHUNK)
+# 客户端连接和读取超时（秒）
+CLIENT_TIMEOUT = 30
+# 各监听端口的测试场景：socks5 为 SOCKS5 CONNECT，http-connect 为 HTTP CONNECT 隧道，http 为普通 HTTP 转发
+SCENARIOS = ("socks5", "http-connect", "http")
+
+
+# ---------- 源站和模拟上游 ----------
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise OSError("连接被关闭")
+        data += chunk
+    return data
+
+
+def _read_line(sock, limit=8192):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(1)
+        if not chunk or len(data) > limit:
+            return None
+        data += chunk
+    return data
+
+
+def _read_head(sock, limit=65536):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(4096)
+        if not chunk or len(data) > limit:
+            return None
+        data += chunk
+    return data
+
+
+def _send_bytes(sock, size):
+    while size > 0:
+        sent = sock.send(_PAYLOAD[:min(size, CHUNK)])
+        size -= sent
+
+
+def _serve_origin(sock):
+    """
+    源站协议（第一行决定）：
+      BULK <n>        发送 n 字节后关闭
+      ECHO            回显收到的数据直到客户端关闭
+      GET /bytes/<n>  HTTP 响应 n 字节
+      TRACE <上行> <下行> <毫秒>  接收上行字节数的同时发送下行字节数，连接至少保持指定时长（轨迹回放使用）
+    """
+    try:
+        line = _read_line(sock)
+        if not line:
+            return
+        if line.startswith(b"BULK "):
+            _send_bytes(sock, int(line[5:]))
+        elif line.startswith(b"ECHO"):
+            while True:
+                data = sock.recv(CHUNK)
+                if not data:
+                    break
+                sock.sendall(data)
+        elif line.startswith(b"TRACE "):
+            started = time.monotonic()
+            up, down, hold_ms = (int(value) for value in line.split()[1:4])
+            drain = threading.Thread(target=_drain, args=(sock, up), daemon=True)
+            drain.start()
+            _send_bytes(sock, down)
+            drain.join(CLIENT_TIMEOUT)
+            remaining = hold_ms / 1000 - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+        elif line.startswith(b"GET "):
+            _read_until_blank(sock)
+            path = line.split(b" ")[1]
+            size = int(path.rsplit(b"/", 1)[-1] or 0)
+            sock.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % size)
+            _send_bytes(sock, size)
+    except (OSError, ValueError):
+        pass
+    finally:
+        sock.close()
+
+
+def _drain(sock, size):
+    try:
+        while size > 0:
+            data = sock.recv(min(size, CHUNK))
+            if not data:
+                return
+            size -= len(data)
+    except OSError:
+        pass
+
+
+def _read_until_blank(sock):
+    while True:
+        line = _read_line(sock)
+        if line is None or line in (b"\r\n", b"\n"):
+            return
+
+
+def _relay(a, b):
+    """双向转发直到任意一端关闭"""
+    sockets = [a, b]
+    try:
+        while True:
+            readable, _, _ = select.select(sockets, [], [], CLIENT_TIMEOUT)
+            if not readable:
+                return
+            for sock in readable:
+                data = sock.recv(CHUNK)
+                if not data:
+                    return
+                (b if sock is a else a).sendall(data)
+    except OSError:
+        pass
+    finally:
+        a.close()
+        b.close()
+
+
+def _serve_fake_upstream(sock, protocol, latency, loss, redirect=None):
+    """
+    模拟上游代理：握手前等待 latency 秒，按 loss 概率直接断开
+
+    redirect 为 (host, port) 时忽略请求的目标，全部转到该地址；目标域名以 fail. 开头的连接直接断开
+    """
+    try:
+        if protocol == "socks5":
+            # 客户端可能把认证协商和连接请求一起发送，按长度逐段读取
+            greeting = _recv_exact(sock, 2)
+            _recv_exact(sock, greeting[1])
+            sock.sendall(b"\x05\x00")
+            head = _recv_exact(sock, 4)
+            if head[3] == 1:
+                host = socket.inet_ntoa(_recv_exact(sock, 4))
+            elif head[3] == 3:
+                host = _recv_exact(sock, _recv_exact(sock, 1)[0]).decode()
+            else:
+                host = socket.inet_ntop(socket.AF_INET6, _recv_exact(sock, 16))
+            port = struct.unpack("!H", _recv_exact(sock, 2))[0]
+        else:
+            head = _read_head(sock)
+            if head is None:
+                return sock.close()
+            host, _, port = head.split(b" ")[1].decode().rpartition(":")
+            port = int(port)
+        if latency:
+            time.sleep(latency)
+        if loss and random.random() < loss:
+            return sock.close()
+        if redirect:
+            if host.startswith("fail."):
+                return sock.close()
+            host, port = redirect
+        remote = socket.create_connection((host.strip("[]"), port), timeout=CLIENT_TIMEOUT)
+        remote.settimeout(None)
+        if protocol == "socks5":
+            sock.sendall(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+        else:
+            sock.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        _relay(sock, remote)
+    except (OSError, IndexError, ValueError):
+        sock.close()
+
+
+def _listen(port=0):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(1024)
+    return listener
+
+
+def _accept_loop(listener, handler, *args):
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=handler, args=(sock, *args), daemon=True).start()
+
+
+def run_origin(ports, ready, stop, latency, loss, redirect=False):
+    """
+    源站进程：回显/下载源站和两个模拟上游，实际端口写入 ports
+
+    redirect 为 True 时模拟上游把所有目标都转到本地源站（回放轨迹中的匿名主机）
+    """
+    listeners = {"origin": _listen(), "socks5": _listen(), "http": _listen()}
+    threading.Thread(target=_accept_loop, args=(listeners["origin"], _serve_origin), daemon=True).start()
+    target = ("127.0.0.1", listeners["origin"].getsockname()[1]) if redirect else None
+    for protocol in ("socks5", "http"):
+        threading.Thread(target=_accept_loop, daemon=True,
+                         args=(listeners[protocol], _serve_fake_upstream, protocol, latency, loss, target)).start()
+    for name, listener in listeners.items():
+        ports[name] = listener.getsockname()[1]
+    ready.set()
+    stop.wait()
+
+
+# ---------- 被测代理 ----------
+
+def run_proxy(socks_port, http_port, upstream, socket_profile, ready, stop, breaker=True):
+    """
+    代理进程：启动 SOCKS5 和 HTTP 代理端口，upstream 为 (协议, 地址) 或 None
+
+    breaker 为 False 时关闭上游熔断（回放时所有连接共用一个模拟上游，轨迹中的失败不应拖累其他连接）
+    """
+    from script import server
+    from script.sockopts import SocketOptions
+
+    if not breaker:
+        server.BREAKER.configure(failure_rate=0)
+    if socket_profile:
+        server.SOCKET_OPTIONS = SocketOptions(
+            {"listener": socket_profile, "upstream": socket_profile, "direct": socket_profile}
+        )
+    servers = [server.ProxyServer("127.0.0.1", socks_port), server.HTTPProxyServer("127.0.0.1", http_port)]
+    for proxy in servers:
+        if upstream:
+            proxy.set_upstream_proxy(upstream[1], upstream[0])
+        if not proxy.start():
+            sys.exit(1)
+    ready.set()
+    stop.wait()
+    for proxy in servers:
+        proxy.stop()
+
+
+# ---------- 客户端 ----------
+
+def _open_socks5(proxy_port, target):
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=CLIENT_TIMEOUT)
+    sock.sendall(b"\x05\x01\x00")
+    if sock.recv(2) != b"\x05\x00":
+        raise OSError("SOCKS5 认证协商失败")
+    sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton(target[0]) + struct.pack("!H", target[1]))
+    reply = b""
+    while len(reply) < 10:
+        chunk = sock.recv(10 - len(reply))
+        if not chunk:
+            raise OSError("SOCKS5 连接被关闭")
+        reply += chunk
+    if reply[1] != 0:
+        raise OSError(f"SOCKS5 连接失败: {reply[1]}")
+    return sock
+
+
+def _open_http_connect(proxy_port, target):
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=CLIENT_TIMEOUT)
+    sock.sendall(b"CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n\r\n" % (target[0].encode(), target[1],
+                                                                      target[0].encode(), target[1]))
+    head = _read_head(sock)
+    if head is None or b" 200" not in head.split(b"\r\n", 1)[0]:
+        raise OSError("HTTP CONNECT 失败")
+    return sock
+
+
+def _read_all(sock, size, first_byte_at):
+    """读取至少 size 字节（或直到关闭），返回 (字节数, 首字节时间)"""
+    received = 0
+    first = None
+    while received < size:
+        data = sock.recv(CHUNK)
+        if not data:
+            break
+        if first is None:
+            first = time.perf_counter()
+        received += len(data)
+    return received, (first or first_byte_at)
+
+
+def _one_connection(scenario, ports, mode, size):
+    """建立一个连接并完成一次传输，返回 (连接耗时, 首字节耗时, 字节数)"""
+    target = ("127.0.0.1", ports["origin"])
+    start = time.perf_counter()
+    if scenario == "socks5":
+        sock = _open_socks5(ports["proxy_socks5"], target)
+    elif scenario == "http-connect":
+        sock = _open_http_connect(ports["proxy_http"], target)
+    else:
+        sock = socket.create_connection(("127.0.0.1", ports["proxy_http"]), timeout=CLIENT_TIMEOUT)
+    connected = time.perf_counter()
+    try:
+        if scenario == "http":
+            sock.sendall(b"GET http://%s:%d/bytes/%d HTTP/1.1\r\nHost: %s:%d\r\nConnection: close\r\n\r\n"
+                         % (target[0].encode(), target[1], size, target[0].encode(), target[1]))
+            sent = time.perf_counter()
+            received, first = _read_all(sock, 1 << 62, sent)
+        elif mode == "echo":
+            sock.sendall(b"ECHO\n")
+            sent = time.perf_counter()
+            sender = threading.Thread(target=_send_bytes, args=(sock, size), daemon=True)
+            sender.start()
+            received, first = _read_all(sock, size, sent)
+            sender.join()
+        else:
+            sock.sendall(b"BULK %d\n" % size)
+            sent = time.perf_counter()
+            received, first = _read_all(sock, size, sent)
+    finally:
+        sock.close()
+    if scenario != "http" and received < size:
+        raise OSError("数据不完整")
+    return connected - start, first - sent, received
+
+
+def _client(scenario, ports, mode, size, deadline, results, errors):
+    while time.perf_counter() < deadline:
+        try:
+            results.append(_one_connection(scenario, ports, mode, size))
+        except (OSError, ValueError):
+            errors.append(1)
+
+
+def percentile(values, fraction):
+    """最近秩法百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(fraction * len(ordered) + 0.5)) - 1, len(ordered) - 1)
+    return ordered[max(index, 0)]
+
+
+def _latency_summary(values):
+    if not values:
+        return {"p50": None, "p99": None, "mean": None}
+    return {
+        "p50": round(percentile(values, 0.5) * 1000, 3),
+        "p99": round(percentile(values, 0.99) * 1000, 3),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+    }
+
+
+def run_scenario(scenario, ports, clients, duration, mode, size):
+    """N 个客户端并发运行 duration 秒，返回该场景的统计结果"""
+    results, errors = [], []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    threads = [threading.Thread(target=_client, args=(scenario, ports, mode, size, deadline, results, errors),
+                                daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total_bytes = sum(result[2] for result in results)
+    return {
+        "scenario": scenario,
+        "connections": len(results),
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 3),
+        "connections_per_s": round(len(results) / elapsed, 1),
+        "throughput_mb_s": round(total_bytes / elapsed / 1024 / 1024, 2),
+        "connect_ms": _latency_summary([result[0] for result in results]),
+        "ttfb_ms": _latency_summary([result[1] for result in results]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SOCKS5 / HTTP 代理端口的本机回环压测")
+    parser.add_argument("--clients", type=int, default=20, help="并发客户端数")
+    parser.add_argument("--duration", type=float, default=10, help="每个场景的运行时间（秒）")
+    parser.add_argument("--bytes", type=int, default=1024, help="每个连接传输的字节数")
+    parser.add_argument("--mode", choices=("bulk", "echo"), default="bulk", help="bulk 下载，echo 上传并回显")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all", help="测试场景")
+    parser.add_argument("--upstream", choices=("none", "socks5", "http"), default="none",
+                        help="代理端口的上游：none 直连源站，socks5 / http 经模拟上游代理")
+    parser.add_argument("--latency-ms", type=float, default=0, help="模拟上游每次握手增加的延迟（毫秒）")
+    parser.add_argument("--loss", type=float, default=0, help="模拟上游直接断开连接的比例（0-1）")
+    parser.add_argument("--socket-profile", default=None,
+                        help="代理使用的套接字参数预设（default / low-latency / bulk-throughput），默认按配置文件")
+    parser.add_argument("--socks-port", type=int, default=1080, help="SOCKS5 代理端口")
+    parser.add_argument("--http-port", type=int, default=1081, help="HTTP 代理端口")
+    parser.add_argument("--output", help="把 JSON 结果写入文件")
+    parser.add_argument("--json", action="store_true", help="只输出 JSON")
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    ports = manager.dict()
+    stop = context.Event()
+    origin_ready, proxy_ready = context.Event(), context.Event()
+    origin = context.Process(target=run_origin, daemon=True,
+                             args=(ports, origin_ready, stop, args.latency_ms / 1000, args.loss))
+    origin.start()
+    if not origin_ready.wait(30):
+        parser.error("源站启动失败")
+    upstream = None if args.upstream == "none" else (args.upstream, f"127.0.0.1:{ports[args.upstream]}")
+    proxy = context.Process(target=run_proxy, daemon=True,
+                            args=(args.socks_port, args.http_port, upstream, args.socket_profile, proxy_ready, stop))
+    proxy.start()
+    if not proxy_ready.wait(30):
+        stop.set()
+        parser.error("代理端口启动失败（端口是否被占用？）")
+
+    ports = dict(ports, proxy_socks5=args.socks_port, proxy_http=args.http_port)
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    report = {
+        "config": {
+            "clients": args.clients, "duration_s": args.duration, "bytes": args.bytes, "mode": args.mode,
+            "upstream": args.upstream, "latency_ms": args.latency_ms, "loss": args.loss,
+            "socket_profile": args.socket_profile or "config",
+        },
+        "results": [],
+    }
+    try:
+        for scenario in scenarios:
+            result = run_scenario(scenario, ports, args.clients, args.duration, args.mode, args.bytes)
+            report["results"].append(result)
+            if not args.json:
+                print(f"{scenario:<13} 连接 {result['connections']:>7} 错误 {result['errors']:>5}  "
+                      f"{result['connections_per_s']:>8} 连接/秒 {result['throughput_mb_s']:>9} MB/s  "
+                      f"建立连接 p50/p99 {result['connect_ms']['p50']}/{result['connect_ms']['p99']} ms  "
+                      f"首字节 p50/p99 {result['ttfb_ms']['p50']}/{result['ttfb_ms']['p99']} ms")
+    finally:
+        stop.set()
+        proxy.join(5)
+        origin.join(5)
+        manager.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import collections
+import os
+import threading
+import time
+
+# 熔断状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 统计最近多少次连接结果
+WINDOW = 20
+# 窗口内至少有多少次结果才判断是否熔断
+MIN_CALLS = 5
+# 失败（含慢连接）比例达到该值时熔断，0 表示关闭熔断
+FAILURE_RATE = 0.5
+# 建立连接超过该时间（秒）视为慢连接，按失败计入比例
+SLOW_CALL_SECONDS = 5.0
+# 熔断后多久（秒）允许半开试探；试探失败时翻倍，最长 MAX_OPEN_SECONDS
+OPEN_SECONDS = 30
+MAX_OPEN_SECONDS = 300
+# 半开状态下同时放行的试探连接数
+HALF_OPEN_PROBES = 1
+# 试探连接超过该时间（秒）仍未返回结果时，允许新的试探
+PROBE_TIMEOUT = 30
+
+
+class _Circuit:
+    __slots__ = ("state", "results", "opened_at", "open_seconds", "probes", "probe_started")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.results = collections.deque(maxlen=WINDOW)
+        self.opened_at = 0.0
+        self.open_seconds = OPEN_SECONDS
+        self.probes = 0
+        self.probe_started = 0.0
+
+
+class CircuitBreaker:
+    """
+    按上游划分的熔断器
+
+    - closed：正常放行，最近 WINDOW 次连接中失败和慢连接的比例达到 failure_rate 时熔断
+    - open：直接拒绝，不再等待连接超时；open_seconds 后进入半开
+    - half_open：只放行 HALF_OPEN_PROBES 个试探连接，成功则恢复，失败则再次熔断并延长等待时间
+    """
+
+    def __init__(self, failure_rate=FAILURE_RATE, open_seconds=OPEN_SECONDS,
+                 slow_call_seconds=SLOW_CALL_SECONDS, on_transition=None):
+        """
+        Args:
+            on_transition: 状态变化时的回调 on_transition(key, state)
+        """
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.on_transition = on_transition
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def configure(self, failure_rate=None, open_seconds=None, slow_call_seconds=None):
+        """运行时调整熔断参数"""
+        if failure_rate is not None:
+            self.failure_rate = failure_rate
+        if open_seconds is not None:
+            self.open_seconds = open_seconds
+        if slow_call_seconds is not None:
+            self.slow_call_seconds = slow_call_seconds
+
+    @property
+    def enabled(self):
+        return self.failure_rate > 0
+
+    def allow(self, key):
+        """是否放行一次经该上游的连接；放行后必须调用 record 报告结果"""
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        transitioned = None
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit.state == CLOSED:
+                return True
+            if circuit.state == OPEN:
+                if now - circuit.opened_at < circuit.open_seconds:
+                    return False
+                circuit.state = HALF_OPEN
+                circuit.probes = 0
+                transitioned = HALF_OPEN
+            if circuit.probes >= HALF_OPEN_PROBES and now - circuit.probe_started < PROBE_TIMEOUT:
+                allowed = False
+            else:
+                if circuit.probes >= HALF_OPEN_PROBES:
+                    # 之前的试探没有报告结果，视为已结束
+                    circuit.probes = 0
+                circuit.probes += 1
+                circuit.probe_started = now
+                allowed = True
+        if transitioned and self.on_transition:
+            self.on_transition(key, transitioned)
+        return allowed
+
+    def record(self, key, ok, seconds=None):
+        """报告一次连接结果和建立连接的耗时"""
+        if not self.enabled:
+            return
+        failed = not ok or (seconds is not None and seconds >= self.slow_call_seconds)
+        transitioned = None
+        with self._lock:
+            circuit = self._circuits.setdefault(key, _Circuit())
+            if circuit.state == HALF_OPEN:
+                circuit.probes = max(circuit.probes - 1, 0)
+                if failed:
+                    circuit.open_seconds = min(circuit.open_seconds * 2, MAX_OPEN_SECONDS)
+                    circuit.opened_at = time.monotonic()
+                    circuit.state = transitioned = OPEN
+                else:
+                    circuit.results.clear()
+                    circuit.open_seconds = self.open_seconds
+                    circuit.state = transitioned = CLOSED
+            elif circuit.state == CLOSED:
+                circuit.results.append(failed)
+                if (
+                    len(circuit.results) >= MIN_CALLS
+                    and sum(circuit.results) / len(circuit.results) >= self.failure_rate
+                ):
+                    circuit.results.clear()
+                    circuit.open_seconds = self.open_seconds
+                    circuit.opened_at = time.monotonic()
+                    circuit.state = transitioned = OPEN
+            # open 状态下的结果（熔断前已发起的连接）不再计入
+        if transitioned and self.on_transition:
+            self.on_transition(key, transitioned)
+
+    def state(self, key):
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit.state if circuit else CLOSED
+
+    def forget(self, keys=None):
+        """清除指定上游（默认全部）的熔断状态"""
+        with self._lock:
+            if keys is None:
+                self._circuits.clear()
+            else:
+                for key in keys:
+                    self._circuits.pop(key, None)
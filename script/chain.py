@@ -0,0 +1,318 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from script import server
+from script import dialer
+
+# 测量目标，与连通性测试保持一致
+PROBE_TARGET = server.PROBE_TARGET
+# 单次测量超时（秒）
+PROBE_TIMEOUT = 5
+# 缓存的边在多少秒内视为有效
+GRAPH_TTL = 600
+# 参与组合的候选代理数量（按分数取前N个）
+MAX_CANDIDATES = 10
+
+# 匿名度等级，数值越大越匿名
+ANONYMITY_RANK = {"高匿": 3, "普匿": 2, "透明": 1}
+
+GRAPH_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets", "chain_graph.json")
+
+
+def proxy_key(item):
+    """代理在延迟图中的唯一标识，如 socks5://1.2.3.4:1080"""
+    return f"{item.get('protocol', 'socks5').lower()}://{item.get('address', '')}"
+
+
+def _measure_connect(proxy, target_host, target_port):
+    """
+    测量经过代理 proxy 连接到 target 的耗时（毫秒），失败返回 None
+    proxy 为 None 时测量本机直接建立TCP连接的耗时
+    """
+    sock = None
+    start = time.perf_counter()
+    try:
+        if proxy is None:
+            sock = dialer.create_connection((target_host, target_port), timeout=PROBE_TIMEOUT)
+        else:
+            sock = dialer.create_connection((proxy['host'], proxy['port']), timeout=PROBE_TIMEOUT)
+            server.proxy_handshake(sock, proxy['protocol'], target_host, target_port)
+        return (time.perf_counter() - start) * 1000
+    except Exception:
+        return None
+    finally:
+        if sock:
+            try:
+                sock.close()
+            except:
+                pass
+
+
+class LatencyGraph:
+    """
+    代理延迟图
+
+    把一条链路 本机 -> A -> B -> 目标 拆成可独立测量、可相加的边：
+      - entry[A]:   本机直接连接到 A 的耗时
+      - edges[A,B]: 经 A 连接到 B 的耗时减去 entry[A]，即 A 到 B 这一跳的代价
+      - exits[B]:   经 B 连接到目标的耗时减去 entry[B]，即 B 到目标这一跳的代价
+    每条边都带有测量时间戳，超过 GRAPH_TTL 后需要重新测量；测量失败记为 None。
+    """
+
+    def __init__(self):
+        self.entry = {}
+        self.edges = {}
+        self.exits = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _fresh(value, now):
+        return value is not None and now - value[1] < GRAPH_TTL
+
+    def is_measured(self, table, key):
+        """某条边是否已在有效期内测量过（测量失败也算，避免反复测量失效代理）"""
+        return self._fresh(getattr(self, table).get(key), time.time())
+
+    def get_entry(self, a, now=None):
+        value = self.entry.get(a)
+        return value[0] if self._fresh(value, now or time.time()) else None
+
+    def get_edge(self, a, b, now=None):
+        value = self.edges.get(f"{a}|{b}")
+        return value[0] if self._fresh(value, now or time.time()) else None
+
+    def get_exit(self, a, now=None):
+        value = self.exits.get(a)
+        return value[0] if self._fresh(value, now or time.time()) else None
+
+    def set_entry(self, a, ms):
+        with self.lock:
+            self.entry[a] = (ms, time.time())
+
+    def set_edge(self, a, b, ms):
+        with self.lock:
+            self.edges[f"{a}|{b}"] = (ms, time.time())
+
+    def set_exit(self, a, ms):
+        with self.lock:
+            self.exits[a] = (ms, time.time())
+
+    def chain_cost(self, chain_keys):
+        """计算链路总延迟（毫秒），任一段缺失或失败时返回 None"""
+        now = time.time()
+        cost = self.get_entry(chain_keys[0], now)
+        if cost is None:
+            return None
+        for a, b in zip(chain_keys, chain_keys[1:]):
+            edge = self.get_edge(a, b, now)
+            if edge is None:
+                return None
+            cost += edge
+        exit_cost = self.get_exit(chain_keys[-1], now)
+        if exit_cost is None:
+            return None
+        return cost + exit_cost
+
+    def save(self, path=GRAPH_PATH):
+        """保存延迟图，便于下次启动复用"""
+        with self.lock:
+            payload = {"entry": self.entry, "edges": self.edges, "exits": self.exits}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path=GRAPH_PATH):
+        """加载已缓存的延迟图，文件不存在或损坏时保持为空"""
+        try:
+            with open(path, encoding="utf-8") as f:
+                payload = json.load(f)
+            with self.lock:
+                self.entry = {k: tuple(v) for k, v in payload.get("entry", {}).items()}
+                self.edges = {k: tuple(v) for k, v in payload.get("edges", {}).items()}
+                self.exits = {k: tuple(v) for k, v in payload.get("exits", {}).items()}
+        except Exception:
+            pass
+
+
+class ChainOptimizer:
+    """按实测端到端延迟挑选多层代理链"""
+
+    def __init__(self, graph=None, max_workers=20, log_callback=None):
+        self.graph = graph or LatencyGraph()
+        self.max_workers = max_workers
+        self.log_callback = log_callback
+
+    def log(self, message):
+        if self.log_callback:
+            self.log_callback(message)
+
+    def select_candidates(self, pool, countries=None, min_anonymity=None, limit=MAX_CANDIDATES):
+        """
+        从代理池中挑选候选节点：可用、满足匿名度要求，按分数取前 limit 个
+
+        Args:
+            pool: 代理池数据（pool.json 中的字典列表）
+            countries: 允许作为出口的国家集合，None 表示不限；
+                       为保证出口候选不被挤掉，出口国家的代理会优先入选
+            min_anonymity: 最低匿名度（高匿/普匿/透明），None 表示不限
+            limit: 候选数量上限
+        """
+        min_rank = ANONYMITY_RANK.get(min_anonymity, 0)
+        available = [
+            item for item in pool
+            if item.get("status") == "可用"
+            and item.get("address")
+            and ANONYMITY_RANK.get(item.get("anonymity", ""), 0) >= min_rank
+        ]
+        available.sort(key=lambda x: x.get("score", 0), reverse=True)
+
+        if countries:
+            exits = [item for item in available if item.get("country") in countries]
+            others = [item for item in available if item.get("country") not in countries]
+            half = max(limit // 2, 1)
+            selected = exits[:half] + others[:limit - len(exits[:half])]
+            return selected[:limit]
+        return available[:limit]
+
+    def measure(self, candidates, target=PROBE_TARGET, force=False):
+        """
+        测量候选节点之间的延迟并写入延迟图，已缓存且未过期的边会被跳过
+
+        Args:
+            candidates: 候选代理列表
+            target: 出口测量目标 (host, port)
+            force: 为 True 时忽略缓存全部重新测量
+        """
+        proxies = {}
+        for item in candidates:
+            proxy = server.parse_proxy_address(item.get("address"), item.get("protocol", "socks5"))
+            if proxy:
+                proxies[proxy_key(item)] = proxy
+
+        tasks = []
+        for key in proxies:
+            if force or not self.graph.is_measured("entry", key):
+                tasks.append(("entry", key, None))
+            if force or not self.graph.is_measured("exits", key):
+                tasks.append(("exit", key, None))
+        for a, b in itertools.permutations(proxies, 2):
+            if force or not self.graph.is_measured("edges", f"{a}|{b}"):
+                tasks.append(("edge", a, b))
+
+        if not tasks:
+            return 0
+
+        self.log(f"[链路] 开始测量 {len(proxies)} 个节点的 {len(tasks)} 条边")
+
+        def run(task):
+            kind, a, b = task
+            proxy = proxies[a]
+            if kind == "entry":
+                return task, _measure_connect(None, proxy['host'], proxy['port'])
+            if kind == "exit":
+                return task, _measure_connect(proxy, target[0], target[1])
+            return task, _measure_connect(proxy, proxies[b]['host'], proxies[b]['port'])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(run, tasks))
+
+        # 先写入入口延迟，再把经过代理的耗时换算成单跳代价
+        for (kind, a, _), ms in results:
+            if kind == "entry":
+                self.graph.set_entry(a, ms)
+        for (kind, a, b), ms in results:
+            if kind == "entry":
+                continue
+            entry = self.graph.get_entry(a)
+            hop_ms = max(ms - entry, 0.0) if ms is not None and entry is not None else None
+            if kind == "exit":
+                self.graph.set_exit(a, hop_ms)
+            else:
+                self.graph.set_edge(a, b, hop_ms)
+
+        return len(tasks)
+
+    def best_chains(self, candidates, hops=2, k=5, countries=None):
+        """
+        在延迟图上计算 k 条最优代理链
+
+        Args:
+            candidates: 候选代理列表
+            hops: 链路跳数（2或3）
+            k: 返回数量
+            countries: 出口（最后一跳）国家限制
+
+        Returns:
+            [(总延迟毫秒, [代理字典, ...]), ...]，按延迟从低到高排列
+        """
+        by_key = {proxy_key(item): item for item in candidates}
+        exit_keys = [
+            key for key, item in by_key.items()
+            if not countries or item.get("country") in countries
+        ]
+
+        # 候选规模有限（默认10个），直接枚举所有排列即可
+        scored = []
+        for exit_key in exit_keys:
+            others = [key for key in by_key if key != exit_key]
+            for prefix in itertools.permutations(others, hops - 1):
+                chain_keys = list(prefix) + [exit_key]
+                cost = self.graph.chain_cost(chain_keys)
+                if cost is not None:
+                    scored.append((cost, chain_keys))
+
+        best = heapq.nsmallest(k, scored, key=lambda x: x[0])
+        return [(round(cost, 1), [by_key[key] for key in chain_keys]) for cost, chain_keys in best]
+
+    def optimize(self, pool, hops=2, k=5, countries=None, min_anonymity=None, force=False):
+        """挑选候选、补测缺失的边并返回 k 条最优代理链"""
+        candidates = self.select_candidates(pool, countries, min_anonymity)
+        if len(candidates) < hops:
+            self.log(f"[链路] 满足条件的可用代理不足 {hops} 个")
+            return []
+
+        self.measure(candidates, force=force)
+        chains = self.best_chains(candidates, hops=hops, k=k, countries=countries)
+
+        try:
+            self.graph.save()
+        except Exception as e:
+            self.log(f"[链路] 保存延迟图失败: {e}")
+
+        return chains
+
+
+# 全局延迟图，跨多次优化复用测量结果
+_graph = None
+
+def get_graph():
+    """获取全局延迟图（首次调用时从磁盘加载缓存）"""
+    global _graph
+    if _graph is None:
+        _graph = LatencyGraph()
+        _graph.load()
+    return _graph
+
+def find_best_chains(pool, hops=2, k=5, countries=None, min_anonymity=None, log_callback=None):
+    """
+    使用全局延迟图计算最优代理链
+
+    Args:
+        pool: 代理池数据
+        hops: 链路跳数
+        k: 返回数量
+        countries: 出口国家限制
+        min_anonymity: 最低匿名度
+        log_callback: 日志回调函数
+
+    Returns:
+        [(总延迟毫秒, [代理字典, ...]), ...]
+    """
+    optimizer = ChainOptimizer(get_graph(), log_callback=log_callback)
+    return optimizer.optimize(pool, hops=hops, k=k, countries=countries, min_anonymity=min_anonymity)
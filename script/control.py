@@ -0,0 +1,277 @@
+import hmac
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from script import server
+from script.selector import COUNTRY_NAMES, ANONYMITY_NAMES
+
+# 查询代理池时默认和最多返回的条目数
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 1000
+# 状态参数的写法
+STATUS_NAMES = {"可用": "可用", "available": "可用", "不可用": "不可用", "unavailable": "不可用", "all": "all"}
+# 请求体大小上限（字节）
+MAX_BODY = 4 * 1024 * 1024
+
+
+class ControlError(Exception):
+    """请求无效，status 为返回的 HTTP 状态码"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_query(params):
+    """
+    把查询参数转为选择条件（写法同 selector.parse_selector）和状态、数量
+
+    Returns:
+        (选择条件, 状态, limit)；状态为 可用 / 不可用 / all（默认 可用）
+
+    Raises:
+        ControlError: 参数无效
+    """
+    selector = {}
+    if params.get("country"):
+        selector["country"] = COUNTRY_NAMES.get(params["country"].upper(), params["country"])
+    if params.get("proto"):
+        selector["proto"] = params["proto"].upper()
+    if params.get("anon"):
+        if params["anon"].lower() not in ANONYMITY_NAMES:
+            raise ControlError(400, f"无效的匿名度: {params['anon']}")
+        selector["anon"] = ANONYMITY_NAMES[params["anon"].lower()]
+    try:
+        if params.get("minscore"):
+            selector["minscore"] = float(params["minscore"])
+        limit = int(params.get("limit") or DEFAULT_LIMIT)
+    except ValueError:
+        raise ControlError(400, "minscore / limit 应为数字")
+    status = STATUS_NAMES.get((params.get("status") or "可用").lower())
+    if status is None:
+        raise ControlError(400, f"无效的状态: {params.get('status')}")
+    return selector, status, min(max(limit, 0), MAX_LIMIT)
+
+
+def _matches(item, selector):
+    """逐条检查选择条件（用于不在索引中的不可用代理）"""
+    if "country" in selector and selector["country"] not in item.get("country", ""):
+        return False
+    if "proto" in selector and item.get("protocol", "").upper() != selector["proto"]:
+        return False
+    if "anon" in selector and item.get("anonymity", "") != selector["anon"]:
+        return False
+    return float(item.get("score", 0) or 0) >= selector.get("minscore", float("-inf"))
+
+
+def _parse_chain(body):
+    """请求体中的上游：{"address", "protocol"} 或 {"chain": [[address, protocol], ...]}，为空列表表示直连"""
+    if "chain" in body:
+        chain = body["chain"]
+        if not isinstance(chain, list) or len(chain) > server.MAX_CHAIN_HOPS:
+            raise ControlError(400, f"chain 应为不超过 {server.MAX_CHAIN_HOPS} 跳的列表")
+    else:
+        chain = [[body.get("address"), body.get("protocol", "socks5")]] if body.get("address") else []
+    hops = []
+    for hop in chain:
+        if not isinstance(hop, (list, tuple)) or len(hop) != 2:
+            raise ControlError(400, f"无效的上游: {hop!r}")
+        address, protocol = str(hop[0]), str(hop[1] or "socks5").lower()
+        try:
+            valid = server.parse_proxy_address(address, protocol) is not None
+        except ValueError:
+            valid = False
+        if not valid or protocol not in ("socks5", "http", "https"):
+            raise ControlError(400, f"无效的上游: {protocol}://{address}")
+        hops.append((address, protocol))
+    return hops
+
+
+class _ControlHandler(BaseHTTPRequestHandler):
+    """
+    控制接口（JSON）：
+
+      GET  /status          服务状态、当前上游、代理池数量
+      GET  /pool            查询代理池：country / proto / anon / minscore / status / limit
+      GET  /pool/best       符合条件的分数最高的代理
+      POST /pool/import     {"proxies": ["socks5://host:port", ...]} 导入并测试（后台进行）
+      POST /pool/retest     重新测试代理池（后台进行）
+      GET  /upstream        当前上游代理链
+      POST /upstream        {"address", "protocol", "validate"} 或 {"chain": [[address, protocol], ...]} 切换上游
+      POST /rotate          立即轮换到下一个可用代理
+      GET  /metrics         流量指标摘要
+    """
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        token = self.server.token
+        if not token:
+            return True
+        supplied = self.headers.get("Authorization", "")
+        return hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+
+    def _read_body(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            raise ControlError(400, "无效的 Content-Length")
+        if length > MAX_BODY:
+            raise ControlError(413, "请求体过大")
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ControlError(400, "请求体不是有效的 JSON")
+        if not isinstance(body, dict):
+            raise ControlError(400, "请求体应为 JSON 对象")
+        return body
+
+    def _dispatch(self, method):
+        if not self._authorized():
+            self._send_json(401, {"error": "未授权"})
+            return
+        url = urlsplit(self.path)
+        route = getattr(self, f"_{method}_{url.path.strip('/').replace('/', '_') or 'status'}", None)
+        if route is None:
+            self._send_json(404, {"error": f"未知的接口: {method.upper()} {url.path}"})
+            return
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            status, payload = route(params) if method == "get" else route(self._read_body())
+        except ControlError as e:
+            status, payload = e.status, {"error": str(e)}
+        self._send_json(status, payload)
+
+    def do_GET(self):
+        self._dispatch("get")
+
+    def do_POST(self):
+        self._dispatch("post")
+
+    # ---------- 接口 ----------
+
+    def _get_status(self, params):
+        daemon = self.server.pool_daemon
+        data = daemon.data
+        return 200, {
+            "running": server.get_upstream_chain() is not None,
+            "upstream": server.get_upstream_chain(),
+            "pool": {"total": len(data), "available": len(daemon.index)},
+            "testing": daemon.testing,
+            "rotation": bool(daemon.scheduler and daemon.scheduler.running),
+        }
+
+    def _get_pool(self, params):
+        selector, status, limit = parse_query(params)
+        daemon = self.server.pool_daemon
+        if status == "可用":
+            total, items = daemon.index.top(selector, limit)
+        else:
+            matched = [item for item in daemon.data
+                       if (status == "all" or item.get("status") == status) and _matches(item, selector)]
+            matched.sort(key=lambda item: item.get("score", 0), reverse=True)
+            total, items = len(matched), matched[:limit]
+        return 200, {"total": total, "items": items}
+
+    def _get_pool_best(self, params):
+        selector, _, _ = parse_query(params)
+        _, items = self.server.pool_daemon.index.top(selector, 1)
+        if not items:
+            return 404, {"error": "没有符合条件的可用代理"}
+        return 200, items[0]
+
+    def _post_pool_import(self, body):
+        proxies = body.get("proxies")
+        if not isinstance(proxies, list) or not all(isinstance(proxy, str) for proxy in proxies):
+            raise ControlError(400, "proxies 应为代理地址列表")
+        proxies = [proxy.strip() for proxy in proxies if proxy.strip()]
+        if not proxies:
+            raise ControlError(400, "没有有效代理")
+        if not self.server.pool_daemon.start_test(proxies):
+            raise ControlError(409, "已有测试在进行中")
+        return 202, {"accepted": len(proxies)}
+
+    def _post_pool_retest(self, body):
+        if not self.server.pool_daemon.start_test():
+            raise ControlError(409, "已有测试在进行中")
+        return 202, {"accepted": True}
+
+    def _get_upstream(self, params):
+        chain = server.get_upstream_chain()
+        if chain is None:
+            return 503, {"error": "代理服务器未运行"}
+        return 200, {"chain": chain}
+
+    def _post_upstream(self, body):
+        hops = _parse_chain(body)
+        validate = bool(body.get("validate", True))
+        if len(hops) > 1:
+            success = server.switch_upstream_chain(hops, validate=validate)
+        else:
+            address, protocol = hops[0] if hops else (None, "socks5")
+            success = server.switch_upstream_proxy(address, protocol, validate=validate)
+        if not success:
+            raise ControlError(409, "新上游验证失败或代理服务器未运行，保留当前上游")
+        return 200, {"chain": server.get_upstream_chain()}
+
+    def _post_rotate(self, body):
+        scheduler = self.server.pool_daemon.scheduler
+        if not (scheduler and scheduler.running):
+            raise ControlError(409, "未启用IP轮换")
+        if not scheduler.rotate("手动"):
+            raise ControlError(409, "没有可切换的可用代理")
+        return 200, {"chain": server.get_upstream_chain()}
+
+    def _get_metrics(self, params):
+        return 200, server.get_metrics_summary()
+
+    def log_message(self, format, *args):
+        pass
+
+
+_control_server = None
+
+
+def start_control_server(port, daemon, host="127.0.0.1", token=""):
+    """
+    启动本地控制接口
+
+    Args:
+        daemon: 提供代理池数据和测试的 PoolDaemon
+        token: 非空时要求请求带 Authorization: Bearer <token>
+
+    Returns:
+        成功返回True，失败返回False
+    """
+    global _control_server
+    if _control_server:
+        return True
+    try:
+        _control_server = ThreadingHTTPServer((host, port), _ControlHandler)
+        _control_server.daemon_threads = True
+    except Exception:
+        _control_server = None
+        return False
+    _control_server.pool_daemon = daemon
+    _control_server.token = token
+    threading.Thread(target=_control_server.serve_forever, daemon=True).start()
+    return True
+
+
+def stop_control_server():
+    """停止本地控制接口"""
+    global _control_server
+    if _control_server:
+        _control_server.shutdown()
+        _control_server.server_close()
+        _control_server = None
@@ -0,0 +1,297 @@
+"""
+无界面运行：不依赖 Flet，适合在没有桌面环境的服务器上长期运行
+
+读取代理池，启动本地 SOCKS5 / HTTP 代理端口（以及 config.yaml 中配置的指标端点、端口固定出口等），
+按配置定时重新测试代理池和轮换上游，实际转发的健康统计定期写回代理池；日志输出到终端和（可选的）日志文件。
+启动时不导入测试模块（requests），第一次重新测试时才加载。
+设置 control_port 后提供本地 HTTP/JSON 控制接口（见 script.control），可查询代理池、导入和重新测试代理、切换上游。
+
+用法：
+  python -m script.daemon                                   # 使用代理池中分数最高的可用代理
+  python -m script.daemon --upstream socks5://1.2.3.4:1080  # 指定上游；给出 2-3 个时为多层代理链
+  python -m script.daemon --rotate 600 --retest 1800 --log-file storage/peanut.log
+"""
+import argparse
+import logging
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+from script import control, health, pool, rotation, server
+from script.selector import PoolIndex
+
+# 重新测试代理池的间隔（秒），0 表示不定时测试
+RETEST_INTERVAL = server.CONFIG.get('daemon_retest_interval', 1800)
+# 定时轮换上游的间隔（秒），0 表示不定时轮换（按连接数、流量、失败次数的条件仍然生效）
+ROTATION_INTERVAL = server.CONFIG.get('daemon_rotation_interval', 0)
+# 日志文件（相对于项目目录），留空只输出到终端
+LOG_FILE = server.CONFIG.get('daemon_log_file') or ''
+# 本地控制接口端口（HTTP/JSON），0 表示不启用；令牌非空时请求需带 Authorization: Bearer <令牌>
+CONTROL_PORT = server.CONFIG.get('control_port', 0)
+CONTROL_TOKEN = server.CONFIG.get('control_token') or ''
+# 写回健康统计、同步候选上游的间隔（秒），与界面一致
+MONITOR_INTERVAL = 2
+# 输出一次流量统计的间隔（秒）
+STATS_INTERVAL = 60
+
+
+def _parse_upstream(value):
+    """把 protocol://host:port 拆成 (host:port, protocol)，不写协议时为 socks5"""
+    protocol, sep, address = value.partition("://")
+    if not sep:
+        return value, "socks5"
+    return address, protocol.lower()
+
+
+class PoolDaemon:
+    """
+    无界面的代理池服务：代理服务、定时重新测试和上游轮换
+
+    代理池数据只在持有锁时整体替换，轮换调度器和健康统计读取的始终是完整的列表。
+    """
+
+    def __init__(self, pool_file=pool.POOL_DB, upstreams=None, retest_interval=RETEST_INTERVAL,
+                 rotation_interval=ROTATION_INTERVAL, control_port=CONTROL_PORT):
+        """
+        Args:
+            pool_file: 代理池数据库
+            upstreams: 固定的上游 [(proxy_address, proxy_protocol), ...]，为空时使用代理池中分数最高的可用代理
+            retest_interval: 重新测试代理池的间隔（秒），0 表示不定时测试
+            rotation_interval: 定时轮换的间隔（秒）
+            control_port: 本地控制接口端口，0 表示不启用
+        """
+        self.pool_file = pool_file
+        self.upstreams = list(upstreams or [])
+        self.retest_interval = retest_interval
+        self.rotation_interval = rotation_interval
+        self.control_port = control_port
+        self.data = []
+        self.scheduler = None
+        self._index = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._testing = threading.Lock()
+
+    def log(self, message):
+        logging.info(message)
+
+    # ---------- 代理池 ----------
+
+    def load(self):
+        try:
+            self.data = pool.load_pool(self.pool_file)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"[代理池] 读取 {self.pool_file} 失败，使用空代理池: {e}")
+            self.data = []
+        available = sum(1 for item in self.data if item.get("status") == "可用")
+        self.log(f"[代理池] 已加载 {len(self.data)} 条代理，可用 {available} 条")
+
+    @property
+    def index(self):
+        """可用代理的索引（按地区、协议、匿名度分组），代理池变化后第一次访问时重建"""
+        index = self._index
+        if index is None:
+            with self._lock:
+                index = self._index = PoolIndex(self.data)
+        return index
+
+    @property
+    def testing(self):
+        return self._testing.locked()
+
+    def save(self):
+        """保存代理池，成功返回True"""
+        with self._lock:
+            data = self.data
+        try:
+            pool.save_pool(data, self.pool_file)
+            return True
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f"[代理池] 写入 {self.pool_file} 失败: {e}")
+            return False
+
+    def start_test(self, proxies=None):
+        """
+        在后台测试代理：proxies 为 None 时重新测试代理池（最近有实际转发成功的代理直接保留），
+        否则导入并测试这些代理，代理池中的其他代理保持不变
+
+        Returns:
+            已有测试在进行中时返回False
+        """
+        if not self._testing.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._run_test, args=(proxies,), daemon=True).start()
+        return True
+
+    def _run_test(self, proxies):
+        try:
+            if proxies is None:
+                proxies, kept = pool.retest_targets(self.data)
+                if not proxies:
+                    return
+                self.log(f"[重测] 开始重新测试 {len(proxies)} 条代理，{len(kept)} 条最近有实际转发成功，跳过测试")
+            else:
+                imported = {proxy.lower() for proxy in proxies}
+                kept = [item for item in self.data if health.pool_key(item) not in imported]
+                self.log(f"[导入] 共 {len(proxies)} 条代理，开始测试...")
+            # Connectivity 依赖 requests，只在需要时导入
+            from script import Connectivity
+
+            # 每条结果测试完成后立即写入代理池存储
+            stream = pool.ResultStream(self.data, self.pool_file)
+            results = Connectivity.test_proxies(proxies, progress_callback=stream)
+            with self._lock:
+                self.data, available, unavailable = pool.merge_results(
+                    self.data, results, kept, log=self.log, tested_at=stream.tested_at
+                )
+                self._index = None
+            if self.save():
+                self.log(f"[完成] 已完成测试 {len(self.data)} 条代理")
+                self.log(f"[统计] 当前可用代理 {available} 个，不可用代理 {unavailable} 个")
+        except Exception as e:
+            logging.warning(f"[重测] 测试代理失败: {e}")
+        finally:
+            self._testing.release()
+
+    def apply_live_health(self):
+        """把代理服务实际转发的统计写回代理池，有代理状态变化时保存"""
+        with self._lock:
+            changed = health.apply_to_pool(self.data, rescore=pool.rescore_proxy)
+            if changed:
+                self._index = None
+        if changed:
+            self.log(f"[健康] 根据实际转发结果更新了 {changed} 条代理的状态")
+            self.save()
+
+    # ---------- 代理服务 ----------
+
+    def initial_upstream(self):
+        """启动时的上游：命令行指定的上游，或代理池中分数最高的可用代理，都没有时直连"""
+        if self.upstreams:
+            return self.upstreams
+        best = pool.healthy(self.data)[:1]
+        return [(item["address"], item.get("protocol", "socks5").lower()) for item in best]
+
+    def start(self):
+        """启动代理服务和轮换，成功返回True"""
+        upstreams = self.initial_upstream()
+        if len(upstreams) > 1:
+            self.log(f"[启动] 多层代理模式，代理链: {' -> '.join(address for address, _ in upstreams)}")
+            success = server.start_proxy_chain(upstreams)
+        else:
+            address, protocol = upstreams[0] if upstreams else (None, "socks5")
+            self.log(f"[启动] 单层代理模式，上游代理: {address or '直连'}")
+            success = server.start_proxy_server(address, protocol)
+        if not success:
+            logging.error("[错误] 代理服务器启动失败")
+            return False
+        socks5_port, http_port = server.get_server_ports()
+        self.log(f"[启动] SOCKS5: 127.0.0.1:{socks5_port}  HTTP: 127.0.0.1:{http_port}")
+
+        if len(upstreams) > 1:
+            self.log("[轮换] IP轮换仅支持单层代理模式，已跳过")
+        elif not self.upstreams:
+            self.start_rotation()
+
+        if self.control_port:
+            if control.start_control_server(self.control_port, self, token=CONTROL_TOKEN):
+                self.log(f"[启动] 控制接口: http://127.0.0.1:{self.control_port}/status")
+            else:
+                logging.warning(f"[错误] 控制接口启动失败，端口 {self.control_port} 可能被占用")
+        return True
+
+    def start_rotation(self):
+        every_connections = server.CONFIG.get("rotation_every_connections", 0)
+        every_bytes = server.CONFIG.get("rotation_every_bytes", 0)
+        on_error = server.CONFIG.get("rotation_on_error", 3)
+        if not (self.rotation_interval or every_connections or every_bytes or on_error):
+            return
+        if not pool.healthy(self.data):
+            self.log("[轮换] 没有可用的代理，未启用IP轮换")
+            return
+        self.scheduler = rotation.RotationScheduler(
+            lambda: self.data,
+            server.switch_upstream_proxy,
+            strategy=server.CONFIG.get("rotation_strategy", "round_robin"),
+            interval=self.rotation_interval,
+            every_connections=every_connections,
+            every_bytes=every_bytes,
+            on_error=on_error,
+            log_callback=self.log,
+        )
+        strategy_text = "加权" if self.scheduler.strategy == "weighted" else "轮询"
+        self.log(f"[轮换] 启用IP轮换（{strategy_text}），间隔 {self.rotation_interval} 秒")
+        self.scheduler.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        """运行直到 stop() 或收到 SIGINT / SIGTERM，返回进程退出码"""
+        self.load()
+        if not self.start():
+            return 1
+
+        last_retest = last_stats = time.monotonic()
+        while not self._stop_event.wait(MONITOR_INTERVAL):
+            try:
+                self.apply_live_health()
+            except Exception as e:
+                logging.warning(f"[健康] 更新代理状态失败: {e}")
+            server.set_pinned_pool(pool.pinned_candidates(self.data))
+            server.set_pool_index(self.data)
+
+            now = time.monotonic()
+            if self.retest_interval and now - last_retest >= self.retest_interval:
+                last_retest = now
+                self.start_test()
+            if now - last_stats >= STATS_INTERVAL:
+                last_stats = now
+                summary = server.get_metrics_summary()
+                self.log(f"[统计] 连接 {summary['active']} / {summary['connections']}，"
+                         f"上行 {summary['bytes_up']} 字节，下行 {summary['bytes_down']} 字节")
+
+        self.log("[停止] 正在停止代理服务器...")
+        control.stop_control_server()
+        if self.scheduler:
+            self.scheduler.stop()
+        server.stop_proxy_server()
+        server.TRACE.flush()
+        self.save()
+        self.log("[停止] 代理服务器已停止")
+        return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无界面运行代理池服务")
+    parser.add_argument("--upstream", action="append", default=[], metavar="PROTOCOL://HOST:PORT",
+                        help="固定的上游代理（不轮换），给出 2-3 个时为多层代理链；默认使用代理池中分数最高的可用代理并轮换")
+    parser.add_argument("--pool", default=pool.POOL_DB, help="代理池数据库（SQLite）")
+    parser.add_argument("--retest", type=int, default=RETEST_INTERVAL, help="重新测试代理池的间隔（秒），0 表示不测试")
+    parser.add_argument("--rotate", type=int, default=ROTATION_INTERVAL, help="定时轮换上游的间隔（秒），0 表示不定时轮换")
+    parser.add_argument("--control-port", type=int, default=CONTROL_PORT, help="本地控制接口端口，0 表示不启用")
+    parser.add_argument("--log-file", default=LOG_FILE, help="日志文件")
+    args = parser.parse_args(argv)
+    if args.retest < 0 or args.rotate < 0:
+        parser.error("间隔时间不能小于0秒")
+    upstreams = [_parse_upstream(value) for value in args.upstream]
+    if len(upstreams) > server.MAX_CHAIN_HOPS:
+        parser.error(f"多层代理链最多 {server.MAX_CHAIN_HOPS} 跳")
+
+    if args.log_file:
+        log_file = server._project_path(args.log_file)
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        handler = logging.FileHandler(log_file, encoding="utf-8")
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logging.getLogger().addHandler(handler)
+
+    daemon = PoolDaemon(args.pool, upstreams, args.retest, args.rotate, args.control_port)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: daemon.stop())
+    return daemon.run()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,261 @@
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+# 解析结果缓存时间（秒）；getaddrinfo 不返回记录的 TTL，统一使用该值
+DNS_TTL = 60
+# 解析失败的缓存时间（秒），避免对不存在的域名反复发起查询
+DNS_NEGATIVE_TTL = 5
+# 过期后仍可继续使用旧结果的时间（秒），期间在后台刷新，不阻塞连接
+DNS_STALE_TTL = 300
+# 缓存的域名数量上限
+DNS_MAX_ENTRIES = 4096
+# RFC 8305 建议的连接尝试间隔（秒）：上一个地址在此时间内未连上就并行尝试下一个
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', -1)}
+
+
+def _is_ip_literal(host):
+    try:
+        socket.inet_pton(socket.AF_INET6 if ':' in host else socket.AF_INET, host)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def interleave_families(addrinfos):
+    """
+    按 RFC 8305 交替排列地址族：保持系统给出的优先顺序，
+    以第一个地址的地址族开头，之后 IPv6/IPv4 交替
+    """
+    if not addrinfos:
+        return []
+    first_family = addrinfos[0][0]
+    primary = [info for info in addrinfos if info[0] == first_family]
+    secondary = [info for info in addrinfos if info[0] != first_family]
+    result = []
+    for index in range(max(len(primary), len(secondary))):
+        if index < len(primary):
+            result.append(primary[index])
+        if index < len(secondary):
+            result.append(secondary[index])
+    return result
+
+
+class DNSCache:
+    """
+    进程内共享的域名解析缓存
+
+    - 同一域名同时只发起一次查询，其余线程等待结果
+    - 过期不久的结果先继续使用，同时在后台刷新，慢速DNS不会阻塞新连接
+    - 解析失败也会短暂缓存
+    """
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL, stale_ttl=DNS_STALE_TTL,
+                 max_entries=DNS_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # host -> (地址列表或异常, 过期时间)
+        self._entries = {}
+        # host -> threading.Event，正在进行的查询
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl=None):
+        """运行时调整缓存时间"""
+        if ttl is not None:
+            self.ttl = ttl
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def resolve(self, host, port):
+        """
+        解析 host，返回 getaddrinfo 格式的地址列表（已填入 port）
+
+        Raises:
+            socket.gaierror: 解析失败
+        """
+        if _is_ip_literal(host):
+            return socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM,
+                                      0, socket.AI_NUMERICHOST)
+
+        host = host.lower()
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(host)
+                if entry and now < entry[1]:
+                    return self._with_port(entry[0], port)
+                event = self._inflight.get(host)
+                stale = entry and isinstance(entry[0], list) and now < entry[1] + self.stale_ttl
+                if event is None:
+                    event = threading.Event()
+                    self._inflight[host] = event
+                    owner = True
+                else:
+                    owner = False
+
+            if stale:
+                # 先用旧结果，后台刷新
+                if owner:
+                    threading.Thread(target=self._lookup, args=(host, event), daemon=True).start()
+                return self._with_port(entry[0], port)
+
+            if owner:
+                self._lookup(host, event)
+            else:
+                event.wait()
+
+    def _lookup(self, host, event):
+        # 无论成功与否都要移出 _inflight 并唤醒等待者，否则之后对该主机的查询会一直阻塞
+        try:
+            try:
+                infos = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+                # 去重（不同 socktype/proto 会返回重复地址）并保持系统排序
+                seen = set()
+                result = []
+                for family, socktype, proto, _, sockaddr in infos:
+                    if (family, sockaddr[0]) in seen:
+                        continue
+                    seen.add((family, sockaddr[0]))
+                    result.append((family, socktype, proto, sockaddr))
+                entry = (result, time.monotonic() + self.ttl)
+            except socket.gaierror as e:
+                entry = (e, time.monotonic() + self.negative_ttl)
+            except (UnicodeError, ValueError) as e:
+                # 标签超过63个字符、含 NUL 等无效主机名，按解析失败处理
+                entry = (socket.gaierror(socket.EAI_NONAME, f"无效的主机名: {e}"),
+                         time.monotonic() + self.negative_ttl)
+
+            with self._lock:
+                if len(self._entries) >= self.max_entries and host not in self._entries:
+                    # 缓存满时丢弃最早过期的一半
+                    oldest = sorted(self._entries, key=lambda k: self._entries[k][1])
+                    for key in oldest[:len(oldest) // 2]:
+                        del self._entries[key]
+                self._entries[host] = entry
+        finally:
+            with self._lock:
+                self._inflight.pop(host, None)
+            event.set()
+
+    @staticmethod
+    def _with_port(result, port):
+        if isinstance(result, Exception):
+            raise result
+        infos = []
+        for family, socktype, proto, sockaddr in result:
+            sockaddr = (sockaddr[0], port) + tuple(sockaddr[2:])
+            infos.append((family, socktype, proto, '', sockaddr))
+        return infos
+
+
+def _close(sock):
+    try:
+        sock.close()
+    except OSError:
+        pass
+
+
+def happy_eyeballs_connect(addrinfos, timeout=None, attempt_delay=CONNECTION_ATTEMPT_DELAY, prepare=None):
+    """
+    RFC 8305 并行连接：依次向各地址发起连接，上一个未在 attempt_delay 内成功
+    （或已失败）时立即尝试下一个，第一个连上的地址胜出，其余连接关闭
+
+    prepare(sock) 在每个套接字发起连接前调用，用于设置套接字参数
+
+    Returns:
+        已连接的套接字，超时设置与 socket.create_connection 一致
+
+    Raises:
+        OSError: 所有地址都连接失败或超时
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    queue = interleave_families(addrinfos)
+    pending = {}
+    next_attempt = 0.0
+    last_error = None
+    try:
+        while queue or pending:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout("连接超时")
+
+            if queue and (not pending or now >= next_attempt):
+                family, socktype, proto, _, sockaddr = queue.pop(0)
+                sock = None
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                    if prepare:
+                        prepare(sock)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sockaddr)
+                except OSError as e:
+                    if sock:
+                        _close(sock)
+                    last_error = e
+                    continue
+                if err == 0:
+                    sock.settimeout(timeout)
+                    return sock
+                if err not in _IN_PROGRESS:
+                    _close(sock)
+                    last_error = OSError(err, os.strerror(err))
+                    continue
+                pending[sock] = sockaddr
+                next_attempt = now + attempt_delay
+
+            # 等到有连接完成、下一次尝试时间或总超时
+            wait_until = next_attempt if queue else deadline
+            if deadline is not None and wait_until is not None:
+                wait_until = min(wait_until, deadline)
+            wait = None if wait_until is None else max(wait_until - now, 0)
+            sockets = list(pending)
+            _, writable, errored = select.select([], sockets, sockets, wait)
+
+            for sock in set(writable) | set(errored):
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0 and sock in writable:
+                    del pending[sock]
+                    sock.settimeout(timeout)
+                    return sock
+                del pending[sock]
+                _close(sock)
+                last_error = OSError(err, os.strerror(err)) if err else OSError("连接失败")
+                # 有地址失败时立即尝试下一个
+                next_attempt = 0.0
+
+        raise last_error or OSError("没有可用的地址")
+    finally:
+        for sock in pending:
+            _close(sock)
+
+
+# 全局解析缓存
+RESOLVER = DNSCache()
+
+
+def create_connection(address, timeout=None, prepare=None):
+    """
+    socket.create_connection 的替代：解析结果走全局缓存，多个地址时按 happy eyeballs 并行连接
+
+    Args:
+        address: (host, port)
+        timeout: 连接超时（秒），同时作为返回套接字的超时设置
+        prepare: 发起连接前对套接字调用的函数
+    """
+    host, port = address
+    return happy_eyeballs_connect(RESOLVER.resolve(host, port), timeout, prepare=prepare)
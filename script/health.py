@@ -0,0 +1,176 @@
+import collections
+import os
+import threading
+import time
+
+# 连续失败多少次后把代理降级为不可用
+DEMOTE_FAILURES = 3
+# 最近一次实际转发成功在多少秒内，重新测试时可以跳过该代理
+FRESH_SECONDS = 300
+# 握手延迟的指数平均系数
+LATENCY_ALPHA = 0.3
+# 单个统计窗口至少转发多少字节才计入吞吐量，避免小请求拉低估计
+MIN_THROUGHPUT_BYTES = 65536
+# 工作进程待上报事件的上限
+MAX_PENDING_EVENTS = 10000
+
+
+def pool_key(item):
+    """代理池条目对应的统计键，与服务器中单跳上游的标签一致，如 socks5://1.2.3.4:1080"""
+    return f"{item.get('protocol', 'socks5').lower()}://{item.get('address', '')}"
+
+
+class HealthTracker:
+    """
+    被动健康统计：记录本地代理服务器实际转发时每个上游的
+    连接成功/失败、握手延迟和观测到的吞吐量
+
+    多进程模式下工作进程开启 forward，事件由主进程通过 apply_events 汇总。
+    """
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # fork 出的工作进程从零开始统计
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.stats = {}
+        self.forward = False
+        self._pending = collections.deque(maxlen=MAX_PENDING_EVENTS)
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        entry = self.stats.get(key)
+        if entry is None:
+            entry = {
+                "ok": 0,
+                "fail": 0,
+                "consecutive_failures": 0,
+                "latency_ms": None,
+                "throughput": 0.0,
+                "last_success": 0.0,
+                "last_failure": 0.0,
+            }
+            self.stats[key] = entry
+        return entry
+
+    def record_connect(self, key, ok, seconds=None, at=None):
+        """记录一次经该上游建立连接（含握手）的结果和耗时"""
+        at = at or time.time()
+        with self._lock:
+            entry = self._entry(key)
+            if ok:
+                entry["ok"] += 1
+                entry["consecutive_failures"] = 0
+                entry["last_success"] = max(entry["last_success"], at)
+                if seconds is not None:
+                    ms = seconds * 1000
+                    previous = entry["latency_ms"]
+                    entry["latency_ms"] = ms if previous is None else previous + LATENCY_ALPHA * (ms - previous)
+            else:
+                entry["fail"] += 1
+                entry["consecutive_failures"] += 1
+                entry["last_failure"] = max(entry["last_failure"], at)
+            if self.forward:
+                self._pending.append(("connect", key, ok, seconds, at))
+
+    def record_throughput(self, key, bytes_per_second):
+        """记录一次观测到的下行吞吐量（字节/秒），保留观测到的最大值"""
+        with self._lock:
+            entry = self._entry(key)
+            entry["throughput"] = max(entry["throughput"], bytes_per_second)
+            if self.forward:
+                self._pending.append(("throughput", key, bytes_per_second))
+
+    def drain_events(self):
+        """取出待上报给主进程的事件"""
+        events = []
+        while True:
+            try:
+                events.append(self._pending.popleft())
+            except IndexError:
+                return events
+
+    def apply_events(self, events):
+        """应用工作进程上报的事件"""
+        for event in events:
+            if event[0] == "connect":
+                _, key, ok, seconds, at = event
+                self.record_connect(key, ok, seconds, at)
+            elif event[0] == "throughput":
+                self.record_throughput(event[1], event[2])
+
+    def snapshot(self):
+        with self._lock:
+            return {key: dict(entry) for key, entry in self.stats.items()}
+
+
+# 全局被动健康统计
+HEALTH = HealthTracker()
+
+
+def _parse_speed(text):
+    try:
+        return float(str(text).split()[0])
+    except (ValueError, IndexError):
+        return 0.0
+
+
+def is_fresh(item, now=None):
+    """代理最近是否有实际转发成功（可以跳过主动测试）"""
+    return item.get("status") == "可用" and (now or time.time()) - item.get("live_checked", 0) < FRESH_SECONDS
+
+
+def apply_to_pool(pool, tracker=HEALTH, rescore=None):
+    """
+    把被动统计写回代理池条目
+
+    - live_ok / live_fail / live_latency / live_checked：实际转发的成功、失败次数，
+      平均握手延迟（毫秒）和最近一次成功的时间
+    - 最后一次主动测试之后连续失败 DEMOTE_FAILURES 次：降级为不可用并累加 fail_count
+    - 不可用的代理在主动测试之后又有成功转发：恢复为可用
+    - 观测到的吞吐量高于测试结果时更新 speed，并调用 rescore(item) 重新计算分数
+
+    Returns:
+        状态发生变化的代理数量
+    """
+    stats = tracker.snapshot()
+    if not stats:
+        return 0
+    status_changes = 0
+    for item in pool:
+        entry = stats.get(pool_key(item))
+        if entry is None:
+            continue
+
+        item["live_ok"] = entry["ok"]
+        item["live_fail"] = entry["fail"]
+        if entry["latency_ms"] is not None:
+            item["live_latency"] = round(entry["latency_ms"], 1)
+        if entry["last_success"]:
+            item["live_checked"] = entry["last_success"]
+
+        tested_at = item.get("tested_at", 0)
+        if (
+            item.get("status") == "可用"
+            and entry["consecutive_failures"] >= DEMOTE_FAILURES
+            and entry["last_failure"] > tested_at
+        ):
+            item["status"] = "不可用"
+            item["fail_count"] = item.get("fail_count", 0) + 1
+            status_changes += 1
+        elif (
+            item.get("status") != "可用"
+            and entry["last_success"] > max(tested_at, entry["last_failure"])
+        ):
+            item["status"] = "可用"
+            item["fail_count"] = 0
+            status_changes += 1
+
+        observed = entry["throughput"] / (1024 * 1024)
+        if observed >= 0.1 and observed > _parse_speed(item.get("speed", "")):
+            item["speed"] = f"{observed:.1f} MB/s"
+            if rescore:
+                item["score"] = rescore(item)
+    return status_changes
@@ -0,0 +1,326 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# 单个响应的最大缓存大小（字节），更大的响应直接转发不缓存
+MAX_ENTRY_BYTES = 8 * 1024 * 1024
+# 可以缓存的状态码
+CACHEABLE_STATUS = {200, 203, 301, 404, 410}
+# 只有 Last-Modified 时的启发式有效期：距上次修改时间的 10%，最长一天
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_SECONDS = 86400
+# 304 响应中需要更新到缓存条目的头部
+REVALIDATION_HEADERS = {"date", "expires", "cache-control", "etag", "last-modified", "age"}
+
+
+def _value(headers, name):
+    name = name.lower()
+    values = [value for key, value in headers if key.lower() == name]
+    return ", ".join(values) if values else None
+
+
+def cache_directives(headers):
+    """解析 Cache-Control，返回 {指令: 值或 None}"""
+    directives = {}
+    for part in (_value(headers, "cache-control") or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') or None
+    return directives
+
+
+def _http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers, now=None):
+    """按 RFC 9111 计算响应的有效期（秒）：s-maxage / max-age / Expires，最后是启发式"""
+    directives = cache_directives(headers)
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            lifetime = _seconds(directives[name])
+            if lifetime is not None:
+                return lifetime
+    date = _http_date(_value(headers, "date")) or now or time.time()
+    expires = _value(headers, "expires")
+    if expires is not None:
+        expires_at = _http_date(expires)
+        return max(expires_at - date, 0) if expires_at else 0
+    last_modified = _http_date(_value(headers, "last-modified"))
+    if last_modified and date > last_modified:
+        return min((date - last_modified) * HEURISTIC_FRACTION, HEURISTIC_MAX_SECONDS)
+    return 0
+
+
+def request_cacheable(method, headers):
+    """请求是否可以使用缓存：只处理不带认证、不分段的 GET，且未声明 no-store"""
+    if method != "GET":
+        return False
+    if _value(headers, "authorization") is not None or _value(headers, "range") is not None:
+        return False
+    return "no-store" not in cache_directives(headers)
+
+
+def request_requires_revalidation(headers):
+    """请求要求先向源站验证（Cache-Control: no-cache / max-age=0 或 Pragma: no-cache）"""
+    directives = cache_directives(headers)
+    if "no-cache" in directives or directives.get("max-age") == "0":
+        return True
+    return "no-cache" in (_value(headers, "pragma") or "").lower()
+
+
+def response_cacheable(status, headers):
+    """响应是否可以存入共享缓存"""
+    if status not in CACHEABLE_STATUS:
+        return False
+    directives = cache_directives(headers)
+    if "no-store" in directives or "private" in directives:
+        return False
+    if _value(headers, "set-cookie") is not None:
+        return False
+    vary = {token.strip().lower() for token in (_value(headers, "vary") or "").split(",") if token.strip()}
+    # 缓存键只区分 Accept-Encoding，其他 Vary 无法正确匹配
+    if vary - {"accept-encoding"}:
+        return False
+    has_validator = _value(headers, "etag") is not None or _value(headers, "last-modified") is not None
+    return has_validator or freshness_lifetime(headers) > 0
+
+
+class CacheEntry:
+    """缓存的响应：起始行、头部和（保持原有分帧的）报文体"""
+
+    __slots__ = ("status_line", "headers", "body", "stored_at", "lifetime", "initial_age")
+
+    def __init__(self, status_line, headers, body, stored_at=None, lifetime=None, initial_age=None):
+        self.status_line = status_line
+        self.headers = [tuple(header) for header in headers]
+        self.body = body
+        self.stored_at = stored_at or time.time()
+        self.lifetime = freshness_lifetime(self.headers, self.stored_at) if lifetime is None else lifetime
+        if initial_age is None:
+            initial_age = _seconds(_value(self.headers, "age")) or 0
+        self.initial_age = initial_age
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(name) + len(value) for name, value in self.headers) + len(self.status_line)
+
+    def age(self, now=None):
+        return self.initial_age + max((now or time.time()) - self.stored_at, 0)
+
+    def fresh(self, now=None):
+        return self.age(now) < self.lifetime
+
+    @property
+    def etag(self):
+        return _value(self.headers, "etag")
+
+    def validators(self):
+        """向源站验证时附加的条件请求头部"""
+        headers = []
+        if self.etag:
+            headers.append(("If-None-Match", self.etag))
+        last_modified = _value(self.headers, "last-modified")
+        if last_modified:
+            headers.append(("If-Modified-Since", last_modified))
+        return headers
+
+    def response_headers(self, now=None):
+        """返回给客户端的头部（更新 Age）"""
+        headers = [(name, value) for name, value in self.headers if name.lower() != "age"]
+        headers.append(("Age", str(int(self.age(now)))))
+        return headers
+
+    def meta(self, key):
+        return {
+            "key": key, "status_line": self.status_line, "headers": self.headers,
+            "stored_at": self.stored_at, "lifetime": self.lifetime, "initial_age": self.initial_age,
+        }
+
+
+class CaptureSink:
+    """转发响应体的同时保留一份副本，超过上限时放弃保存"""
+
+    def __init__(self, dest, limit=MAX_ENTRY_BYTES):
+        self.dest = dest
+        self.limit = limit
+        self.data = bytearray()
+        self.overflow = False
+
+    def sendall(self, data):
+        self.dest.sendall(data)
+        if self.overflow:
+            return
+        if len(self.data) + len(data) > self.limit:
+            self.overflow = True
+            self.data = bytearray()
+        else:
+            self.data += data
+
+
+class HTTPCache:
+    """
+    普通 HTTP GET 响应的共享缓存：内存 LRU + 磁盘两级
+
+    命中新鲜的条目时直接返回，不经过上游；过期但带有 ETag / Last-Modified 的条目
+    由调用方带条件头部向源站验证，收到 304 后刷新有效期继续使用。
+    内存按总字节数淘汰最久未使用的条目，磁盘按总字节数淘汰最早写入的文件；
+    多进程模式下各进程有独立的内存层，共用磁盘层。
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0, max_entry_bytes=MAX_ENTRY_BYTES):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir if disk_bytes else None
+        self.disk_bytes = disk_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._memory = collections.OrderedDict()
+        self._memory_used = 0
+        self._disk = collections.OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            self._scan_disk()
+
+    @staticmethod
+    def key(host, port, path, request_headers):
+        encoding = (_value(request_headers, "accept-encoding") or "").replace(" ", "").lower()
+        return f"{host.lower()}:{port}{path}|{encoding}"
+
+    # ---------- 磁盘层 ----------
+
+    def _scan_disk(self):
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            files = []
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".cache"):
+                    stat = os.stat(os.path.join(self.disk_dir, name))
+                    files.append((stat.st_mtime, name, stat.st_size))
+        except OSError as e:
+            logging.warning(f"HTTP缓存目录不可用，只使用内存缓存: {e}")
+            self.disk_dir = None
+            return
+        for _, name, size in sorted(files):
+            self._disk[name] = size
+            self._disk_used += size
+        self._evict_disk()
+
+    def _disk_name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + ".cache"
+
+    def _evict_disk(self):
+        """在锁内调用：删除最早写入的文件直到不超过上限"""
+        while self._disk_used > self.disk_bytes and self._disk:
+            name, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+
+    def _write_disk(self, key, entry):
+        name = self._disk_name(key)
+        path = os.path.join(self.disk_dir, name)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp, "wb") as f:
+                f.write(json.dumps(entry.meta(key)).encode("utf-8") + b"\n")
+                f.write(entry.body)
+            os.replace(temp, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logging.warning(f"写入HTTP缓存文件失败: {e}")
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._disk_used += size - self._disk.pop(name, 0)
+            self._disk[name] = size
+            self._evict_disk()
+
+    def _read_disk(self, key):
+        name = self._disk_name(key)
+        try:
+            with open(os.path.join(self.disk_dir, name), "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("key") != key:
+            return None
+        return CacheEntry(meta["status_line"], meta["headers"], body,
+                          meta["stored_at"], meta["lifetime"], meta["initial_age"])
+
+    # ---------- 内存层 ----------
+
+    def _remember(self, key, entry):
+        """在锁内调用：放入内存层并按总大小淘汰"""
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= old.size
+        if entry.size > self.memory_bytes:
+            return
+        self._memory[key] = entry
+        self._memory_used += entry.size
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted.size
+
+    def lookup(self, key):
+        """查找缓存条目（不论是否新鲜），没有时返回 None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+        if not self.disk_dir:
+            return None
+        entry = self._read_disk(key)
+        if entry is not None:
+            with self._lock:
+                self._remember(key, entry)
+        return entry
+
+    def store(self, key, status_line, headers, body):
+        """保存一个可缓存的响应，成功返回True"""
+        if len(body) > self.max_entry_bytes:
+            return False
+        entry = CacheEntry(status_line, headers, bytes(body))
+        with self._lock:
+            self._remember(key, entry)
+        if self.disk_dir:
+            self._write_disk(key, entry)
+        return True
+
+    def refresh(self, key, entry, not_modified_headers):
+        """源站返回 304 后，用其中的头部更新条目并重新计算有效期"""
+        updates = [(name, value) for name, value in not_modified_headers if name.lower() in REVALIDATION_HEADERS]
+        names = {name.lower() for name, _ in updates}
+        headers = [(name, value) for name, value in entry.headers if name.lower() not in names] + updates
+        refreshed = CacheEntry(entry.status_line, headers, entry.body)
+        with self._lock:
+            self._remember(key, refreshed)
+        if self.disk_dir:
+            self._write_disk(key, refreshed)
+        return refreshed
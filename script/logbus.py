@@ -0,0 +1,117 @@
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+
+# 刷新间隔（秒），消费线程每隔这段时间批量输出一次
+FLUSH_INTERVAL = 0.2
+# 队列上限，超出时丢弃新日志并计数，热路径永不阻塞
+MAX_QUEUE = 10000
+
+_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+
+
+def parse_level(value, default=logging.INFO):
+    """把配置中的级别名（如 "INFO"）转为 logging 级别"""
+    if isinstance(value, int):
+        return value
+    return _LEVELS.get(str(value or "").upper(), default)
+
+
+class AsyncLogBus:
+    """
+    异步日志总线
+
+    热路径只做级别判断、采样计数和一次 deque.append（线程安全，无需加锁），
+    由单个消费线程定期取出，写入 logging 并按接收方批量回调。
+    """
+
+    def __init__(self, level=logging.INFO, sample_every=1, max_queue=MAX_QUEUE):
+        self.level = level
+        self.sample_every = max(int(sample_every or 1), 1)
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.dropped = 0
+        self._sample_counter = itertools.count()
+        self._consumer_started = False
+        self._start_lock = threading.Lock()
+        # fork 出的子进程没有消费线程，锁也可能处于被持有状态，需要重建
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def configure(self, level=None, sample_every=None):
+        """运行时调整级别和采样率"""
+        if level is not None:
+            self.level = parse_level(level)
+        if sample_every is not None:
+            self.sample_every = max(int(sample_every), 1)
+
+    def emit(self, level, message, sink=None):
+        """
+        提交一条日志
+
+        Args:
+            level: logging 级别；低于阈值的直接丢弃
+            message: 日志内容
+            sink: 接收方，签名为 sink(messages: list)，None 表示只写入 logging
+        """
+        if level < self.level:
+            return
+        # DEBUG 级别的逐连接日志按 1/N 采样
+        if level <= logging.DEBUG and self.sample_every > 1 and next(self._sample_counter) % self.sample_every:
+            return
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append((level, message, sink))
+        if not self._consumer_started:
+            self._start_consumer()
+
+    def _after_fork(self):
+        self._start_lock = threading.Lock()
+        self._consumer_started = False
+
+    def _start_consumer(self):
+        with self._start_lock:
+            if self._consumer_started:
+                return
+            self._consumer_started = True
+            threading.Thread(target=self._consume, daemon=True).start()
+
+    def flush(self):
+        """立即输出队列中的全部日志（在调用线程中执行）"""
+        batches = {}
+        while True:
+            try:
+                level, message, sink = self.queue.popleft()
+            except IndexError:
+                break
+            logging.log(level, message)
+            if sink is not None:
+                batches.setdefault(sink, []).append(message)
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            logging.warning(f"日志队列已满，丢弃 {dropped} 条日志")
+
+        for sink, messages in batches.items():
+            try:
+                sink(messages)
+            except Exception as e:
+                logging.warning(f"日志回调失败: {e}")
+
+    def _consume(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+# 全局日志总线
+BUS = AsyncLogBus()
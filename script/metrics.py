@@ -0,0 +1,274 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 延迟类直方图的分桶（秒）
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 连接时长直方图的分桶（秒）
+DURATION_BUCKETS = (0.1, 1.0, 5.0, 15.0, 60.0, 300.0, 1800.0)
+
+# 指标说明，渲染 Prometheus 文本时输出 HELP/TYPE
+METRIC_HELP = {
+    "peanut_connections_total": ("counter", "本地监听端口接受的连接总数"),
+    "peanut_active_connections": ("gauge", "当前活动的客户端连接数"),
+    "peanut_connection_duration_seconds": ("histogram", "客户端连接持续时间"),
+    "peanut_rejected_connections_total": ("counter", "因超出连接上限被立即拒绝的连接数"),
+    "peanut_upstream_connects_total": ("counter", "向上游（或直连目标）发起的连接次数"),
+    "peanut_upstream_connect_seconds": ("histogram", "向上游建立连接（含代理握手）的耗时"),
+    "peanut_upstream_active_tunnels": ("gauge", "当前经过该上游的活动隧道数"),
+    "peanut_upstream_bytes_total": ("counter", "经过该上游转发的字节数"),
+    "peanut_circuit_transitions_total": ("counter", "上游熔断器进入各状态的次数"),
+    "peanut_rule_decisions_total": ("counter", "按分流规则作出的各类决定次数"),
+    "peanut_http_cache_total": ("counter", "HTTP 响应缓存的命中、未命中、验证后复用和存储次数"),
+    "peanut_udp_associations": ("gauge", "当前的 SOCKS5 UDP 关联数"),
+    "peanut_udp_datagrams_total": ("counter", "经 UDP 关联转发的数据报数"),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(labels_key, extra=None):
+    items = list(labels_key)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    escaped = []
+    for name, value in items:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class ProxyMetrics:
+    """
+    进程内指标注册表：计数器、仪表和直方图
+
+    所有更新都在一把锁内完成，只在连接级别的事件上调用；
+    逐块转发的字节数由调用方先在本地累加，再批量写入。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """清空所有指标（fork 出的工作进程从零开始计数）"""
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.started_at = time.time()
+
+    def inc(self, name, labels=None, value=1):
+        """计数器累加"""
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, labels=None, value=1):
+        """仪表增减"""
+        key = (name, _labels_key(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        """直方图记录一个观测值"""
+        key = (name, _labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(buckets), 0.0, 0]
+                self.histograms[key] = histogram
+                self.buckets[name] = buckets
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        """导出当前指标的副本（可跨进程传递）"""
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {key: [list(h[0]), h[1], h[2]] for key, h in self.histograms.items()},
+                "buckets": dict(self.buckets),
+            }
+
+    @staticmethod
+    def merge(snapshots):
+        """合并多个快照（多进程模式下汇总各工作进程的指标）"""
+        merged = {"counters": {}, "gauges": {}, "histograms": {}, "buckets": {}}
+        for snapshot in snapshots:
+            for kind in ("counters", "gauges"):
+                for key, value in snapshot[kind].items():
+                    merged[kind][key] = merged[kind].get(key, 0) + value
+            for key, (counts, total, count) in snapshot["histograms"].items():
+                current = merged["histograms"].get(key)
+                if current is None:
+                    merged["histograms"][key] = [list(counts), total, count]
+                else:
+                    current[0] = [a + b for a, b in zip(current[0], counts)]
+                    current[1] += total
+                    current[2] += count
+            merged["buckets"].update(snapshot["buckets"])
+        return merged
+
+    def render(self, extra_snapshots=()):
+        """按 Prometheus 文本格式输出指标"""
+        snapshot = self.merge([self.snapshot(), *extra_snapshots])
+        series = {}
+        for kind in ("counters", "gauges", "histograms"):
+            for (name, labels), value in snapshot[kind].items():
+                series.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(series):
+            metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in sorted(series[name], key=lambda x: x[0]):
+                if metric_type != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(snapshot["buckets"][name], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, extra_snapshots=()):
+        """
+        汇总供界面展示的关键指标
+
+        Returns:
+            {"active": 活动连接数, "connections": 连接总数,
+             "bytes_up": 上行字节, "bytes_down": 下行字节,
+             "upstreams": [(上游, 下行字节, 平均连接耗时秒), ...] 按流量从高到低,
+             "failures": {上游: 连接失败次数}}
+        """
+        snapshot = self.merge([self.snapshot(), *extra_snapshots])
+        result = {"active": 0, "connections": 0, "bytes_up": 0, "bytes_down": 0, "upstreams": [], "failures": {}}
+        traffic = {}
+        for (name, labels), value in snapshot["gauges"].items():
+            if name == "peanut_active_connections":
+                result["active"] += value
+        for (name, labels), value in snapshot["counters"].items():
+            labels = dict(labels)
+            if name == "peanut_connections_total":
+                result["connections"] += value
+            elif name == "peanut_upstream_bytes_total":
+                key = "bytes_up" if labels.get("direction") == "up" else "bytes_down"
+                result[key] += value
+                if key == "bytes_down":
+                    traffic[labels.get("upstream", "")] = traffic.get(labels.get("upstream", ""), 0) + value
+            elif name == "peanut_upstream_connects_total" and labels.get("result") == "failure":
+                upstream = labels.get("upstream", "")
+                result["failures"][upstream] = result["failures"].get(upstream, 0) + value
+        latency = {}
+        for (name, labels), (_, total, count) in snapshot["histograms"].items():
+            if name == "peanut_upstream_connect_seconds" and count:
+                latency[dict(labels).get("upstream", "")] = total / count
+        result["upstreams"] = sorted(
+            ((upstream, down, latency.get(upstream)) for upstream, down in traffic.items()),
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        return result
+
+
+# 全局指标注册表
+METRICS = ProxyMetrics()
+
+# 多进程模式下各工作进程最近一次上报的快照
+_worker_snapshots = {}
+_worker_lock = threading.Lock()
+
+
+def update_worker_snapshot(worker_id, snapshot):
+    """记录工作进程上报的指标快照"""
+    with _worker_lock:
+        _worker_snapshots[worker_id] = snapshot
+
+
+def clear_worker_snapshots():
+    with _worker_lock:
+        _worker_snapshots.clear()
+
+
+def _worker_snapshot_list():
+    with _worker_lock:
+        return list(_worker_snapshots.values())
+
+
+def render():
+    """输出本进程及所有工作进程汇总后的 Prometheus 文本"""
+    return METRICS.render(_worker_snapshot_list())
+
+
+def summary():
+    """汇总本进程及所有工作进程的关键指标"""
+    return METRICS.summary(_worker_snapshot_list())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    启动本地指标端点（Prometheus 文本格式，路径 /metrics）
+
+    Returns:
+        成功返回True，失败返回False
+    """
+    global _metrics_server
+    if _metrics_server:
+        return True
+    try:
+        _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _metrics_server.daemon_threads = True
+    except Exception:
+        _metrics_server = None
+        return False
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return True
+
+
+def stop_metrics_server():
+    """停止本地指标端点"""
+    global _metrics_server
+    if _metrics_server:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
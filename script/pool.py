@@ -0,0 +1,211 @@
+import logging
+import os
+import threading
+import time
+
+from script import health
+from script.store import PoolStore
+
+_ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets")
+# 代理池数据库（SQLite）
+POOL_DB = os.path.join(_ASSETS, "pool.db")
+# 旧版代理池文件，第一次打开数据库时导入
+POOL_FILE = os.path.join(_ASSETS, "pool.json")
+# 连续测试失败多少次后从代理池中删除
+MAX_FAIL_COUNT = 5
+
+ANONYMITY_DISPLAY = {"Elite": "高匿", "Anonymous": "普匿", "Transparent": "透明"}
+ANONYMITY_RAW = {display: raw for raw, display in ANONYMITY_DISPLAY.items()}
+
+# 已打开的存储：数据库文件 -> PoolStore
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path=POOL_DB):
+    """打开（或取已打开的）代理池存储，默认数据库第一次打开时从 pool.json 导入"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = PoolStore(path, legacy_file=POOL_FILE if path == POOL_DB else None)
+        return store
+
+
+def load_pool(path=POOL_DB):
+    """
+    读取代理池，补齐 fail_count 字段
+
+    Raises:
+        OSError / sqlite3.Error: 数据库无法打开或读取
+    """
+    data = get_store(path).load()
+    for item in data:
+        if "fail_count" not in item:
+            item["fail_count"] = 0
+    return data
+
+
+def save_pool(data, path=POOL_DB):
+    """
+    把代理池写回数据库（只写入有变化的代理）
+
+    Raises:
+        sqlite3.Error: 写入失败
+    """
+    get_store(path).sync(data)
+
+
+def retest_targets(data, now=None):
+    """
+    重新测试时的代理列表：最近有实际转发成功的代理直接保留，不再测试
+
+    Returns:
+        (待测试的代理地址列表 ["socks5://host:port", ...], 原样保留的代理条目列表)
+    """
+    now = now or time.time()
+    proxies = []
+    kept = []
+    for item in data:
+        address = item.get("address", "")
+        if not address:
+            continue
+        if health.is_fresh(item, now):
+            kept.append(item)
+            continue
+        proxies.append(f"{item.get('protocol', '').lower()}://{address}")
+    return proxies, kept
+
+
+def fail_counts(data):
+    """当前代理池中每个代理的失败次数：PROTOCOL://address -> fail_count"""
+    return {
+        f"{item.get('protocol', '').upper()}://{item.get('address', '')}": item.get("fail_count", 0)
+        for item in data
+    }
+
+
+def result_item(result, fail_counts, tested_at):
+    """
+    把一条测试结果转换为代理池条目，并更新 fail_count（可用时重置为0，不可用时+1）
+
+    Returns:
+        (代理池条目, 失败次数)；失败次数达到 MAX_FAIL_COUNT、应从代理池中删除时条目为 None
+    """
+    status = "可用" if result.get("con") == "success" else "不可用"
+    protocol_display = result.get("Agreement", "").upper()
+    address = result.get("ip", "")
+    latency_ms = result.get("ms", 0.0)
+    speed_mbps = result.get("mbps", 0.0)
+    speed_mb_s = speed_mbps / 8.0 if speed_mbps else 0.0
+
+    fail_count = 0 if status == "可用" else fail_counts.get(f"{protocol_display}://{address}", 0) + 1
+    if fail_count >= MAX_FAIL_COUNT:
+        return None, fail_count
+    return {
+        "status": status,
+        "score": result.get("Score", 0.0),
+        "anonymity": ANONYMITY_DISPLAY.get(result.get("Anonymity", ""), ""),
+        "protocol": protocol_display,
+        "address": address,
+        "latency": f"{latency_ms:.1f}ms" if latency_ms else "",
+        "speed": f"{speed_mb_s:.1f} MB/s" if speed_mb_s else "",
+        "country": result.get("country", ""),
+        "city": result.get("city", ""),
+        "fail_count": fail_count,
+        "tested_at": tested_at,
+    }, fail_count
+
+
+class ResultStream:
+    """
+    测试过程中把每条结果立即写入代理池存储（作为 Connectivity.test_proxies 的进度回调使用），
+    进程在测试中途退出时已完成的结果不会丢失；全部完成后仍由 merge_results 生成新的代理池
+    """
+
+    def __init__(self, data, path=POOL_DB, progress_callback=None):
+        self.store = get_store(path)
+        self.fail_counts = fail_counts(data)
+        self.tested_at = time.time()
+        self.progress_callback = progress_callback
+
+    def __call__(self, completed, total, result):
+        if result:
+            item, _ = result_item(result, self.fail_counts, self.tested_at)
+            try:
+                if item is not None:
+                    self.store.upsert([item])
+                else:
+                    self.store.delete([{"protocol": result.get("Agreement", ""), "address": result.get("ip", "")}])
+            except Exception as e:
+                logging.warning(f"写入测试结果失败: {e}")
+        if self.progress_callback:
+            self.progress_callback(completed, total, result)
+
+
+def merge_results(data, results, kept=(), log=None, tested_at=None):
+    """
+    把测试结果合并为新的代理池：保留并更新 fail_count，失败次数过多的代理删除，按分数从高到低排序
+
+    Args:
+        data: 当前代理池（用于读取原有的 fail_count）
+        results: Connectivity.test_proxies 的测试结果
+        kept: 未参与本次测试、原样保留的代理条目
+        log: 日志函数
+        tested_at: 测试时间，使用 ResultStream 时传入其 tested_at，使逐条写入的内容与最终结果一致
+
+    Returns:
+        (新的代理池, 可用数量, 不可用数量)
+    """
+    counts = fail_counts(data)
+    tested_at = tested_at or time.time()
+    new_data = list(kept)
+    available_count = len(kept)
+    unavailable_count = 0
+
+    for result in results:
+        if result.get("con") == "success":
+            available_count += 1
+        else:
+            unavailable_count += 1
+        item, fail_count = result_item(result, counts, tested_at)
+        if item is None:
+            if log:
+                log(f"[清理] 删除失败次数过多的代理: {result.get('ip', '')} (失败{fail_count}次)")
+            continue
+        new_data.append(item)
+
+    new_data.sort(key=lambda x: x.get("score", 0), reverse=True)
+    return new_data, available_count, unavailable_count
+
+
+def rescore_proxy(item):
+    """按测试延迟、匿名度和（可能被实际转发更新过的）速度重新计算分数"""
+    # Connectivity 依赖 requests，只在需要时导入
+    from script import Connectivity
+
+    try:
+        latency_s = float(item.get("latency", "").rstrip("ms")) / 1000
+    except ValueError:
+        return item.get("score", 0.0)
+    try:
+        mbps = float(item.get("speed", "").split()[0]) * 8
+    except (ValueError, IndexError):
+        mbps = 0.0
+    score = (
+        Connectivity.calc_latency_score(latency_s)
+        + Connectivity.calc_anonymity_score(ANONYMITY_RAW.get(item.get("anonymity", ""), ""))
+        + Connectivity.calc_speed_score(mbps)
+    )
+    return round(score, 1)
+
+
+def healthy(data):
+    """可用代理，按分数从高到低"""
+    items = [item for item in data if item.get("status") == "可用" and item.get("address")]
+    items.sort(key=lambda x: x.get("score", 0), reverse=True)
+    return items
+
+
+def pinned_candidates(data):
+    """端口固定出口的候选上游：可用代理按分数从高到低"""
+    return [[(item["address"], item.get("protocol", "socks5").lower())] for item in healthy(data)]
@@ -0,0 +1,223 @@
+import random
+import threading
+import time
+
+from script import server
+
+# 选择策略：round_robin 按顺序轮询可用代理，weighted 按分数加权随机
+STRATEGIES = ("round_robin", "weighted")
+
+# 检查切换条件的间隔（秒）
+POLL_INTERVAL = 0.5
+# 每次轮换最多尝试的候选数，验证失败的候选会跳过
+MAX_ATTEMPTS = 3
+# 验证失败的代理在这段时间内（秒）不再作为候选
+FAILED_COOLDOWN = 120
+# 当前代理失效但没有可切换的候选时，重试的间隔（秒）
+RETRY_INTERVAL = 10
+
+
+class RotationScheduler:
+    """
+    IP轮换调度器
+
+    候选代理每次轮换时从 pool_provider() 实时读取（代理池重新测试后立即生效），
+    只在状态为"可用"的代理中选择；切换前由 switch_func 验证新代理，失败则换下一个。
+
+    触发条件（满足任一即切换）：
+      - interval:          距上次切换超过 N 秒
+      - every_connections: 距上次切换新增 N 个连接
+      - every_bytes:       距上次切换转发了 N 字节
+      - on_error:          当前代理连接失败 N 次
+    """
+
+    def __init__(self, pool_provider, switch_func, strategy="round_robin", interval=0,
+                 every_connections=0, every_bytes=0, on_error=0, log_callback=None, on_switch=None):
+        """
+        Args:
+            pool_provider: 返回当前代理池数据（pool.json 中的字典列表）的函数
+            switch_func: 切换函数 switch_func(address, protocol) -> bool，返回 False 表示验证失败
+            strategy: 选择策略，见 STRATEGIES
+            interval / every_connections / every_bytes / on_error: 触发条件，0 表示不启用
+            log_callback: 日志回调函数
+            on_switch: 切换成功后的回调 on_switch(proxy_item, reason)
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"不支持的轮换策略: {strategy}")
+        self.pool_provider = pool_provider
+        self.switch_func = switch_func
+        self.strategy = strategy
+        self.interval = interval
+        self.every_connections = every_connections
+        self.every_bytes = every_bytes
+        self.on_error = on_error
+        self.log_callback = log_callback
+        self.on_switch = on_switch
+
+        self.current = None
+        self._cursor = 0
+        self._failed = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pool_labels = None
+        self._baseline = None
+        self._switched_at = 0
+
+    def log(self, message):
+        if self.log_callback:
+            self.log_callback(message)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """启动调度线程（立即切换到第一个代理）"""
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if server.affinity_enabled() and self._pool_labels:
+            server.set_upstream_pool([])
+            self._pool_labels = None
+
+    def _healthy(self):
+        return [
+            item for item in self.pool_provider() or []
+            if item.get("status") == "可用" and item.get("address")
+        ]
+
+    def candidates(self):
+        """当前可用的候选代理（按代理池顺序，排除最近验证失败的）"""
+        now = time.monotonic()
+        return [
+            item for item in self._healthy()
+            if now - self._failed.get(item["address"], -FAILED_COOLDOWN) >= FAILED_COOLDOWN
+        ]
+
+    def _order(self, candidates):
+        """按策略排列候选顺序，不包含当前代理"""
+        current_address = self.current.get("address") if self.current else None
+        addresses = [item["address"] for item in candidates]
+        if self.strategy == "round_robin":
+            # 从当前代理在池中的下一个位置开始；当前代理已不在池中时从上次的位置继续
+            start = addresses.index(current_address) + 1 if current_address in addresses else self._cursor
+            start = start % len(candidates) if candidates else 0
+            ordered = candidates[start:] + candidates[:start]
+            return [item for item in ordered if item["address"] != current_address]
+        candidates = [item for item in candidates if item["address"] != current_address]
+        if self.strategy == "weighted":
+            # 按分数加权的不放回抽样
+            weights = [max(item.get("score", 0), 1) for item in candidates]
+            order = []
+            remaining = list(zip(candidates, weights))
+            while remaining and len(order) < MAX_ATTEMPTS:
+                index = random.choices(range(len(remaining)), weights=[w for _, w in remaining])[0]
+                order.append(remaining.pop(index)[0])
+            return order
+        return candidates
+
+    def _stats(self):
+        summary = server.get_metrics_summary()
+        return summary["connections"], summary["bytes_up"] + summary["bytes_down"], summary["failures"]
+
+    def _current_label(self):
+        if not self.current:
+            return None
+        proxy = server.parse_proxy_address(self.current.get("address"), self.current.get("protocol", "socks5"))
+        return server.upstream_label([proxy]) if proxy else None
+
+    def _due(self):
+        """检查是否满足切换条件，返回触发原因，未满足时返回 None"""
+        if self._baseline is None:
+            return "启动"
+        elapsed = time.monotonic() - self._switched_at
+        if self.interval and elapsed >= self.interval:
+            return "定时"
+        if elapsed >= RETRY_INTERVAL and (
+            self.current is None
+            or not any(item["address"] == self.current.get("address") for item in self._healthy())
+        ):
+            return "当前代理已失效"
+        if not (self.every_connections or self.every_bytes or self.on_error):
+            return None
+
+        connections, traffic, failures = self._stats()
+        base_connections, base_traffic, base_failures = self._baseline
+        if self.every_connections and connections - base_connections >= self.every_connections:
+            return f"已处理 {connections - base_connections} 个连接"
+        if self.every_bytes and traffic - base_traffic >= self.every_bytes:
+            return "流量达到阈值"
+        label = self._current_label()
+        if self.on_error and label and failures.get(label, 0) - base_failures.get(label, 0) >= self.on_error:
+            return "当前代理连接失败"
+        return None
+
+    def _sync_affinity_pool(self):
+        """粘性模式下，把当前所有可用代理同步为粘性上游池（有变化时才更新）"""
+        if not server.affinity_enabled():
+            return
+        healthy = self._healthy()
+        labels = [item["address"] for item in healthy]
+        if labels == self._pool_labels:
+            return
+        if not server.set_upstream_pool([[(item["address"], item.get("protocol", "socks5").lower())] for item in healthy]):
+            # 下发失败（代理服务器未运行或超出共享内存大小）时不记录，下次继续尝试
+            return
+        self._pool_labels = labels
+        self.log(f"[轮换] 粘性上游池已更新: {len(healthy)} 个代理")
+
+    def rotate(self, reason="手动"):
+        """
+        立即切换到下一个候选代理
+
+        Returns:
+            切换成功返回True
+        """
+        self._sync_affinity_pool()
+        candidates = self.candidates()
+        order = self._order(candidates)
+        if not order:
+            self.log("[轮换] 没有其他可用的代理，保持当前上游")
+            self._mark_switched()
+            return False
+
+        for item in order[:MAX_ATTEMPTS]:
+            address = item.get("address")
+            protocol = item.get("protocol", "socks5").lower()
+            self._cursor = candidates.index(item) + 1
+            if self.switch_func(address, protocol):
+                self.current = item
+                self._mark_switched()
+                self.log(f"[轮换] 切换到 {address}（{reason}）")
+                if self.on_switch:
+                    self.on_switch(item, reason)
+                return True
+            self._failed[address] = time.monotonic()
+            self.log(f"[轮换] {address} 验证失败，跳过")
+
+        self.log("[轮换] 本轮候选均验证失败，保持当前上游")
+        self._mark_switched()
+        return False
+
+    def _mark_switched(self):
+        self._switched_at = time.monotonic()
+        try:
+            self._baseline = self._stats()
+        except Exception:
+            self._baseline = (0, 0, {})
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                reason = self._due()
+                if reason:
+                    self.rotate(reason)
+            except Exception as e:
+                self.log(f"[轮换] 调度错误: {e}")
+                self._mark_switched()
+            self._stop_event.wait(POLL_INTERVAL)
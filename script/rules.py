@@ -0,0 +1,289 @@
+import ipaddress
+import logging
+import os
+import threading
+import time
+
+from script.selector import parse_selector
+
+try:
+    # GeoIP 规则需要 maxminddb 和 MaxMind 格式的国家数据库，未安装时忽略 GEOIP 规则
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+# 分流动作
+DIRECT = "direct"
+PROXY = "proxy"
+REJECT = "reject"
+POOL = "pool"
+
+# 规则文件修改检查间隔（秒），文件变化后下一次连接时重新加载
+RELOAD_INTERVAL = 2
+
+
+def parse_action(text):
+    """
+    解析规则动作：DIRECT、PROXY、REJECT 或 POOL:<选择条件>（格式同代理认证用户名，如 POOL:country-US）
+
+    Returns:
+        (动作, 选择条件字典)，无法识别时返回 None
+    """
+    name, _, argument = text.strip().partition(":")
+    name = name.strip().lower()
+    if name in (DIRECT, PROXY, REJECT) and not argument:
+        return name, None
+    if name == POOL:
+        selector = parse_selector(argument.strip())
+        if selector is not None:
+            return POOL, selector
+    return None
+
+
+class DomainTrie:
+    """
+    域名后缀树：按标签从顶级域开始逐级查找，匹配最长的后缀，
+    查找耗时只与域名的标签数有关，与规则数量无关
+    """
+
+    _ACTION = object()
+
+    def __init__(self):
+        self._root = {}
+        self.size = 0
+
+    def insert(self, suffix, action):
+        node = self._root
+        for label in reversed(suffix.strip(".").lower().split(".")):
+            node = node.setdefault(label, {})
+        if DomainTrie._ACTION not in node:
+            self.size += 1
+        node[DomainTrie._ACTION] = action
+
+    def match(self, host):
+        node = self._root
+        matched = None
+        for label in reversed(host.strip(".").lower().split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            matched = node.get(DomainTrie._ACTION, matched)
+        return matched
+
+
+class CIDRTable:
+    """按前缀长度分组的网段表，最长前缀优先；查找次数不超过出现过的前缀长度种数"""
+
+    def __init__(self):
+        # IP 版本 -> {前缀长度: {网络地址整数: 动作}}，_lengths 中的前缀长度从长到短
+        self._tables = {4: {}, 6: {}}
+        self._lengths = {4: [], 6: []}
+        self.size = 0
+
+    def add(self, network, action):
+        network = ipaddress.ip_network(network, strict=False)
+        table = self._tables[network.version].setdefault(network.prefixlen, {})
+        table[int(network.network_address)] = action
+        self._lengths[network.version] = sorted(self._tables[network.version], reverse=True)
+        self.size += 1
+
+    def match(self, ip):
+        address = ipaddress.ip_address(ip)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        bits = address.max_prefixlen
+        value = int(address)
+        tables = self._tables[address.version]
+        for prefixlen in self._lengths[address.version]:
+            masked = value >> (bits - prefixlen) << (bits - prefixlen) if prefixlen else 0
+            action = tables[prefixlen].get(masked)
+            if action is not None:
+                return action
+        return None
+
+
+class RuleSet:
+    """
+    编译后的分流规则（只读）
+
+    规则文件每行一条 类型,值,动作[,no-resolve]，# 开头为注释：
+      DOMAIN-SUFFIX,example.com,DIRECT      example.com 及其子域名
+      DOMAIN,api.example.com,REJECT         只匹配该域名
+      IP-CIDR,10.0.0.0/8,DIRECT             目标 IP 所在网段，域名目标会先解析（no-resolve 时不解析）
+      GEOIP,CN,DIRECT                       目标 IP 所属国家（需要 maxminddb 和 geoip_database）
+      MATCH,PROXY                           以上都不匹配时的动作，默认 PROXY
+
+    匹配顺序：域名规则（最长后缀优先）→ 网段（最长前缀优先）→ GeoIP → MATCH。
+    """
+
+    def __init__(self, lines=(), geoip_path=None):
+        self.domains = DomainTrie()
+        self.exact = {}
+        self.cidrs = CIDRTable()
+        self.resolve_cidrs = False
+        self.geoip = {}
+        self.default = (PROXY, None)
+        self.errors = []
+        self._geoip_reader = None
+
+        for number, line in enumerate(lines, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            try:
+                self._add(line)
+            except ValueError as e:
+                self.errors.append(f"第 {number} 行: {e}")
+
+        if self.geoip:
+            if maxminddb is None:
+                self.errors.append("未安装 maxminddb，GEOIP 规则已忽略")
+                self.geoip = {}
+            elif not geoip_path:
+                self.errors.append("未配置 geoip_database，GEOIP 规则已忽略")
+                self.geoip = {}
+            else:
+                try:
+                    self._geoip_reader = maxminddb.open_database(geoip_path)
+                except Exception as e:
+                    self.errors.append(f"打开 GeoIP 数据库失败，GEOIP 规则已忽略: {e}")
+                    self.geoip = {}
+
+    def _add(self, line):
+        fields = [field.strip() for field in line.split(",")]
+        kind = fields[0].upper()
+        if kind == "MATCH":
+            if len(fields) != 2 or not parse_action(fields[1]):
+                raise ValueError(f"无效的 MATCH 规则: {line}")
+            self.default = parse_action(fields[1])
+            return
+        if len(fields) < 3:
+            raise ValueError(f"规则格式应为 类型,值,动作: {line}")
+        action = parse_action(fields[2])
+        if not action:
+            raise ValueError(f"无效的动作: {fields[2]}")
+        value = fields[1]
+        if kind == "DOMAIN-SUFFIX":
+            self.domains.insert(value, action)
+        elif kind == "DOMAIN":
+            self.exact[value.strip(".").lower()] = action
+        elif kind in ("IP-CIDR", "IP-CIDR6"):
+            self.cidrs.add(value, action)
+            if "no-resolve" not in (field.lower() for field in fields[3:]):
+                self.resolve_cidrs = True
+        elif kind == "GEOIP":
+            self.geoip[value.upper()] = action
+        else:
+            raise ValueError(f"不支持的规则类型: {kind}")
+
+    @property
+    def size(self):
+        return self.domains.size + len(self.exact) + self.cidrs.size + len(self.geoip)
+
+    def _match_ip(self, ip):
+        action = self.cidrs.match(ip) if self.cidrs.size else None
+        if action is None and self._geoip_reader:
+            try:
+                record = self._geoip_reader.get(ip) or {}
+            except ValueError:
+                record = {}
+            country = (record.get("country") or record.get("registered_country") or {}).get("iso_code")
+            action = self.geoip.get(country) if country else None
+        return action
+
+    def decide(self, host, resolve=None):
+        """
+        返回目标主机的分流动作 (动作, 选择条件)
+
+        Args:
+            host: 目标域名或 IP
+            resolve: 域名解析函数 resolve(host) -> IP，需要按 IP 规则匹配域名时调用
+        """
+        # 顶级域不会以数字结尾，只有可能是 IP 时才解析地址
+        is_ip = False
+        if host and (host[-1].isdigit() or ":" in host):
+            try:
+                ipaddress.ip_address(host)
+                is_ip = True
+            except ValueError:
+                pass
+
+        if is_ip:
+            return self._match_ip(host) or self.default
+
+        action = self.exact.get(host.strip(".").lower()) or self.domains.match(host)
+        if action:
+            return action
+        if resolve and (self.resolve_cidrs or self.geoip):
+            try:
+                ip = resolve(host)
+            except OSError:
+                ip = None
+            if ip:
+                return self._match_ip(ip) or self.default
+        return self.default
+
+
+class RuleEngine:
+    """
+    分流规则引擎：从规则文件加载 RuleSet，文件修改后自动重新加载（不需要重启监听端口）
+
+    重新加载时先编译新规则再整体替换，正在进行的匹配不受影响；
+    新规则文件有错误时只跳过错误的行，文件无法读取时保留当前规则。
+    """
+
+    def __init__(self, path=None, geoip_path=None):
+        self.path = path
+        self.geoip_path = geoip_path
+        self.ruleset = RuleSet()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        if path:
+            self.reload()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def reload(self):
+        """重新读取规则文件，成功返回True"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, "r", encoding="utf-8") as f:
+                ruleset = RuleSet(f.read().splitlines(), self.geoip_path)
+        except OSError as e:
+            logging.warning(f"读取分流规则失败，保留当前规则: {e}")
+            self._mtime = None
+            return False
+        for error in ruleset.errors:
+            logging.warning(f"分流规则: {error}")
+        self.ruleset = ruleset
+        self._mtime = mtime
+        logging.info(f"已加载分流规则 {ruleset.size} 条: {self.path}")
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < RELOAD_INTERVAL:
+            return
+        # 只有一个线程负责检查，其余连接直接使用当前规则
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != self._mtime:
+                self.reload()
+        finally:
+            self._lock.release()
+
+    def decide(self, host, resolve=None):
+        """返回目标主机的分流动作 (动作, 选择条件)，未启用规则时总是 PROXY"""
+        if not self.path:
+            return PROXY, None
+        self._maybe_reload()
+        return self.ruleset.decide(host, resolve)
@@ -0,0 +1,171 @@
+import bisect
+import itertools
+import threading
+
+from script.affinity import HashRing
+from script.health import pool_key
+
+# 用户名中可用的选择条件，如 country-US-minscore-200-session-abc123
+SELECTOR_KEYS = ("country", "proto", "anon", "minscore", "session")
+
+# 常用国家/地区代码与代理池中地区名称的对应（地区名称来自连通性测试的归属地查询）
+COUNTRY_NAMES = {
+    "CN": "中国", "HK": "香港", "TW": "台湾", "MO": "澳门", "US": "美国", "CA": "加拿大",
+    "JP": "日本", "KR": "韩国", "SG": "新加坡", "GB": "英国", "UK": "英国", "DE": "德国",
+    "FR": "法国", "NL": "荷兰", "RU": "俄罗斯", "IN": "印度", "ID": "印度尼西亚",
+    "TH": "泰国", "VN": "越南", "MY": "马来西亚", "PH": "菲律宾", "AU": "澳大利亚",
+    "BR": "巴西", "MX": "墨西哥", "AR": "阿根廷", "TR": "土耳其", "IT": "意大利",
+    "ES": "西班牙", "PL": "波兰", "UA": "乌克兰", "SE": "瑞典", "CH": "瑞士",
+    "ZA": "南非", "EG": "埃及", "IR": "伊朗", "BD": "孟加拉", "PK": "巴基斯坦",
+}
+
+# 缓存的选择条件组合数量上限
+MAX_CACHED_SELECTORS = 256
+
+# 匿名度条件的写法与代理池中显示名称的对应
+ANONYMITY_NAMES = {
+    "elite": "高匿", "anonymous": "普匿", "transparent": "透明",
+    "高匿": "高匿", "普匿": "普匿", "透明": "透明",
+}
+
+
+def parse_selector(username):
+    """
+    把代理认证用户名解析为选择条件
+
+    格式为以 - 分隔的 键-值 对：country、proto、anon、minscore 各取一个值，
+    session 取之后的全部内容（可包含 -）。
+
+    Returns:
+        条件字典；用户名不是选择条件（含未知的键或格式错误）时返回 None
+    """
+    tokens = (username or "").split("-")
+    selector = {}
+    index = 0
+    while index < len(tokens):
+        key = tokens[index].lower()
+        if key not in SELECTOR_KEYS or index + 1 >= len(tokens):
+            return None
+        if key == "session":
+            selector["session"] = "-".join(tokens[index + 1:])
+            break
+        value = tokens[index + 1]
+        if key == "country":
+            selector["country"] = COUNTRY_NAMES.get(value.upper(), value)
+        elif key == "proto":
+            selector["proto"] = value.upper()
+        elif key == "anon":
+            if value.lower() not in ANONYMITY_NAMES:
+                return None
+            selector["anon"] = ANONYMITY_NAMES[value.lower()]
+        elif key == "minscore":
+            try:
+                selector["minscore"] = float(value)
+            except ValueError:
+                return None
+        index += 2
+    return selector or None
+
+
+class PoolIndex:
+    """
+    代理池的只读索引视图，按地区、协议、匿名度分组，组内按分数从高到低排列
+
+    选择条件先取最小的分组，再按分数截断，最后逐条检查其余条件；
+    同一组条件的结果会缓存，代理池更新时重建整个索引。
+    带 session 的连接在符合条件的代理中按一致性哈希固定出口，其余连接依次轮询。
+    """
+
+    def __init__(self, items=(), make_chain=None):
+        """
+        Args:
+            items: 代理池条目（pool.json 中的字典），只索引状态为"可用"的
+            make_chain: 把条目转换为上游链路的函数，返回 None 的条目会被忽略
+        """
+        self.entries = []
+        for item in items:
+            if item.get("status") != "可用" or not item.get("address"):
+                continue
+            chain = make_chain(item) if make_chain else (item["address"], item.get("protocol", "socks5").lower())
+            if chain:
+                self.entries.append((float(item.get("score", 0) or 0), item, chain, pool_key(item)))
+        self.entries.sort(key=lambda entry: entry[0], reverse=True)
+        self.labels = frozenset(entry[3] for entry in self.entries)
+
+        self._groups = {}
+        for entry in self.entries:
+            item = entry[1]
+            for group in (
+                ("country", item.get("country", "")),
+                ("proto", item.get("protocol", "").upper()),
+                ("anon", item.get("anonymity", "")),
+            ):
+                self._groups.setdefault(group, []).append(entry)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _group(self, key, value):
+        if key != "country":
+            return self._groups.get((key, value), [])
+        # 地区名称可能带有前缀（如 中国香港），按包含关系匹配
+        matched = [entries for (name, country), entries in self._groups.items()
+                   if name == "country" and value and value in country]
+        if len(matched) == 1:
+            return matched[0]
+        return sorted(itertools.chain.from_iterable(matched), key=lambda entry: entry[0], reverse=True)
+
+    def _match(self, selector):
+        """符合条件的代理（按分数从高到低）"""
+        groups = [self._group(key, selector[key]) for key in ("country", "proto", "anon") if key in selector]
+        base = entries = min(groups, key=len) if groups else self.entries
+        if "minscore" in selector:
+            # 组内按分数降序，找到第一个低于下限的位置
+            scores = [-entry[0] for entry in entries]
+            entries = entries[:bisect.bisect_right(scores, -selector["minscore"])]
+        for group in groups:
+            if group is not base:
+                members = {id(entry) for entry in group}
+                entries = [entry for entry in entries if id(entry) in members]
+        return entries
+
+    def _cached(self, selector):
+        """在锁内调用：同一组条件（不含 session）的匹配结果"""
+        key = tuple(sorted((k, v) for k, v in selector.items() if k != "session"))
+        cached = self._cache.get(key)
+        if cached is None:
+            if len(self._cache) >= MAX_CACHED_SELECTORS:
+                self._cache.clear()
+            cached = self._cache[key] = {"entries": self._match(selector), "counter": itertools.count()}
+        return cached
+
+    def top(self, selector, limit=None):
+        """
+        按选择条件返回分数最高的代理池条目
+
+        Returns:
+            (符合条件的总数, 前 limit 个条目)
+        """
+        with self._lock:
+            entries = self._cached(selector)["entries"]
+        return len(entries), [entry[1] for entry in entries[:limit]]
+
+    def select(self, selector):
+        """
+        按选择条件返回一个上游，没有符合条件的代理时返回 None
+        """
+        session = selector.get("session")
+        with self._lock:
+            cached = self._cached(selector)
+            entries = cached["entries"]
+            if not entries:
+                return None
+            if session and "ring" not in cached:
+                # 按代理标识建环，代理池更新后同一 session 大多仍落在原来的代理上
+                cached["ring"] = HashRing([entry[3] for entry in entries])
+                cached["chains"] = {entry[3]: entry[2] for entry in entries}
+        if session:
+            return cached["chains"][cached["ring"].get(session)]
+        return entries[next(cached["counter"]) % len(entries)][2]
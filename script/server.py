@@ -2,37 +2,485 @@ import socket
 import select
 import threading
 import struct
+import time
 import logging
+import ipaddress
 import os
+import json
+import base64
+import types
+import multiprocessing
+import selectors
 import yaml
 
+from script.metrics import METRICS, DURATION_BUCKETS
+from script.logbus import BUS as LOG_BUS
+from script import metrics
+from script import dialer
+from script.health import HEALTH, MIN_THROUGHPUT_BYTES
+from script.breaker import CircuitBreaker
+from script.affinity import HashRing, affinity_key, AFFINITY_MODES
+from script.selector import PoolIndex, parse_selector
+from script.rules import RuleEngine
+from script import httpcache
+from script.sockopts import SocketOptions
+from script.trace import TraceRecorder
+from script.udprelay import UDP_RELAY, UDPAssociation
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # 读取配置文件
 def load_config():
-    """加载配置文件"""
+    """加载配置文件，读取失败时返回空配置（各项使用默认值）"""
     try:
         config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), './assets/config.yaml')
         with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-            return config.get('socks5_port', 1080), config.get('http_port', 1081)
+            return yaml.safe_load(f) or {}
     except Exception as e:
-        logging.warning(f"读取配置文件失败，使用默认端口: {e}")
-        return 1080, 1081
+        logging.warning(f"读取配置文件失败，使用默认配置: {e}")
+        return {}
+
+CONFIG = load_config()
 
 # 获取配置的端口
-SOCKS5_PORT, HTTP_PORT = load_config()
+SOCKS5_PORT = CONFIG.get('socks5_port', 1080)
+HTTP_PORT = CONFIG.get('http_port', 1081)
+# 监听队列长度，突发连接较多时需要调大
+LISTEN_BACKLOG = CONFIG.get('backlog', 1024)
+# 工作进程数，大于1时使用 SO_REUSEPORT 多进程监听（仅Linux）
+WORKERS = CONFIG.get('workers', 1)
+# 本地指标端点端口（Prometheus 文本格式），0 表示不启用
+METRICS_PORT = CONFIG.get('metrics_port', 0)
+
+# 服务器日志级别和逐连接日志（DEBUG）的采样率：每 N 条保留 1 条
+LOG_BUS.configure(CONFIG.get('log_level', 'INFO'), CONFIG.get('log_sample_every', 1))
+
+# 连接上限：每个监听端口的最大并发连接数、经过同一上游的最大并发隧道数（0 表示不限制）
+MAX_CONNECTIONS = CONFIG.get('max_connections', 1024)
+MAX_CONNECTIONS_PER_UPSTREAM = CONFIG.get('max_connections_per_upstream', 256)
+# 上游连接（含代理握手）超时（秒）
+UPSTREAM_TIMEOUT = CONFIG.get('connect_timeout', 10)
+# 隧道空闲超时和最长存活时间（秒），0 表示不限制
+IDLE_TIMEOUT = CONFIG.get('idle_timeout', 300)
+MAX_LIFETIME = CONFIG.get('max_lifetime', 0)
+# 域名解析结果缓存时间（秒）
+dialer.RESOLVER.configure(ttl=CONFIG.get('dns_ttl', 60))
+# 切换上游前先经新上游连接探测目标，失败时保留当前上游
+VALIDATE_ON_SWITCH = CONFIG.get('validate_on_switch', True)
+# 切换后旧上游上的连接最多保留的时间（秒），超时后关闭，0 表示等待其自然结束
+DRAIN_TIMEOUT = CONFIG.get('drain_timeout', 300)
+# 切换前探测使用的目标，与连通性测试保持一致
+PROBE_TARGET = ("www.baidu.com", 443)
+# 预先建立到第一跳代理的TCP连接数及其有效期（秒）
+WARM_SOCKETS = 2
+WARM_TTL = 10
+# 客户端完成 SOCKS5 握手的超时（秒）
+HANDSHAKE_TIMEOUT = 10
+# 多层代理链最大跳数
+MAX_CHAIN_HOPS = 3
+# 粘性模式：off 不启用，client 按客户端，username 按代理认证用户名，domain 按目标站点
+AFFINITY_MODE = str(CONFIG.get('affinity_mode') or 'off').lower()
+# client 模式下的客户端端口分组大小，0 表示只按客户端 IP
+AFFINITY_PORT_GROUP = CONFIG.get('affinity_port_group', 0)
+# 端口固定出口：范围内的每个端口固定使用代理池中的一个代理，如 "20000-20099"，留空不启用
+PINNED_PORTS = CONFIG.get('pinned_ports') or ''
+# 分流规则文件（相对于项目目录），按目标域名/IP 决定直连、走代理、走代理池中的指定代理或拒绝，留空不启用
+RULES_FILE = CONFIG.get('rules_file') or ''
+# GeoIP 国家数据库（MaxMind mmdb 格式），GEOIP 规则需要
+GEOIP_DATABASE = CONFIG.get('geoip_database') or ''
+# 上游熔断：最近连接中失败（含超过 circuit_slow_seconds 的慢连接）比例达到 circuit_failure_rate 时
+# 直接拒绝经该上游的新连接，circuit_open_seconds 后放行少量试探连接；比例为 0 时不启用
+CIRCUIT_FAILURE_RATE = CONFIG.get('circuit_failure_rate', 0.5)
+CIRCUIT_OPEN_SECONDS = CONFIG.get('circuit_open_seconds', 30)
+CIRCUIT_SLOW_SECONDS = CONFIG.get('circuit_slow_seconds', 5)
+# HTTP 代理端口的共享响应缓存（只缓存普通 HTTP 的 GET 响应，HTTPS 隧道不受影响）
+HTTP_CACHE_ENABLED = CONFIG.get('http_cache', False)
+HTTP_CACHE_MEMORY_MB = CONFIG.get('http_cache_memory_mb', 64)
+HTTP_CACHE_DIR = CONFIG.get('http_cache_dir') or ''
+HTTP_CACHE_DISK_MB = CONFIG.get('http_cache_disk_mb', 512)
+# 套接字参数（TCP_NODELAY、保活、缓冲区、监听端口的 Fast Open），按监听端口、上游和直连分别配置
+SOCKET_OPTIONS = SocketOptions(CONFIG.get('socket_options'))
+# 连接轨迹文件（相对于项目目录），记录每个连接的时间、目标主机哈希和字节数，供 script.trace 回放；留空不记录
+TRACE_FILE = CONFIG.get('trace_file') or ''
+# SOCKS5 UDP ASSOCIATE：上游不是支持 UDP 的单层 SOCKS5 代理时是否直接发送（会暴露本机出口 IP）
+UDP_DIRECT_FALLBACK = CONFIG.get('udp_direct_fallback', True)
+
+
+def _recv_exact(sock, length):
+    """从套接字精确读取 length 字节，连接提前关闭时抛出异常"""
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise Exception("连接被提前关闭")
+        data += chunk
+    return data
+
+
+def _build_socks5_request(target_host, target_port, cmd=1):
+    """构造SOCKS5请求（默认CONNECT），自动识别IPv4/IPv6/域名"""
+    try:
+        ip = ipaddress.ip_address(target_host)
+        if ip.version == 4:
+            address = b'\x01' + ip.packed
+        else:
+            address = b'\x04' + ip.packed
+    except ValueError:
+        host_bytes = target_host.encode('idna')
+        address = b'\x03' + bytes([len(host_bytes)]) + host_bytes
+    return b'\x05' + bytes([cmd]) + b'\x00' + address + struct.pack('!H', target_port)
+
+
+def _read_socks5_reply(sock):
+    """读取完整的SOCKS5应答（包括变长的BND.ADDR），返回 (rep, bind_host, bind_port)"""
+    _, rep, _, address_type = _recv_exact(sock, 4)
+    if address_type == 1:
+        bind_host = socket.inet_ntoa(_recv_exact(sock, 4))
+    elif address_type == 4:
+        bind_host = socket.inet_ntop(socket.AF_INET6, _recv_exact(sock, 16))
+    elif address_type == 3:
+        length = _recv_exact(sock, 1)[0]
+        bind_host = _recv_exact(sock, length).decode('utf-8', errors='ignore')
+    else:
+        raise Exception(f"SOCKS5应答地址类型无效: {address_type}")
+    bind_port = struct.unpack('!H', _recv_exact(sock, 2))[0]
+    return rep, bind_host, bind_port
+
+
+def proxy_handshake(sock, protocol, target_host, target_port):
+    """在已连接到代理的套接字上，按协议请求代理连接到目标"""
+    if protocol == 'socks5':
+        socks5_handshake(sock, target_host, target_port)
+    elif protocol in ['http', 'https']:
+        http_handshake(sock, target_host, target_port)
+    else:
+        raise Exception(f"不支持的代理协议: {protocol}")
+
+
+class TargetUnreachable(Exception):
+    """上游代理正常工作，但目标不可达（不计入上游的健康统计）"""
+
+
+def socks5_handshake(sock, target_host, target_port):
+    """
+    SOCKS5握手：无认证时问候与CONNECT请求合并为一次写入（流水线），
+    每一跳只需一个往返，再依次读取方法应答和连接应答
+    """
+    sock.sendall(b'\x05\x01\x00' + _build_socks5_request(target_host, target_port))
+
+    if _recv_exact(sock, 2) != b'\x05\x00':
+        raise Exception("SOCKS5握手失败")
+
+    rep, _, _ = _read_socks5_reply(sock)
+    if rep in (3, 4, 5):
+        # 网络不可达、主机不可达、连接被拒绝：由目标引起
+        raise TargetUnreachable(f"SOCKS5连接失败，目标不可达，错误码: {rep}")
+    if rep != 0:
+        raise Exception(f"SOCKS5连接失败，错误码: {rep}")
+
+
+def socks5_udp_associate(sock, proxy_host):
+    """
+    在已连接到 SOCKS5 代理的套接字上请求 UDP ASSOCIATE
+    
+    Returns:
+        代理的 UDP 中继地址 (host, port)；代理返回未指定地址时使用代理本身的地址
+    """
+    sock.sendall(b'\x05\x01\x00' + _build_socks5_request('0.0.0.0', 0, cmd=3))
+    if _recv_exact(sock, 2) != b'\x05\x00':
+        raise Exception("SOCKS5握手失败")
+    rep, bind_host, bind_port = _read_socks5_reply(sock)
+    if rep != 0:
+        raise Exception(f"SOCKS5 UDP ASSOCIATE失败，错误码: {rep}")
+    if bind_host in ('0.0.0.0', '::'):
+        bind_host = proxy_host
+    return bind_host, bind_port
+
+
+def http_handshake(sock, target_host, target_port):
+    """HTTP CONNECT握手，只读取到响应头结束，不吞掉隧道内的后续数据"""
+    connect_request = f"CONNECT {target_host}:{target_port} HTTP/1.1\r\n"
+    connect_request += f"Host: {target_host}:{target_port}\r\n"
+    connect_request += "Connection: keep-alive\r\n\r\n"
+
+    sock.sendall(connect_request.encode('utf-8'))
+
+    # 先窥视缓冲区定位响应头结尾，只读走响应头；未找到结尾时缓冲区内全是响应头，可直接读走
+    response = b''
+    while True:
+        peeked = sock.recv(8192, socket.MSG_PEEK)
+        if not peeked:
+            raise Exception("HTTP代理响应不完整")
+        end = (response[-3:] + peeked).find(b'\r\n\r\n')
+        if end != -1:
+            response += _recv_exact(sock, end + 4 - len(response[-3:]))
+            break
+        response += _recv_exact(sock, len(peeked))
+        if len(response) > 8192:
+            raise Exception("HTTP代理响应头过大")
+
+    status_line = response.split(b'\r\n', 1)[0].decode('utf-8', errors='ignore')
+    parts = status_line.split(' ')
+    if len(parts) < 2 or not parts[1].startswith('2'):
+        raise Exception(f"HTTP代理连接失败: {status_line}")
+
+
+def upstream_label(chain):
+    """上游链路的指标标签，如 socks5://1.2.3.4:1080，直连为 direct"""
+    if not chain:
+        return 'direct'
+    return '>'.join(f"{hop['protocol']}://{hop['host']}:{hop['port']}" for hop in chain)
+
+
+def _project_path(path):
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), path)
+
+
+# 分流规则，文件修改后自动重新加载
+RULES = RuleEngine(_project_path(RULES_FILE), _project_path(GEOIP_DATABASE))
+
+
+# HTTP 响应缓存，未启用时为 None
+HTTP_CACHE = httpcache.HTTPCache(
+    HTTP_CACHE_MEMORY_MB * 1024 * 1024, _project_path(HTTP_CACHE_DIR), HTTP_CACHE_DISK_MB * 1024 * 1024
+) if HTTP_CACHE_ENABLED else None
+
+
+# 连接轨迹记录器，未配置 trace_file 时不记录
+TRACE = TraceRecorder(_project_path(TRACE_FILE))
+
+
+def _resolve_ip(host):
+    """按 IP 规则匹配域名时使用的解析（走共享解析缓存）"""
+    return dialer.RESOLVER.resolve(host, 0)[0][4][0]
+
+
+def _on_circuit_transition(label, state):
+    METRICS.inc('peanut_circuit_transitions_total', {'upstream': label, 'state': state})
+    if state == 'open':
+        logging.warning(f"上游 {label} 连接失败，已熔断")
+    elif state == 'closed':
+        logging.info(f"上游 {label} 试探连接成功，恢复使用")
+
+
+# 各上游的熔断器，SOCKS5 和 HTTP 监听端口共用
+BREAKER = CircuitBreaker(CIRCUIT_FAILURE_RATE, CIRCUIT_OPEN_SECONDS, CIRCUIT_SLOW_SECONDS,
+                         on_transition=_on_circuit_transition)
+
+
+def record_upstream_result(label, ok, seconds=None):
+    """报告一次经上游建立连接的结果：计入熔断器和被动健康统计"""
+    BREAKER.record(label, ok, seconds)
+    HEALTH.record_connect(label, ok, seconds)
+
+
+# 各上游当前占用的连接数，SOCKS5 和 HTTP 监听端口共用
+_upstream_active = {}
+_upstream_lock = threading.Lock()
+
+
+def acquire_upstream_slot(chain):
+    """
+    为经过 chain 的一条连接占用名额，已达 MAX_CONNECTIONS_PER_UPSTREAM 时返回 False
+    直连不受此限制
+    """
+    if not chain or not MAX_CONNECTIONS_PER_UPSTREAM:
+        return True
+    label = upstream_label(chain)
+    with _upstream_lock:
+        active = _upstream_active.get(label, 0)
+        if active >= MAX_CONNECTIONS_PER_UPSTREAM:
+            return False
+        _upstream_active[label] = active + 1
+    return True
+
+
+def release_upstream_slot(chain):
+    """释放 acquire_upstream_slot 占用的名额"""
+    if not chain or not MAX_CONNECTIONS_PER_UPSTREAM:
+        return
+    label = upstream_label(chain)
+    with _upstream_lock:
+        active = _upstream_active.get(label, 0) - 1
+        if active > 0:
+            _upstream_active[label] = active
+        else:
+            _upstream_active.pop(label, None)
+
+
+def freeze_chain(hops):
+    """把代理链转为不可变描述（元组 + 只读字典），连接持有的快照不会被并发切换修改"""
+    return tuple(types.MappingProxyType(dict(hop)) for hop in hops or ())
+
+
+def probe_upstream(hops, target=None, timeout=None):
+    """
+    经代理链 hops 连接 target（默认 PROBE_TARGET），验证上游可用
+    
+    Returns:
+        (是否可用, 耗时毫秒或错误信息)
+    """
+    target = target or PROBE_TARGET
+    sock = None
+    start = time.perf_counter()
+    try:
+        sock = dialer.create_connection((hops[0]['host'], hops[0]['port']), timeout=timeout or UPSTREAM_TIMEOUT,
+                                        prepare=SOCKET_OPTIONS.upstream(hops[0]['host'], hops[0]['port']).apply)
+        targets = [(hop['host'], hop['port']) for hop in hops[1:]] + [target]
+        for hop, (next_host, next_port) in zip(hops, targets):
+            proxy_handshake(sock, hop['protocol'], next_host, next_port)
+        return True, round((time.perf_counter() - start) * 1000, 1)
+    except Exception as e:
+        return False, str(e)
+    finally:
+        if sock:
+            try:
+                sock.close()
+            except:
+                pass
+
+
+class _WarmPool:
+    """
+    到上游第一跳的预建连接：切换上游时提前建立TCP连接，
+    新连接直接取用，省去一次到代理的握手往返
+    """
+    
+    def __init__(self):
+        self._sockets = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+    
+    def warm(self, host, port, count=WARM_SOCKETS):
+        """在后台补足到 count 个预建连接"""
+        key = (host, port)
+        with self._lock:
+            need = count - len(self._sockets.get(key, ())) - self._pending.get(key, 0)
+            if need <= 0:
+                return
+            self._pending[key] = self._pending.get(key, 0) + need
+        for _ in range(need):
+            threading.Thread(target=self._dial, args=(key,), daemon=True).start()
+    
+    def _dial(self, key):
+        sock = None
+        try:
+            sock = dialer.create_connection(key, timeout=UPSTREAM_TIMEOUT,
+                                            prepare=SOCKET_OPTIONS.upstream(*key).apply)
+        except Exception:
+            pass
+        with self._lock:
+            self._pending[key] -= 1
+            if sock:
+                self._sockets.setdefault(key, []).append((sock, time.monotonic()))
+    
+    def take(self, host, port):
+        """取出一个仍然有效的预建连接，没有时返回 None"""
+        key = (host, port)
+        while True:
+            with self._lock:
+                sockets = self._sockets.get(key)
+                if not sockets:
+                    return None
+                sock, created_at = sockets.pop()
+            # 过期或已可读（被代理关闭）的连接丢弃
+            try:
+                readable, _, _ = select.select([sock], [], [], 0)
+                if not readable and time.monotonic() - created_at < WARM_TTL:
+                    return sock
+            except Exception:
+                pass
+            try:
+                sock.close()
+            except:
+                pass
+    
+    def discard(self, host, port):
+        """关闭某个代理的全部预建连接"""
+        with self._lock:
+            sockets = self._sockets.pop((host, port), [])
+        for sock, _ in sockets:
+            try:
+                sock.close()
+            except:
+                pass
+
+
+_warm_pool = _WarmPool()
+
+
+def _dial_upstream(host, port):
+    """连接上游代理，优先使用预建连接"""
+    sock = _warm_pool.take(host, port)
+    if sock:
+        sock.settimeout(UPSTREAM_TIMEOUT)
+        return sock
+    return dialer.create_connection((host, port), timeout=UPSTREAM_TIMEOUT,
+                                    prepare=SOCKET_OPTIONS.upstream(host, port).apply)
+
+
+def parse_proxy_address(proxy_address, proxy_protocol='socks5'):
+    """把 "host:port" 解析为上游代理描述字典，格式无效时返回 None"""
+    if not proxy_address or ':' not in proxy_address:
+        return None
+    host, port = proxy_address.rsplit(':', 1)
+    return {
+        'host': host.strip('[]'),
+        'port': int(port),
+        'protocol': (proxy_protocol or 'socks5').lower()
+    }
+
 
 class ProxyServer:
-    def __init__(self, local_host='127.0.0.1', local_port=1800):
+    # 指标中的监听端口名称
+    listener_name = 'socks5'
+    # 超出连接上限时的回复：不接受任何认证方法，客户端收到后立即放弃
+    reject_response = b'\x05\xff'
+    
+    def __init__(self, local_host='127.0.0.1', local_port=1800, backlog=None, reuse_port=False):
         self.local_host = local_host
         self.local_port = local_port
+        self.backlog = backlog or LISTEN_BACKLOG
+        self.reuse_port = reuse_port
         self.server_socket = None
         self.running = False
-        self.upstream_proxy = None
+        # 当前上游：不可变的代理链描述，切换时整体替换引用
+        self._upstream = ()
         self.log_callback = None
-        
+        self.log_batch_callback = None
+        self._log_sink = self._deliver_logs
+        self.max_connections = MAX_CONNECTIONS
+        # 本监听端口接受的客户端连接使用的套接字参数
+        self.socket_profile = SOCKET_OPTIONS.listener(self.listener_name)
+        self.active_connections = 0
+        self._active_lock = threading.Lock()
+        self.affinity_mode = AFFINITY_MODE if AFFINITY_MODE in AFFINITY_MODES else 'off'
+        # 粘性模式使用的上游池：(哈希环, 上游标签 -> 代理链)，整体替换以保证读取一致
+        self._affinity_pool = (HashRing(), {})
+        # 代理池索引：SOCKS5/HTTP 认证用户名为选择条件时从中选择上游
+        self._pool_index = PoolIndex()
+        # 正在转发的隧道：上游标签 -> {(客户端套接字, 远端套接字), ...}，用于排空旧上游
+        self._tunnels = {}
+        self._tunnels_lock = threading.Lock()
+    
+    @property
+    def upstream_chain(self):
+        """当前上游代理链（不可变快照），直连时为空"""
+        return self._upstream
+    
+    @upstream_chain.setter
+    def upstream_chain(self, hops):
+        self._swap_upstream(freeze_chain(hops))
+    
+    @property
+    def upstream_proxy(self):
+        """当前上游代理链的第一跳"""
+        chain = self._upstream
+        return chain[0] if chain else None
+
     def set_upstream_proxy(self, proxy_address, proxy_protocol='socks5'):
         """
         设置上游代理
@@ -41,27 +489,203 @@ class ProxyServer:
             proxy_address: 代理地址，格式为 "host:port"
             proxy_protocol: 代理协议，支持 socks5, http
         """
-        if proxy_address and ':' in proxy_address:
-            host, port = proxy_address.rsplit(':', 1)
-            self.upstream_proxy = {
-                'host': host,
-                'port': int(port),
-                'protocol': proxy_protocol.lower()
-            }
+        proxy = parse_proxy_address(proxy_address, proxy_protocol)
+        if proxy:
+            self._swap_upstream(freeze_chain([proxy]))
             self.log(f"设置上游代理: {proxy_protocol}://{proxy_address}")
         else:
-            self.upstream_proxy = None
+            self._swap_upstream(())
+            self.log("清除上游代理")
+    
+    def set_upstream_chain(self, chain):
+        """
+        设置多层上游代理链，每一跳都通过上一跳建立隧道
+        
+        Args:
+            chain: 代理列表，每项为 (proxy_address, proxy_protocol)，
+                   按 本机 -> 第一跳 -> ... -> 目标 的顺序排列
+        """
+        hops = self._parse_chain(chain)
+        self._swap_upstream(hops)
+        if hops:
+            path = ' -> '.join(f"{h['protocol']}://{h['host']}:{h['port']}" for h in hops)
+            self.log(f"设置代理链({len(hops)}跳): {path}")
+        else:
             self.log("清除上游代理")
     
-    def set_log_callback(self, callback):
-        """设置日志回调函数"""
+    def _parse_chain(self, chain):
+        """把 [(proxy_address, proxy_protocol), ...] 解析为代理链，忽略无效节点"""
+        hops = []
+        for proxy_address, proxy_protocol in chain or []:
+            proxy = parse_proxy_address(proxy_address, proxy_protocol)
+            if not proxy:
+                self.log(f"忽略无效的代理链节点: {proxy_address}")
+                continue
+            hops.append(proxy)
+        
+        if len(hops) > MAX_CHAIN_HOPS:
+            self.log(f"代理链最多支持 {MAX_CHAIN_HOPS} 跳，多余节点已忽略")
+            hops = hops[:MAX_CHAIN_HOPS]
+        return freeze_chain(hops)
+    
+    def _swap_upstream(self, chain):
+        """
+        原子切换上游：新连接立即使用新上游，已建立的连接继续使用各自的快照，
+        旧上游上的连接在后台排空
+        """
+        old, self._upstream = self._upstream, chain
+        if old == chain:
+            return
+        if chain and self.running:
+            _warm_pool.warm(chain[0]['host'], chain[0]['port'])
+        if old:
+            self._start_drain(old)
+    
+    def _upstream_in_use(self, label):
+        """上游是否仍被当前配置使用（当前上游、粘性上游池或代理池索引）"""
+        if label == upstream_label(self._upstream):
+            return True
+        return label in self._affinity_pool[1] or label in self._pool_index.labels
+    
+    def _start_drain(self, chain):
+        label = upstream_label(chain)
+        if self._upstream_in_use(label):
+            return
+        # 第一跳不再被使用时，其预建连接直接关闭
+        first_hops = [hops[0] for hops in (self._upstream, *self._affinity_pool[1].values()) if hops]
+        if chain[0] not in first_hops:
+            _warm_pool.discard(chain[0]['host'], chain[0]['port'])
+        threading.Thread(target=self._drain, args=(label,), daemon=True).start()
+    
+    def _drain(self, label):
+        """等待旧上游上的隧道结束；超过 DRAIN_TIMEOUT 仍未结束的强制关闭"""
+        deadline = time.monotonic() + DRAIN_TIMEOUT if DRAIN_TIMEOUT else None
+        while True:
+            with self._tunnels_lock:
+                tunnels = list(self._tunnels.get(label, ()))
+            if not tunnels:
+                return
+            if self._upstream_in_use(label):
+                # 又切换回了这个上游，无需排空
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                self.log(f"旧上游 {label} 排空超时，关闭剩余 {len(tunnels)} 个连接")
+                for pair in tunnels:
+                    for sock in pair:
+                        try:
+                            sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+                return
+            time.sleep(1)
+    
+    def set_affinity_mode(self, mode):
+        """
+        设置粘性模式
+        
+        Args:
+            mode: off / client / username / domain
+        """
+        if mode not in AFFINITY_MODES:
+            raise ValueError(f"不支持的粘性模式: {mode}")
+        self.affinity_mode = mode
+    
+    def set_upstream_pool(self, chains):
+        """
+        设置粘性模式使用的上游池，连接按粘性键在一致性哈希环上分配到其中一个上游，
+        池变化时只有少部分键改变归属
+        
+        Args:
+            chains: 上游列表，每项为一条代理链 [(proxy_address, proxy_protocol), ...]；
+                    为空时所有连接使用 upstream_chain
+        """
+        pool = {}
+        for chain in chains or []:
+            hops = self._parse_chain(chain)
+            if hops:
+                pool[upstream_label(hops)] = hops
+        old_pool = self._affinity_pool[1]
+        self._affinity_pool = (HashRing(pool), pool)
+        for label, hops in old_pool.items():
+            if label not in pool:
+                self._start_drain(hops)
+        if pool:
+            self.log(f"设置粘性上游池: {len(pool)} 个上游，模式 {self.affinity_mode}")
+    
+    def set_pool_index(self, items):
+        """
+        设置代理池索引：认证用户名为选择条件（如 country-US-minscore-200、session-abc123）时
+        按条件从池中选择上游
+        
+        Args:
+            items: 代理池条目（pool.json 中的字典），只使用状态为"可用"的
+        """
+        self._pool_index = PoolIndex(items, make_chain=self._item_chain)
+    
+    @staticmethod
+    def _item_chain(item):
+        proxy = parse_proxy_address(item.get('address'), item.get('protocol', 'socks5').lower())
+        return freeze_chain([proxy]) if proxy else None
+    
+    def _select_chain(self, client_address=None, target_host=None, username=None):
+        """
+        为一条新连接选择上游链路：先按分流规则决定直连、拒绝或使用代理池中的指定代理，
+        用户名为选择条件时从代理池索引中选择，粘性模式下按哈希环分配，否则使用当前上游；
+        返回 None 表示拒绝该连接
+        """
+        if RULES.enabled and target_host:
+            action, rule_selector = RULES.decide(target_host, _resolve_ip)
+            METRICS.inc('peanut_rule_decisions_total', {'action': action})
+            if action == 'reject':
+                self.log(f"分流规则拒绝: {target_host}", logging.DEBUG)
+                return None
+            if action == 'direct':
+                return ()
+            if action == 'pool' and self._pool_index:
+                chain = self._pool_index.select(rule_selector)
+                if chain is not None:
+                    return chain
+        if username and self._pool_index:
+            selector = parse_selector(username)
+            if selector is not None:
+                chain = self._pool_index.select(selector)
+                if chain is None:
+                    self.log(f"代理池中没有符合条件的代理: {username}", logging.DEBUG)
+                return chain
+        if self.affinity_mode != 'off':
+            ring, pool = self._affinity_pool
+            if pool:
+                key = affinity_key(self.affinity_mode, client_address, username, target_host, AFFINITY_PORT_GROUP)
+                if key is not None:
+                    return pool[ring.get(key)]
+        return self.upstream_chain
+    
+    def set_log_callback(self, callback, batch_callback=None):
+        """
+        设置日志回调函数
+        
+        Args:
+            callback: 逐条回调，签名为 callback(message)
+            batch_callback: 批量回调，签名为 batch_callback(messages)；设置后优先使用
+        """
         self.log_callback = callback
+        self.log_batch_callback = batch_callback
     
-    def log(self, message):
-        """输出日志"""
-        logging.info(message)
-        if self.log_callback:
-            self.log_callback(message)
+    def log(self, message, level=logging.INFO):
+        """
+        输出日志：只放入异步日志队列，由日志线程批量写入 logging 和回调，
+        连接处理线程不会因界面刷新而阻塞
+        """
+        has_callback = self.log_callback or self.log_batch_callback
+        LOG_BUS.emit(level, message, self._log_sink if has_callback else None)
+    
+    def _deliver_logs(self, messages):
+        """日志线程批量投递日志到回调"""
+        if self.log_batch_callback:
+            self.log_batch_callback(messages)
+        elif self.log_callback:
+            for message in messages:
+                self.log_callback(message)
     
     def start(self):
         """启动代理服务器"""
@@ -72,11 +696,17 @@ class ProxyServer:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # 多个工作进程绑定同一端口，由内核分发新连接
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.socket_profile.apply_listener(self.server_socket)
             self.server_socket.bind((self.local_host, self.local_port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.backlog)
             self.running = True
             
             self.log(f"代理服务器启动成功: {self.local_host}:{self.local_port}")
+            if self._upstream:
+                _warm_pool.warm(self._upstream[0]['host'], self._upstream[0]['port'])
             
             # 在新线程中接受连接
             accept_thread = threading.Thread(target=self._accept_connections, daemon=True)
@@ -84,7 +714,7 @@ class ProxyServer:
             
             return True
         except Exception as e:
-            self.log(f"启动代理服务器失败: {e}")
+            self.log(f"启动代理服务器失败: {e}", logging.WARNING)
             return False
     
     def stop(self):
@@ -118,19 +748,70 @@ class ProxyServer:
                     client_socket.close()
                     break
                 
-                self.log(f"新连接: {client_address[0]}:{client_address[1]}")
-                
-                # 为每个连接创建新线程
-                client_thread = threading.Thread(
-                    target=self._handle_client,
-                    args=(client_socket, client_address),
-                    daemon=True
-                )
-                client_thread.start()
+                self._dispatch(client_socket, client_address)
             except Exception as e:
                 if self.running:
-                    self.log(f"接受连接错误: {e}")
+                    self.log(f"接受连接错误: {e}", logging.WARNING)
+    
+    def _dispatch(self, client_socket, client_address):
+        """检查并发上限后为新连接创建处理线程"""
+        self.log(f"新连接: {client_address[0]}:{client_address[1]}", logging.DEBUG)
+        
+        METRICS.inc('peanut_connections_total', {'listener': self.listener_name})
+
+        # 超出并发上限时立即拒绝，不再排队等待
+        with self._active_lock:
+            over_limit = self.max_connections and self.active_connections >= self.max_connections
+            if not over_limit:
+                self.active_connections += 1
+        if over_limit:
+            METRICS.inc('peanut_rejected_connections_total',
+                        {'listener': self.listener_name, 'reason': 'listener_limit'})
+            self.log(f"连接数已达上限 {self.max_connections}，拒绝: {client_address[0]}:{client_address[1]}",
+                     logging.DEBUG)
+            self._reject_client(client_socket)
+            return
+
+        # 为每个连接创建新线程
+        client_thread = threading.Thread(
+            target=self._serve_client,
+            args=(client_socket, client_address),
+            daemon=True
+        )
+        client_thread.start()
     
+    def _serve_client(self, client_socket, client_address):
+        """处理客户端连接并记录活动连接数和连接时长"""
+        labels = {'listener': self.listener_name}
+        METRICS.gauge_add('peanut_active_connections', labels, 1)
+        start = time.perf_counter()
+        try:
+            self.socket_profile.apply(client_socket)
+            self._handle_client(client_socket, client_address)
+        finally:
+            with self._active_lock:
+                self.active_connections -= 1
+            METRICS.gauge_add('peanut_active_connections', labels, -1)
+            METRICS.observe('peanut_connection_duration_seconds', time.perf_counter() - start, labels, DURATION_BUCKETS)
+
+    def _reject_client(self, client_socket):
+        """在接受线程中直接回复拒绝并关闭连接（非阻塞，不占用处理线程）"""
+        try:
+            client_socket.setblocking(False)
+            # 先读掉已到达的数据，避免关闭时内核发送 RST 导致客户端收不到回复
+            try:
+                client_socket.recv(RECV_BUFFER_SIZE)
+            except OSError:
+                pass
+            client_socket.send(self.reject_response)
+        except OSError:
+            pass
+        finally:
+            try:
+                client_socket.close()
+            except:
+                pass
+
     def _handle_client(self, client_socket, client_address):
         """处理客户端请求"""
         try:
@@ -139,11 +820,14 @@ class ProxyServer:
                 client_socket.close()
                 return
             
+            # 握手阶段限时，防止客户端连上后迟迟不发数据占用线程
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            
             # SOCKS5 握手
             version = client_socket.recv(1)
             if not version or version != b'\x05':
                 if self.running:
-                    self.log(f"不支持的SOCKS版本: {client_address}")
+                    self.log(f"不支持的SOCKS版本: {client_address}", logging.WARNING)
                 client_socket.close()
                 return
             
@@ -154,14 +838,23 @@ class ProxyServer:
                 return
             
             nmethods = ord(nmethods_data)
-            methods = client_socket.recv(nmethods)
+            methods = _recv_exact(client_socket, nmethods)
             
             if not self.running:
                 client_socket.close()
                 return
             
-            # 回复：无需认证
-            client_socket.sendall(b'\x05\x00')
+            username = None
+            if 2 in methods and (self.affinity_mode == 'username' or self._pool_index or 0 not in methods):
+                # 用户名/密码认证（RFC 1929），用户名作为选择条件或粘性键，不校验密码
+                client_socket.sendall(b'\x05\x02')
+                username = self._read_socks5_credentials(client_socket)
+                if username is None:
+                    client_socket.close()
+                    return
+            else:
+                # 回复：无需认证
+                client_socket.sendall(b'\x05\x00')
             
             # 读取请求
             request_data = client_socket.recv(4)
@@ -171,7 +864,7 @@ class ProxyServer:
             
             version, cmd, _, address_type = struct.unpack('!BBBB', request_data)
             
-            if cmd != 1:  # 只支持CONNECT命令
+            if cmd not in (1, 3):  # 支持 CONNECT 和 UDP ASSOCIATE
                 client_socket.sendall(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
                 client_socket.close()
                 return
@@ -194,6 +887,12 @@ class ProxyServer:
                     client_socket.close()
                     return
                 address = address_data.decode('utf-8')
+            elif address_type == 4:  # IPv6
+                address_data = client_socket.recv(16)
+                if len(address_data) < 16:
+                    client_socket.close()
+                    return
+                address = socket.inet_ntop(socket.AF_INET6, address_data)
             else:
                 client_socket.sendall(b'\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00')
                 client_socket.close()
@@ -210,213 +909,795 @@ class ProxyServer:
                 client_socket.close()
                 return
             
-            self.log(f"请求连接: {address}:{port}")
+            if cmd == 3:
+                self._handle_udp_associate(client_socket, client_address, address, port, username)
+                return
             
-            # 连接到目标（通过上游代理或直连）
-            if self.upstream_proxy:
-                remote_socket = self._connect_via_proxy(address, port)
-            else:
-                remote_socket = self._connect_direct(address, port)
+            self.log(f"请求连接: {address}:{port}", logging.DEBUG)
             
-            if not remote_socket:
-                client_socket.sendall(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+            # 连接到目标（通过上游代理或直连）
+            chain = self._select_chain(client_address, address, username)
+            if chain is None:
+                # 没有可用的上游，不允许直连
+                client_socket.sendall(b'\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00')
+                client_socket.close()
+                return
+            if not acquire_upstream_slot(chain):
+                self._reject_upstream(chain)
+                client_socket.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
                 client_socket.close()
                 return
             
-            # 回复成功
-            client_socket.sendall(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
-            
-            # 开始转发数据
-            self._forward_data(client_socket, remote_socket)
+            try:
+                started = time.time()
+                remote_socket = self._open_remote(address, port, chain)
+                trace = ('tunnel', address, port, started, time.time() - started) if TRACE.enabled else None
+                
+                if not remote_socket:
+                    if trace:
+                        TRACE.record(self.listener_name, *trace, ok=False)
+                    client_socket.sendall(b'\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00')
+                    client_socket.close()
+                    return
+                
+                # 回复成功
+                client_socket.sendall(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+                
+                # 开始转发数据
+                self._forward_data(client_socket, remote_socket, chain, trace)
+            finally:
+                release_upstream_slot(chain)
             
         except Exception as e:
             if self.running:
-                self.log(f"处理客户端错误: {e}")
+                self.log(f"处理客户端错误: {e}", logging.WARNING)
         finally:
             try:
                 client_socket.close()
             except:
                 pass
     
+    def _handle_udp_associate(self, client_socket, client_address, address, port, username=None):
+        """
+        处理 UDP ASSOCIATE：经单层 SOCKS5 上游的 UDP 中继转发，上游不支持时按配置直连
+        
+        关联在控制连接（当前 TCP 连接）关闭或空闲超过 IDLE_TIMEOUT 时结束。
+        """
+        chain = self._select_chain(client_address, None, username)
+        if chain is None:
+            client_socket.sendall(b'\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00')
+            return
+        
+        control = None
+        relay = None
+        slot_held = False
+        association = None
+        try:
+            if len(chain) == 1 and chain[0]['protocol'] == 'socks5':
+                hop = chain[0]
+                if not acquire_upstream_slot(chain):
+                    self._reject_upstream(chain)
+                    client_socket.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+                    return
+                slot_held = True
+                try:
+                    control = _dial_upstream(hop['host'], hop['port'])
+                    relay_host, relay_port = socks5_udp_associate(control, hop['host'])
+                    relay = (dialer.RESOLVER.resolve(relay_host, relay_port)[0][4][0], relay_port)
+                except Exception as e:
+                    self.log(f"上游 {upstream_label(chain)} 不支持 UDP: {e}", logging.DEBUG)
+                    if control:
+                        control.close()
+                        control = None
+            if chain and relay is None and not UDP_DIRECT_FALLBACK:
+                client_socket.sendall(b'\x05\x02\x00\x01\x00\x00\x00\x00\x00\x00')
+                return
+            
+            bind_host = client_socket.getsockname()[0]
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                udp_socket.bind((bind_host, 0))
+            except OSError:
+                udp_socket.close()
+                raise
+            decide = None
+            if RULES.enabled:
+                decide = lambda host: RULES.decide(host)[0]
+            association = UDPAssociation(udp_socket, client_address[0], port or None, relay, decide)
+            UDP_RELAY.register(association)
+            self.log(f"UDP关联: {client_address[0]} 经 {upstream_label(chain) if relay else 'direct'}", logging.DEBUG)
+            
+            client_socket.sendall(b'\x05\x00\x00\x01' + socket.inet_aton(bind_host)
+                                  + struct.pack('!H', udp_socket.getsockname()[1]))
+            
+            # 保持控制连接，客户端或上游关闭时结束关联
+            watched = [client_socket] + ([control] if control else [])
+            while self.running:
+                readable, _, _ = select.select(watched, [], [], 1)
+                if any(not sock.recv(4096) for sock in readable):
+                    break
+                if IDLE_TIMEOUT and time.monotonic() - association.last_active >= IDLE_TIMEOUT:
+                    self.log("UDP关联空闲超时，断开", logging.DEBUG)
+                    break
+        finally:
+            if association:
+                UDP_RELAY.unregister(association)
+            if control:
+                try:
+                    control.close()
+                except OSError:
+                    pass
+            if slot_held:
+                release_upstream_slot(chain)
+    
+    def _read_socks5_credentials(self, client_socket):
+        """读取 RFC 1929 用户名/密码子协商并回复成功，格式错误时返回 None"""
+        version, username_length = _recv_exact(client_socket, 2)
+        if version != 1:
+            return None
+        username = _recv_exact(client_socket, username_length).decode('utf-8', errors='replace')
+        password_length = _recv_exact(client_socket, 1)[0]
+        _recv_exact(client_socket, password_length)
+        client_socket.sendall(b'\x01\x00')
+        return username
+    
+    def _reject_upstream(self, chain):
+        """记录因上游并发已满被拒绝的连接"""
+        label = upstream_label(chain)
+        METRICS.inc('peanut_rejected_connections_total',
+                    {'listener': self.listener_name, 'reason': 'upstream_limit'})
+        self.log(f"上游 {label} 并发连接数已达上限 {MAX_CONNECTIONS_PER_UPSTREAM}，拒绝新连接", logging.DEBUG)
+    
+    def _open_remote(self, address, port, chain=None):
+        """
+        按配置连接目标：多层代理链、单层上游代理或直连，并记录连接耗时和结果
+        
+        Args:
+            chain: 本次连接使用的上游链路快照，None 表示使用当前配置
+        """
+        if chain is None:
+            chain = self.upstream_chain
+        
+        labels = {'upstream': upstream_label(chain)}
+        if chain and not BREAKER.allow(labels['upstream']):
+            # 熔断中的上游直接失败，不再等待连接超时
+            METRICS.inc('peanut_upstream_connects_total', {**labels, 'result': 'circuit_open'})
+            self.log(f"上游 {labels['upstream']} 已熔断，拒绝连接 {address}:{port}", logging.DEBUG)
+            return None
+        
+        start = time.perf_counter()
+        if len(chain) > 1:
+            sock = self._connect_via_chain(chain, address, port)
+        elif chain:
+            sock = self._connect_via_proxy(address, port, chain[0])
+        else:
+            sock = self._connect_direct(address, port)
+        
+        METRICS.inc('peanut_upstream_connects_total', {**labels, 'result': 'success' if sock else 'failure'})
+        if sock:
+            METRICS.observe('peanut_upstream_connect_seconds', time.perf_counter() - start, labels)
+        return sock
+    
     def _connect_direct(self, address, port):
         """直接连接到目标"""
         try:
-            remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            remote_socket.connect((address, port))
+            remote_socket = dialer.create_connection((address, port), timeout=UPSTREAM_TIMEOUT,
+                                                     prepare=SOCKET_OPTIONS.direct.apply)
+            remote_socket.settimeout(None)
             return remote_socket
         except Exception as e:
-            self.log(f"直连失败 {address}:{port} - {e}")
+            self.log(f"直连失败 {address}:{port} - {e}", logging.WARNING)
             return None
     
-    def _connect_via_proxy(self, address, port):
+    def _connect_via_proxy(self, address, port, proxy=None):
         """通过上游代理连接"""
         try:
-            proxy = self.upstream_proxy
+            proxy = proxy or self.upstream_proxy
+            label = upstream_label([proxy])
             
             if proxy['protocol'] == 'socks5':
-                return self._connect_via_socks5(address, port, proxy['host'], proxy['port'])
+                return self._connect_via_socks5(address, port, proxy['host'], proxy['port'], label)
             elif proxy['protocol'] in ['http', 'https']:
-                return self._connect_via_http(address, port, proxy['host'], proxy['port'])
+                return self._connect_via_http(address, port, proxy['host'], proxy['port'], label)
             else:
-                self.log(f"不支持的代理协议: {proxy['protocol']}")
+                self.log(f"不支持的代理协议: {proxy['protocol']}", logging.WARNING)
                 return None
         except Exception as e:
-            self.log(f"通过代理连接失败: {e}")
+            self.log(f"通过代理连接失败: {e}", logging.WARNING)
             return None
     
-    def _connect_via_socks5(self, target_host, target_port, proxy_host, proxy_port):
-        """通过SOCKS5代理连接"""
+    def _connect_via_chain(self, chain, address, port):
+        """
+        通过多层代理链连接：先连接第一跳，再依次在已建立的隧道内
+        向下一跳发起握手，最后一跳连接真正的目标
+        """
+        sock = None
         try:
             if not self.running:
                 return None
             
-            # 连接到SOCKS5代理
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(10)
-            sock.connect((proxy_host, proxy_port))
-            
-            # SOCKS5握手
-            sock.sendall(b'\x05\x01\x00')
-            response = sock.recv(2)
-            if not response or len(response) < 2 or response != b'\x05\x00':
-                raise Exception("SOCKS5握手失败")
-            
-            # 发送连接请求
-            if target_host.replace('.', '').isdigit():  # IP地址
-                request = b'\x05\x01\x00\x01' + socket.inet_aton(target_host)
-            else:  # 域名
-                request = b'\x05\x01\x00\x03' + bytes([len(target_host)]) + target_host.encode('utf-8')
-            
-            request += struct.pack('!H', target_port)
-            sock.sendall(request)
-            
-            # 读取响应
-            response = sock.recv(10)
-            if not response or len(response) < 2:
-                raise Exception("SOCKS5响应不完整")
+            start = time.perf_counter()
+            first = chain[0]
+            sock = _dial_upstream(first['host'], first['port'])
             
-            if response[1] != 0:
-                raise Exception(f"SOCKS5连接失败，错误码: {response[1]}")
+            # 每一跳的目标是下一跳代理，最后一跳的目标是真实地址
+            targets = [(hop['host'], hop['port']) for hop in chain[1:]] + [(address, port)]
+            for hop, (next_host, next_port) in zip(chain, targets):
+                proxy_handshake(sock, hop['protocol'], next_host, next_port)
             
+            sock.settimeout(None)
+            # 多层链路不对应代理池中的单个代理，只计入熔断器
+            BREAKER.record(upstream_label(chain), True, time.perf_counter() - start)
             if self.running:
-                self.log(f"通过SOCKS5代理连接成功: {target_host}:{target_port}")
+                self.log(f"通过代理链({len(chain)}跳)连接成功: {address}:{port}", logging.DEBUG)
             return sock
         except Exception as e:
+            if sock:
+                try:
+                    sock.close()
+                except:
+                    pass
+            if not isinstance(e, TargetUnreachable):
+                BREAKER.record(upstream_label(chain), False)
             if self.running:
-                self.log(f"SOCKS5代理连接失败: {e}")
+                self.log(f"代理链连接失败: {e}", logging.WARNING)
             return None
     
-    def _connect_via_http(self, target_host, target_port, proxy_host, proxy_port):
-        """通过HTTP代理连接"""
+    def _connect_via_socks5(self, target_host, target_port, proxy_host, proxy_port, label=None):
+        """通过SOCKS5代理连接，结果和握手耗时报告给 label 对应上游的熔断器和健康统计"""
+        sock = None
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((proxy_host, proxy_port))
-            
-            # 发送CONNECT请求
-            connect_request = f"CONNECT {target_host}:{target_port} HTTP/1.1\r\n"
-            connect_request += f"Host: {target_host}:{target_port}\r\n"
-            connect_request += "Connection: keep-alive\r\n\r\n"
+            if not self.running:
+                return None
             
-            sock.sendall(connect_request.encode('utf-8'))
+            # 连接到SOCKS5代理
+            start = time.perf_counter()
+            sock = _dial_upstream(proxy_host, proxy_port)
+            socks5_handshake(sock, target_host, target_port)
+            sock.settimeout(None)
+            if label:
+                record_upstream_result(label, True, time.perf_counter() - start)
             
-            # 读取响应
-            response = sock.recv(4096).decode('utf-8')
-            if '200' not in response.split('\r\n')[0]:
-                raise Exception("HTTP代理连接失败")
+            if self.running:
+                self.log(f"通过SOCKS5代理连接成功: {target_host}:{target_port}", logging.DEBUG)
+            return sock
+        except Exception as e:
+            if sock:
+                try:
+                    sock.close()
+                except:
+                    pass
+            if label and not isinstance(e, TargetUnreachable):
+                record_upstream_result(label, False)
+            if self.running:
+                self.log(f"SOCKS5代理连接失败: {e}", logging.WARNING)
+            return None
+    
+    def _connect_via_http(self, target_host, target_port, proxy_host, proxy_port, label=None):
+        """通过HTTP代理连接，结果和握手耗时报告给 label 对应上游的熔断器和健康统计"""
+        sock = None
+        try:
+            start = time.perf_counter()
+            sock = _dial_upstream(proxy_host, proxy_port)
+            http_handshake(sock, target_host, target_port)
+            sock.settimeout(None)
+            if label:
+                record_upstream_result(label, True, time.perf_counter() - start)
             
-            self.log(f"通过HTTP代理连接成功: {target_host}:{target_port}")
+            self.log(f"通过HTTP代理连接成功: {target_host}:{target_port}", logging.DEBUG)
             return sock
         except Exception as e:
-            self.log(f"HTTP代理连接失败: {e}")
+            if sock:
+                try:
+                    sock.close()
+                except:
+                    pass
+            if label:
+                record_upstream_result(label, False)
+            self.log(f"HTTP代理连接失败: {e}", logging.WARNING)
             return None
     
-    def _forward_data(self, client_socket, remote_socket):
-        """双向转发数据"""
+    def _forward_data(self, client_socket, remote_socket, chain=None, trace=None):
+        """
+        双向转发数据，按上游累计转发字节数（本地累加，每秒批量写入指标）
+        
+        一方关闭写端（EOF）时只向另一方传递半关闭，继续转发反方向的数据，
+        两个方向都结束、空闲超过 IDLE_TIMEOUT 或存活超过 MAX_LIFETIME 时断开
+        
+        trace 为 (类型, 目标主机, 端口, 开始时间, 建立连接耗时) 时，隧道结束后写入连接轨迹
+        """
+        chain = self.upstream_chain if chain is None else chain
+        labels = {'upstream': upstream_label(chain)}
+        # 单层上游的下行吞吐量计入被动健康统计
+        health_key = labels['upstream'] if len(chain) == 1 else None
+        up_labels = {**labels, 'direction': 'up'}
+        down_labels = {**labels, 'direction': 'down'}
+        bytes_up = bytes_down = 0
+        # 已写入指标的字节数，结束时与未写入的部分合计为隧道的总流量
+        flushed_up = flushed_down = 0
+        started = last_flush = last_active = time.monotonic()
+        METRICS.gauge_add('peanut_upstream_active_tunnels', labels, 1)
+        tunnel = (client_socket, remote_socket)
+        with self._tunnels_lock:
+            self._tunnels.setdefault(labels['upstream'], set()).add(tunnel)
         try:
+            # 对端不读取时 sendall 会阻塞（自然形成背压），超时后放弃该隧道
+            client_socket.settimeout(IDLE_TIMEOUT or None)
+            remote_socket.settimeout(IDLE_TIMEOUT or None)
             sockets = [client_socket, remote_socket]
-            while True:
+            while sockets:
                 readable, _, _ = select.select(sockets, [], [], 1)
                 
+                now = time.monotonic()
+                if now - last_flush >= 1:
+                    if health_key and bytes_down >= MIN_THROUGHPUT_BYTES:
+                        HEALTH.record_throughput(health_key, bytes_down / (now - last_flush))
+                    METRICS.inc('peanut_upstream_bytes_total', up_labels, bytes_up)
+                    METRICS.inc('peanut_upstream_bytes_total', down_labels, bytes_down)
+                    flushed_up += bytes_up
+                    flushed_down += bytes_down
+                    bytes_up = bytes_down = 0
+                    last_flush = now
+                
+                if MAX_LIFETIME and now - started >= MAX_LIFETIME:
+                    self.log(f"隧道超过最长存活时间 {MAX_LIFETIME} 秒，断开", logging.DEBUG)
+                    return
+                
                 if not readable:
+                    if IDLE_TIMEOUT and now - last_active >= IDLE_TIMEOUT:
+                        self.log(f"隧道空闲超过 {IDLE_TIMEOUT} 秒，断开", logging.DEBUG)
+                        return
                     continue
                 
+                last_active = now
                 for sock in readable:
+                    peer = remote_socket if sock is client_socket else client_socket
                     try:
                         data = sock.recv(4096)
                         if not data:
-                            return
+                            # 半关闭：把 EOF 传给对端，另一个方向继续转发
+                            sockets.remove(sock)
+                            peer.shutdown(socket.SHUT_WR)
+                            continue
                         
+                        peer.sendall(data)
                         if sock is client_socket:
-                            remote_socket.sendall(data)
+                            bytes_up += len(data)
                         else:
-                            client_socket.sendall(data)
+                            bytes_down += len(data)
                     except:
                         return
         except Exception as e:
-            self.log(f"数据转发错误: {e}")
+            self.log(f"数据转发错误: {e}", logging.WARNING)
         finally:
+            with self._tunnels_lock:
+                tunnels = self._tunnels.get(labels['upstream'])
+                tunnels.discard(tunnel)
+                if not tunnels:
+                    del self._tunnels[labels['upstream']]
+            METRICS.gauge_add('peanut_upstream_active_tunnels', labels, -1)
+            METRICS.inc('peanut_upstream_bytes_total', up_labels, bytes_up)
+            METRICS.inc('peanut_upstream_bytes_total', down_labels, bytes_down)
+            if trace:
+                TRACE.record(self.listener_name, *trace, up=flushed_up + bytes_up, down=flushed_down + bytes_down)
             try:
                 remote_socket.close()
             except:
                 pass
 
 
-class HTTPProxyServer(ProxyServer):
+# HTTP 逐跳头部，转发时不透传
+HOP_BY_HOP_HEADERS = {
+    'connection', 'proxy-connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+# 单个请求/响应头的最大长度
+MAX_HEADER_SIZE = 32768
+# 请求行最大长度
+MAX_REQUEST_LINE = 8192
+# 头部最大数量
+MAX_HEADER_COUNT = 100
+# 转发报文时的接收缓冲区大小
+RECV_BUFFER_SIZE = 65536
+# 客户端长连接两次请求之间的空闲超时（秒）
+KEEPALIVE_TIMEOUT = 60
+# 空闲上游连接的最长保留时间（秒）
+IDLE_TUNNEL_TIMEOUT = 30
+# 每个源站最多保留的空闲上游连接数
+MAX_IDLE_TUNNELS_PER_ORIGIN = 4
+
+
+class _HeaderTooLarge(Exception):
+    """报文头超出长度或数量限制"""
+
+
+class _BadRequest(Exception):
+    """报文头格式错误：无效的头部行、CONNECT 端口或 Content-Length"""
+
+
+class _HTTPConnection:
+    """
+    带读缓冲的套接字包装，用于按 HTTP 报文边界读取和转发数据
+    
+    接收使用预分配的缓冲区（recv_into），报文头结尾从上次扫描的位置继续查找，
+    报文体直接以 memoryview 转发，避免重复拼接和拷贝。
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        # 经 relay_* 转发出去的字节数
+        self.relayed = 0
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+    
+    def _recv(self):
+        """接收一次数据到预分配缓冲区，返回接收到的字节数"""
+        return self.sock.recv_into(self._recv_view)
+    
+    def _fill(self):
+        size = self._recv()
+        if not size:
+            return False
+        self.buffer += self._recv_view[:size]
+        return True
+    
+    def read_head(self, max_size=MAX_HEADER_SIZE):
+        """
+        读取一个完整的报文头（到空行为止），每次只扫描新到达的数据
+        
+        Args:
+            max_size: 报文头最大长度，超出时抛出 _HeaderTooLarge
+        
+        Returns:
+            报文头字节串；在报文开始前连接被正常关闭时返回 None
+        """
+        scanned = 0
+        while True:
+            # 空行可能跨越两次接收，回退3个字节继续查找
+            end = self.buffer.find(b'\r\n\r\n', max(scanned - 3, 0))
+            if end != -1:
+                if end + 4 > max_size:
+                    raise _HeaderTooLarge("报文头过大")
+                head = bytes(self.buffer[:end + 4])
+                del self.buffer[:end + 4]
+                return head
+            scanned = len(self.buffer)
+            if scanned > max_size:
+                raise _HeaderTooLarge("报文头过大")
+            if not self._fill():
+                if self.buffer:
+                    raise Exception("报文头不完整")
+                return None
+    
+    def read_line(self):
+        """读取一行（含CRLF），用于chunked编码"""
+        scanned = 0
+        while True:
+            end = self.buffer.find(b'\r\n', max(scanned - 1, 0))
+            if end != -1:
+                line = bytes(self.buffer[:end + 2])
+                del self.buffer[:end + 2]
+                return line
+            scanned = len(self.buffer)
+            if scanned > MAX_HEADER_SIZE:
+                raise Exception("chunk 行过长")
+            if not self._fill():
+                raise Exception("连接被提前关闭")
+    
+    def relay_exact(self, length, dest):
+        """把接下来的 length 字节原样转发到 dest"""
+        if self.buffer and length > 0:
+            size = min(length, len(self.buffer))
+            dest.sendall(memoryview(self.buffer)[:size])
+            del self.buffer[:size]
+            length -= size
+            self.relayed += size
+        # 缓冲区已取空，剩余数据直接从接收缓冲区转发
+        while length > 0:
+            size = self._recv()
+            if not size:
+                raise Exception("连接被提前关闭")
+            if size > length:
+                # 多读到的数据属于下一个报文，留在缓冲区
+                dest.sendall(self._recv_view[:length])
+                self.buffer += self._recv_view[length:size]
+                self.relayed += length
+                return
+            dest.sendall(self._recv_view[:size])
+            length -= size
+            self.relayed += size
+    
+    def relay_chunked(self, dest):
+        """转发一个 chunked 编码的报文体（包括结尾的 trailer）"""
+        while True:
+            line = self.read_line()
+            dest.sendall(line)
+            self.relayed += len(line)
+            size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                break
+            self.relay_exact(size + 2, dest)
+        while True:
+            line = self.read_line()
+            dest.sendall(line)
+            self.relayed += len(line)
+            if line == b'\r\n':
+                return
+    
+    def relay_until_close(self, dest):
+        """转发数据直到对端关闭连接"""
+        if self.buffer:
+            dest.sendall(self.buffer)
+            self.relayed += len(self.buffer)
+            self.buffer.clear()
+        while True:
+            size = self._recv()
+            if not size:
+                return
+            dest.sendall(self._recv_view[:size])
+            self.relayed += size
+
+
+def _parse_http_head(head):
+    """
+    解析报文头，只在字节层面切分，逐行按 latin-1 解码
+    
+    Returns:
+        (起始行各部分列表, [(头部名, 值), ...])
+    """
+    lines = head.split(b'\r\n')
+    if len(lines[0]) > MAX_REQUEST_LINE:
+        raise _HeaderTooLarge("请求行过长")
+    start_line = lines[0].decode('latin-1').split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(b':')
+        if not sep:
+            raise _BadRequest(f"无效的头部行: {line[:64]!r}")
+        headers.append((name.strip().decode('latin-1'), value.strip().decode('latin-1')))
+        if len(headers) > MAX_HEADER_COUNT:
+            raise _HeaderTooLarge("头部数量过多")
+    return start_line, headers
+
+
+def _header_value(headers, name):
+    """获取头部值（不区分大小写），多个同名头部用逗号合并"""
+    name = name.lower()
+    values = [value for key, value in headers if key.lower() == name]
+    return ', '.join(values) if values else None
+
+
+def _header_tokens(headers, name):
+    value = _header_value(headers, name)
+    if not value:
+        return set()
+    return {token.strip().lower() for token in value.split(',') if token.strip()}
+
+
+def _is_persistent(version, headers):
+    """根据协议版本和 Connection 头判断连接是否保持"""
+    tokens = _header_tokens(headers, 'connection') | _header_tokens(headers, 'proxy-connection')
+    if version == 'HTTP/1.0':
+        return 'keep-alive' in tokens
+    return 'close' not in tokens
+
+
+def _body_framing(headers):
+    """
+    判断报文体的分帧方式
+    
+    Returns:
+        ('chunked', None) / ('length', n) / ('none', None)
+    """
+    if 'chunked' in _header_tokens(headers, 'transfer-encoding'):
+        return 'chunked', None
+    length = _header_value(headers, 'content-length')
+    if length is not None:
+        length = length.split(',')[0].strip()
+        if not length.isdigit():
+            raise _BadRequest(f"无效的 Content-Length: {length[:32]!r}")
+        return 'length', int(length)
+    return 'none', None
+
+
+def _check_request(start_line, headers):
+    """
+    检查请求头中转发前必须有效的部分：CONNECT 目标端口和 Content-Length
+    
+    Raises:
+        _BadRequest: 格式错误
+    """
+    if len(start_line) >= 3 and start_line[0] == 'CONNECT' and ':' in start_line[1]:
+        port = start_line[1].rsplit(':', 1)[1]
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise _BadRequest(f"无效的 CONNECT 端口: {port[:16]!r}")
+    _body_framing(headers)
+
+
+def _proxy_username(headers):
+    """从 Proxy-Authorization: Basic 中取出用户名，没有时返回 None"""
+    value = _header_value(headers, 'proxy-authorization')
+    if not value or value[:6].lower() != 'basic ':
+        return None
+    try:
+        return base64.b64decode(value[6:].strip()).decode('utf-8', errors='replace').split(':', 1)[0]
+    except Exception:
+        return None
+
+
+def _build_http_head(start_line, headers, connection):
+    """重新组装报文头：去掉逐跳头部，保留分帧所需的 Transfer-Encoding，并写入 Connection"""
+    extra_hop = _header_tokens(headers, 'connection')
+    lines = [start_line]
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'transfer-encoding':
+            lines.append(f"{name}: {value}")
+            continue
+        if lower in HOP_BY_HOP_HEADERS or lower in extra_hop:
+            continue
+        lines.append(f"{name}: {value}")
+    lines.append(f"Connection: {connection}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class HTTPProxyServer(ProxyServer):
     """HTTP代理服务器"""
     
+    listener_name = 'http'
+    reject_response = (
+        b'HTTP/1.1 503 Service Unavailable\r\n'
+        b'Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+    )
+    # 没有可用上游（不允许直连）时的回复
+    forbidden_response = b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+    
+    def __init__(self, local_host='127.0.0.1', local_port=1800, backlog=None, reuse_port=False):
+        super().__init__(local_host, local_port, backlog, reuse_port)
+        # 空闲上游连接池：(上游链路, 主机, 端口) -> [(socket, 放回时间), ...]
+        self._idle_tunnels = {}
+        self._idle_lock = threading.Lock()
+    
+    def set_upstream_chain(self, chain):
+        super().set_upstream_chain(chain)
+        # 切换上游后旧的空闲连接不再复用
+        self._clear_idle_tunnels()
+    
+    def set_upstream_proxy(self, proxy_address, proxy_protocol='socks5'):
+        super().set_upstream_proxy(proxy_address, proxy_protocol)
+        # 切换上游后旧的空闲连接不再复用
+        self._clear_idle_tunnels()
+    
+    def stop(self):
+        super().stop()
+        self._clear_idle_tunnels()
+    
+    def _upstream_key(self, chain=None):
+        if chain is None:
+            chain = self.upstream_chain
+        return tuple((hop['protocol'], hop['host'], hop['port']) for hop in chain)
+    
+    def set_upstream_pool(self, chains):
+        super().set_upstream_pool(chains)
+        # 上游池变化后，不在池中的空闲连接不再复用
+        self._clear_idle_tunnels()
+    
+    def _is_current_upstream(self, upstream_key):
+        """上游是否仍在使用中（当前上游或粘性上游池中的一个）"""
+        if upstream_key == self._upstream_key():
+            return True
+        _, pool = self._affinity_pool
+        return any(upstream_key == self._upstream_key(chain) for chain in pool.values())
+    
+    def _clear_idle_tunnels(self):
+        with self._idle_lock:
+            idle = self._idle_tunnels
+            self._idle_tunnels = {}
+        for tunnels in idle.values():
+            for sock, _ in tunnels:
+                try:
+                    sock.close()
+                except:
+                    pass
+    
+    def _checkout_tunnel(self, address, port, upstream_key):
+        """取出一个可复用的空闲上游连接，没有时返回 None"""
+        key = (upstream_key, address, port)
+        while True:
+            with self._idle_lock:
+                tunnels = self._idle_tunnels.get(key)
+                if not tunnels:
+                    return None
+                sock, released_at = tunnels.pop()
+            # 过期或已可读（对端关闭或有多余数据）的连接直接丢弃
+            try:
+                readable, _, _ = select.select([sock], [], [], 0)
+                if not readable and time.time() - released_at < IDLE_TUNNEL_TIMEOUT:
+                    return sock
+            except Exception:
+                pass
+            try:
+                sock.close()
+            except:
+                pass
+    
+    def _release_tunnel(self, address, port, sock, upstream_key):
+        """把完成一次请求的上游连接放回空闲池"""
+        key = (upstream_key, address, port)
+        with self._idle_lock:
+            if self.running and self._is_current_upstream(upstream_key):
+                tunnels = self._idle_tunnels.setdefault(key, [])
+                if len(tunnels) < MAX_IDLE_TUNNELS_PER_ORIGIN:
+                    tunnels.append((sock, time.time()))
+                    return
+        try:
+            sock.close()
+        except:
+            pass
+    
     def _handle_client(self, client_socket, client_address):
-        """处理HTTP代理请求"""
+        """处理HTTP代理请求，同一客户端连接上可以连续处理多个请求（长连接/流水线）"""
         try:
             if not self.running:
                 client_socket.close()
                 return
             
-            # 读取HTTP请求
-            request_data = b''
-            while b'\r\n\r\n' not in request_data:
-                chunk = client_socket.recv(4096)
-                if not chunk:
-                    client_socket.close()
+            client = _HTTPConnection(client_socket)
+            # 流水线请求会留在读缓冲中，按顺序逐个处理
+            while self.running:
+                client_socket.settimeout(KEEPALIVE_TIMEOUT)
+                try:
+                    head = client.read_head()
+                    if head is None:
+                        return
+                    start_line, headers = _parse_http_head(head)
+                    _check_request(start_line, headers)
+                except socket.timeout:
                     return
-                request_data += chunk
-                if len(request_data) > 8192:  # 防止请求过大
-                    break
-            
-            request_str = request_data.decode('utf-8', errors='ignore')
-            lines = request_str.split('\r\n')
-            
-            if not lines:
-                client_socket.close()
-                return
-            
-            # 解析请求行
-            request_line = lines[0]
-            parts = request_line.split(' ')
-            
-            if len(parts) < 2:
-                client_socket.close()
-                return
-            
-            method = parts[0]
-            url = parts[1]
-            
-            # 处理CONNECT方法（HTTPS）
-            if method == 'CONNECT':
-                self._handle_connect(client_socket, url)
-            else:
+                except _HeaderTooLarge as e:
+                    self.log(f"拒绝请求 {client_address[0]}:{client_address[1]} - {e}", logging.WARNING)
+                    client_socket.sendall(
+                        b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+                        b'Content-Length: 0\r\nConnection: close\r\n\r\n'
+                    )
+                    return
+                except _BadRequest as e:
+                    self.log(f"拒绝请求 {client_address[0]}:{client_address[1]} - {e}", logging.WARNING)
+                    client_socket.sendall(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                    return
+                # 转发请求/响应体时对端长时间不读写视为空闲
+                client_socket.settimeout(IDLE_TIMEOUT or None)
+                
+                if len(start_line) < 3:
+                    client_socket.sendall(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+                    return
+                
+                method, url, version = start_line
+                
+                # 处理CONNECT方法（HTTPS）
+                if method == 'CONNECT':
+                    initial_data = bytes(client.buffer)
+                    client.buffer.clear()
+                    self._handle_connect(client_socket, url, initial_data, client_address, _proxy_username(headers))
+                    return
+                
                 # 处理普通HTTP请求
-                self._handle_http(client_socket, request_data, url)
+                if not self._handle_http(client, method, url, version, headers, client_address):
+                    return
                 
         except Exception as e:
             if self.running:
-                self.log(f"HTTP代理处理错误: {e}")
+                self.log(f"HTTP代理处理错误: {e}", logging.WARNING)
         finally:
             try:
                 client_socket.close()
             except:
                 pass
     
-    def _handle_connect(self, client_socket, url):
+    def _handle_connect(self, client_socket, url, initial_data=b'', client_address=None, username=None):
         """处理CONNECT请求（用于HTTPS）"""
         try:
             # 解析目标地址
@@ -431,91 +1712,690 @@ class HTTPProxyServer(ProxyServer):
                 client_socket.close()
                 return
             
-            self.log(f"HTTP CONNECT: {address}:{port}")
+            self.log(f"HTTP CONNECT: {address}:{port}", logging.DEBUG)
             
             # 连接到目标
-            if self.upstream_proxy:
-                remote_socket = self._connect_via_proxy(address, port)
-            else:
-                remote_socket = self._connect_direct(address, port)
-            
-            if not remote_socket:
-                client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
+            chain = self._select_chain(client_address, address, username)
+            if chain is None:
+                client_socket.sendall(self.forbidden_response)
+                client_socket.close()
+                return
+            if not acquire_upstream_slot(chain):
+                self._reject_upstream(chain)
+                client_socket.sendall(self.reject_response)
                 client_socket.close()
                 return
             
-            # 回复连接成功
-            client_socket.sendall(b'HTTP/1.1 200 Connection Established\r\n\r\n')
-            
-            # 开始转发数据
-            self._forward_data(client_socket, remote_socket)
+            try:
+                started = time.time()
+                remote_socket = self._open_remote(address, port, chain)
+                trace = ('tunnel', address, port, started, time.time() - started) if TRACE.enabled else None
+                
+                if not remote_socket:
+                    if trace:
+                        TRACE.record(self.listener_name, *trace, ok=False)
+                    client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
+                    client_socket.close()
+                    return
+                
+                # 回复连接成功
+                client_socket.sendall(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                
+                # 客户端紧跟在CONNECT之后发送的数据（如TLS ClientHello）
+                if initial_data:
+                    remote_socket.sendall(initial_data)
+                
+                # 开始转发数据
+                self._forward_data(client_socket, remote_socket, chain, trace)
+            finally:
+                release_upstream_slot(chain)
             
         except Exception as e:
             if self.running:
-                self.log(f"CONNECT处理错误: {e}")
+                self.log(f"CONNECT处理错误: {e}", logging.WARNING)
+    
+    def _send_cached(self, client_socket, entry, request_headers, client_persistent):
+        """
+        用缓存条目回复客户端；客户端的 If-None-Match 与条目的 ETag 相同时只回复 304
+        
+        Returns:
+            客户端连接是否可以继续处理下一个请求
+        """
+        connection = 'keep-alive' if client_persistent else 'close'
+        headers = entry.response_headers()
+        etag = entry.etag
+        if etag and etag.lower() in (_header_tokens(request_headers, 'if-none-match') | {'*'}):
+            keep = {'etag', 'cache-control', 'expires', 'date', 'last-modified', 'vary', 'age'}
+            headers = [(name, value) for name, value in headers if name.lower() in keep]
+            client_socket.sendall(_build_http_head('HTTP/1.1 304 Not Modified', headers, connection))
+        else:
+            client_socket.sendall(_build_http_head(entry.status_line, headers, connection) + entry.body)
+        return client_persistent
     
-    def _handle_http(self, client_socket, request_data, url):
-        """处理普通HTTP请求"""
+    def _handle_http(self, client, method, url, version, headers, client_address=None):
+        """
+        处理一个普通HTTP请求
+        
+        Returns:
+            客户端连接是否可以继续处理下一个请求
+        """
+        client_socket = client.sock
+        remote_socket = None
+        remote = None
+        chain = None
+        slot_held = False
+        reusable = False
+        response_started = False
+        # 本次请求的转发字节数（报文头 + 报文体）
+        client_mark = client.relayed
+        head_bytes_up = head_bytes_down = 0
+        # 连接轨迹：请求开始时间和建立上游连接的耗时
+        started = time.time()
+        connect_seconds = 0.0
         try:
             # 解析URL获取主机和端口
             if url.startswith('http://'):
                 url = url[7:]
-            
-            if '/' in url:
-                host_port, path = url.split('/', 1)
-                path = '/' + path
+                if '/' in url:
+                    host_port, path = url.split('/', 1)
+                    path = '/' + path
+                else:
+                    host_port = url
+                    path = '/'
             else:
-                host_port = url
-                path = '/'
+                # 非代理形式的请求，从Host头获取目标
+                host_port = _header_value(headers, 'host') or ''
+                path = url
+            
+            if not host_port:
+                client_socket.sendall(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+                return False
             
-            if ':' in host_port:
+            if ':' in host_port and not host_port.endswith(']'):
                 address, port = host_port.rsplit(':', 1)
+                if not port.isdigit():
+                    client_socket.sendall(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+                    return False
                 port = int(port)
             else:
                 address = host_port
                 port = 80
+            address = address.strip('[]')
             
             if not self.running:
-                client_socket.close()
-                return
+                return False
             
-            self.log(f"HTTP请求: {address}:{port}{path}")
+            self.log(f"HTTP请求: {address}:{port}{path}", logging.DEBUG)
             
-            # 连接到目标
-            if self.upstream_proxy:
-                remote_socket = self._connect_via_proxy(address, port)
-            else:
-                remote_socket = self._connect_direct(address, port)
+            client_persistent = _is_persistent(version, headers)
+            request_framing, request_length = _body_framing(headers)
+            chain = self._select_chain(client_address, address, _proxy_username(headers))
+            if chain is None:
+                client_socket.sendall(self.forbidden_response)
+                return False
+            
+            # 可缓存的 GET 请求先查缓存，新鲜的条目直接返回，过期的带条件头部向源站验证
+            cache_key = cached = None
+            upstream_headers = headers
+            if HTTP_CACHE and request_framing == 'none' and httpcache.request_cacheable(method, headers):
+                cache_key = HTTP_CACHE.key(address, port, path, headers)
+                cached = HTTP_CACHE.lookup(cache_key)
+                if cached is not None and cached.fresh() and not httpcache.request_requires_revalidation(headers):
+                    METRICS.inc('peanut_http_cache_total', {'result': 'hit'})
+                    response_started = True
+                    return self._send_cached(client_socket, cached, headers, client_persistent)
+                has_conditions = any(name.lower() in ('if-none-match', 'if-modified-since') for name, _ in headers)
+                if cached is not None and not has_conditions and cached.validators():
+                    upstream_headers = headers + cached.validators()
+                else:
+                    cached = None
+                    METRICS.inc('peanut_http_cache_total', {'result': 'miss'})
+            
+            upstream_key = self._upstream_key(chain)
+            
+            if not acquire_upstream_slot(chain):
+                self._reject_upstream(chain)
+                client_socket.sendall(self.reject_response)
+                return False
+            slot_held = True
+            
+            # 优先复用同一源站的空闲上游连接
+            remote_socket = self._checkout_tunnel(address, port, upstream_key)
+            reused = remote_socket is not None
+            if not reused:
+                remote_socket = self._open_remote(address, port, chain)
+                connect_seconds = time.time() - started
             
             if not remote_socket:
-                client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\n\r\n')
-                client_socket.close()
-                return
+                client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n')
+                return False
+            
+            # 以 origin-form 转发请求，上游连接始终请求保持
+            request_head = _build_http_head(f"{method} {path} {version}", upstream_headers, 'keep-alive')
+            try:
+                remote_socket.sendall(request_head)
+            except Exception:
+                if not reused:
+                    raise
+                # 复用的连接已被源站关闭，重新建立一次
+                remote_socket.close()
+                remote_socket = self._open_remote(address, port, chain)
+                connect_seconds = time.time() - started
+                if not remote_socket:
+                    client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n')
+                    return False
+                remote_socket.sendall(request_head)
+            head_bytes_up = len(request_head)
+            remote_socket.settimeout(IDLE_TIMEOUT or None)
             
-            # 转发请求
-            remote_socket.sendall(request_data)
+            # 转发请求体
+            if request_framing == 'chunked':
+                client.relay_chunked(remote_socket)
+            elif request_framing == 'length':
+                client.relay_exact(request_length, remote_socket)
             
-            # 转发响应
+            # 读取响应头（跳过 1xx 临时响应）
+            remote = _HTTPConnection(remote_socket)
             while True:
-                data = remote_socket.recv(4096)
-                if not data:
+                response_head = remote.read_head()
+                if response_head is None:
+                    raise Exception("源站未返回响应")
+                status_parts, response_headers = _parse_http_head(response_head)
+                response_version = status_parts[0]
+                status = int(status_parts[1]) if len(status_parts) > 1 else 0
+                if status == 101 or not 100 <= status < 200:
                     break
-                client_socket.sendall(data)
+                response_started = True
+                client_socket.sendall(response_head)
+                head_bytes_down += len(response_head)
+            
+            status_line = ' '.join(status_parts)
+            response_started = True
+            
+            # 源站确认缓存仍然有效：刷新有效期并返回缓存的内容
+            if cached is not None:
+                if status == 304:
+                    head_bytes_down += len(response_head)
+                    cached = HTTP_CACHE.refresh(cache_key, cached, response_headers)
+                    METRICS.inc('peanut_http_cache_total', {'result': 'revalidated'})
+                    reusable = _is_persistent(response_version, response_headers) and not remote.buffer
+                    return self._send_cached(client_socket, cached, headers, client_persistent)
+                METRICS.inc('peanut_http_cache_total', {'result': 'miss'})
+            
+            # 协议升级（如 WebSocket）：转为原始双向转发
+            if status == 101:
+                client_socket.sendall(response_head)
+                if remote.buffer:
+                    client_socket.sendall(remote.buffer)
+                    remote.buffer.clear()
+                if client.buffer:
+                    remote_socket.sendall(client.buffer)
+                    client.buffer.clear()
+                self._forward_data(client_socket, remote_socket, chain)
+                remote_socket = None
+                return False
+            
+            # 确定响应体分帧方式
+            if method == 'HEAD' or status in (204, 304):
+                response_framing, response_length = 'length', 0
+            else:
+                response_framing, response_length = _body_framing(response_headers)
+                if response_framing == 'none':
+                    response_framing = 'close'
+            
+            upstream_persistent = response_framing != 'close' and _is_persistent(response_version, response_headers)
+            keep_client = client_persistent and response_framing != 'close'
+            
+            response_head = _build_http_head(
+                status_line, response_headers, 'keep-alive' if keep_client else 'close'
+            )
+            client_socket.sendall(response_head)
+            head_bytes_down += len(response_head)
+            
+            # 可缓存的响应在转发的同时保留一份响应体
+            sink = client_socket
+            if (
+                cache_key
+                and response_framing in ('chunked', 'length')
+                and (response_length or 0) <= HTTP_CACHE.max_entry_bytes
+                and httpcache.response_cacheable(status, response_headers)
+            ):
+                sink = httpcache.CaptureSink(client_socket, HTTP_CACHE.max_entry_bytes)
+            
+            # 转发响应体
+            if response_framing == 'chunked':
+                remote.relay_chunked(sink)
+            elif response_framing == 'length':
+                remote.relay_exact(response_length, sink)
+            else:
+                remote.relay_until_close(sink)
+            
+            if sink is not client_socket and not sink.overflow:
+                if HTTP_CACHE.store(cache_key, status_line, response_headers, sink.data):
+                    METRICS.inc('peanut_http_cache_total', {'result': 'stored'})
+            
+            reusable = upstream_persistent and not remote.buffer
+            return keep_client
             
         except Exception as e:
             if self.running:
-                self.log(f"HTTP请求处理错误: {e}")
+                self.log(f"HTTP请求处理错误: {e}", logging.WARNING)
+            if not response_started:
+                try:
+                    client_socket.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                except:
+                    pass
+            return False
+        finally:
+            if slot_held:
+                release_upstream_slot(chain)
+            if chain is not None:
+                labels = {'upstream': upstream_label(chain)}
+                bytes_up = head_bytes_up + client.relayed - client_mark
+                bytes_down = head_bytes_down + (remote.relayed if remote else 0)
+                METRICS.inc('peanut_upstream_bytes_total', {**labels, 'direction': 'up'}, bytes_up)
+                METRICS.inc('peanut_upstream_bytes_total', {**labels, 'direction': 'down'}, bytes_down)
+                if TRACE.enabled:
+                    TRACE.record(self.listener_name, 'http', address, port, started, connect_seconds,
+                                 bytes_up, bytes_down, ok=response_started)
+            if remote_socket:
+                if reusable:
+                    self._release_tunnel(address, port, remote_socket, upstream_key)
+                else:
+                    try:
+                        remote_socket.close()
+                    except:
+                        pass
+
+
+# ---------- 端口固定出口 ----------
+
+def parse_port_range(value):
+    """解析 "20000-20099" 或 "20000" 形式的端口范围，无效时返回空列表"""
+    try:
+        first, _, last = str(value).strip().partition('-')
+        first = int(first)
+        last = int(last) if last else first
+    except ValueError:
+        return []
+    if not 0 < first <= last <= 65535:
+        return []
+    return list(range(first, last + 1))
+
+
+class PinnedPortServer(ProxyServer):
+    """
+    端口固定出口的 SOCKS5 服务器：监听一段端口，每个端口固定使用候选上游中的一个，
+    供需要多个稳定出口 IP 的并行客户端使用
+    
+    所有端口由同一个线程通过 selectors 接受连接，连接处理与 ProxyServer 相同。
+    候选上游更新时仍在候选中的端口保持原有出口；端口上的上游熔断时立即改用空闲的候选。
+    没有分配上游的端口拒绝连接，不会直连。
+    """
+    
+    listener_name = 'pinned'
+    
+    def __init__(self, local_host='127.0.0.1', ports=(), backlog=None):
+        ports = list(ports)
+        super().__init__(local_host, ports[0] if ports else 0, backlog)
+        self.ports = ports
+        self._pins = {}
+        self._candidates = ()
+        self._pins_lock = threading.Lock()
+        self._listeners = []
+        self._selector = None
+        self._current = threading.local()
+    
+    def start(self):
+        """绑定范围内的所有端口，任意端口绑定失败时整体启动失败"""
+        if self.running:
+            self.log("端口固定出口已在运行")
+            return False
+        if not self.ports:
+            self.log("端口固定出口的端口范围无效", logging.WARNING)
+            return False
+        
+        selector = selectors.DefaultSelector()
+        try:
+            for port in self.ports:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self._listeners.append(listener)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.socket_profile.apply_listener(listener)
+                listener.bind((self.local_host, port))
+                listener.listen(self.backlog)
+                listener.setblocking(False)
+                selector.register(listener, selectors.EVENT_READ)
+        except Exception as e:
+            selector.close()
+            self._close_listeners()
+            self.log(f"启动端口固定出口失败（端口 {port}）: {e}", logging.WARNING)
+            return False
+        
+        self._selector = selector
+        self.running = True
+        self.log(f"端口固定出口启动成功: {self.local_host}:{self.ports[0]}-{self.ports[-1]}")
+        threading.Thread(target=self._accept_connections, daemon=True).start()
+        return True
+    
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self._close_listeners()
+        self.log("端口固定出口已停止")
+    
+    def _close_listeners(self):
+        for listener in self._listeners:
+            try:
+                listener.close()
+            except OSError:
+                pass
+        self._listeners = []
+    
+    def _accept_connections(self):
+        """在一个线程中等待所有端口的新连接"""
+        selector = self._selector
+        try:
+            while self.running:
+                try:
+                    events = selector.select(timeout=1.0)
+                except (OSError, ValueError):
+                    if self.running:
+                        continue
+                    break
+                for key, _ in events:
+                    try:
+                        client_socket, client_address = key.fileobj.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        if self.running:
+                            self.log(f"接受连接错误: {e}", logging.WARNING)
+                        continue
+                    client_socket.setblocking(True)
+                    self._dispatch(client_socket, client_address)
+        finally:
+            selector.close()
+    
+    def _serve_client(self, client_socket, client_address):
+        # 记录连接到达的本地端口，选择上游时使用
+        try:
+            self._current.port = client_socket.getsockname()[1]
+        except OSError:
+            self._current.port = None
+        super()._serve_client(client_socket, client_address)
+    
+    def set_candidates(self, chains):
+        """
+        更新候选上游并重新分配端口
+        
+        Args:
+            chains: 按优先顺序排列的上游列表，每项为一条代理链 [(proxy_address, proxy_protocol), ...]；
+                    前 len(ports) 个优先分配，其余作为熔断时的备用
+        """
+        candidates = []
+        for chain in chains or []:
+            hops = self._parse_chain(chain)
+            if hops and hops not in candidates:
+                candidates.append(hops)
+        
+        with self._pins_lock:
+            if tuple(candidates) == self._candidates:
+                return
+            self._candidates = tuple(candidates)
+            old_pins = self._pins
+            # 仍在候选中的端口保持原有出口，其余端口依次分配未使用的候选
+            pins = {port: hops for port, hops in old_pins.items() if hops in candidates}
+            free = [hops for hops in candidates if hops not in pins.values()]
+            for port in self.ports:
+                if port not in pins and free:
+                    pins[port] = free.pop(0)
+            self._pins = pins
+        
+        changed = [port for port in self.ports if old_pins.get(port) != pins.get(port)]
+        for hops in old_pins.values():
+            if hops not in pins.values():
+                self._start_drain(hops)
+        if changed:
+            self.log(f"端口固定出口: {len(pins)}/{len(self.ports)} 个端口已分配上游，{len(changed)} 个端口变更")
+    
+    def pins(self):
+        """当前各端口使用的上游标签"""
+        return {port: upstream_label(hops) for port, hops in self._pins.items()}
+    
+    def _upstream_in_use(self, label):
+        return any(upstream_label(hops) == label for hops in self._pins.values())
+    
+    def _repin(self, port, broken):
+        """端口上的上游熔断时改用一个未分配且未熔断的候选，没有时返回 None"""
+        with self._pins_lock:
+            if self._pins.get(port) is not broken:
+                return self._pins.get(port)
+            used = list(self._pins.values())
+            for hops in self._candidates:
+                if hops not in used and BREAKER.state(upstream_label(hops)) != 'open':
+                    self._pins[port] = hops
+                    break
+            else:
+                return None
+        self.log(f"端口 {port} 的上游 {upstream_label(broken)} 已熔断，改用 {upstream_label(hops)}")
+        self._start_drain(broken)
+        return hops
+    
+    def _select_chain(self, client_address=None, target_host=None, username=None):
+        port = getattr(self._current, 'port', None)
+        chain = self._pins.get(port)
+        if chain is None:
+            return None
+        if BREAKER.state(upstream_label(chain)) == 'open':
+            chain = self._repin(port, chain) or chain
+        return chain
+
+
+# ---------- 多进程模式 ----------
+
+# 工作进程共享的上游配置（JSON）的共享内存大小（字节），按 MAX_INDEX_ITEMS / MAX_POOL_ITEMS 条目留有余量
+UPSTREAM_STATE_SIZE = 256 * 1024
+
+def reuse_port_supported():
+    """当前平台是否支持 SO_REUSEPORT 多进程监听（需要 fork 启动方式）"""
+    return hasattr(socket, 'SO_REUSEPORT') and 'fork' in multiprocessing.get_all_start_methods()
+
+
+def _proxy_worker_main(worker_id, upstream_state, upstream_version, stop_event, log_queue, metrics_queue):
+    """
+    工作进程入口：以 SO_REUSEPORT 绑定 SOCKS5 和 HTTP 端口，
+    跟随共享内存中的上游配置切换上游代理，并每秒上报一次指标快照和被动健康事件
+    """
+    METRICS.reset()
+    HEALTH.forward = True
+    last_report = 0
+    
+    def log_callback(message):
+        try:
+            log_queue.put_nowait(f"[进程{worker_id}] {message}")
+        except Exception:
+            pass
+    
+    servers = [
+        ProxyServer(local_port=SOCKS5_PORT, reuse_port=True),
+        HTTPProxyServer(local_port=HTTP_PORT, reuse_port=True),
+    ]
+    
+    applied_version = None
+    for instance in servers:
+        instance.set_log_callback(log_callback)
+    
+    try:
+        while not stop_event.is_set():
+            # 上游配置有变化时应用到本进程的服务器
+            version = upstream_version.value
+            if version != applied_version:
+                with upstream_state.get_lock():
+                    state = json.loads(upstream_state.value.decode('utf-8') or '{}')
+                for instance in servers:
+                    instance.set_upstream_chain([tuple(hop) for hop in state.get('chain', [])])
+                    instance.set_upstream_pool([[tuple(hop) for hop in chain] for chain in state.get('pool', [])])
+                    instance.set_pool_index(state.get('index', []))
+                applied_version = version
+            
+            for instance in servers:
+                if not instance.running and not instance.start():
+                    return
+            
+            if time.monotonic() - last_report >= 1:
+                try:
+                    metrics_queue.put_nowait((worker_id, METRICS.snapshot(), HEALTH.drain_events()))
+                except Exception:
+                    pass
+                last_report = time.monotonic()
+            
+            stop_event.wait(0.1)
+    finally:
+        for instance in servers:
+            instance.stop()
+
+
+class ProxyWorkerPool:
+    """
+    多进程代理服务器：N 个工作进程各自以 SO_REUSEPORT 监听相同端口，
+    上游选择保存在共享内存中，由主进程统一启动、停止和切换
+    """
+    
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.context = multiprocessing.get_context('fork')
+        self.upstream_state = self.context.Array('c', UPSTREAM_STATE_SIZE)
+        self.upstream_version = self.context.Value('i', 0)
+        self.stop_event = self.context.Event()
+        self.log_queue = self.context.Queue()
+        self.metrics_queue = self.context.Queue()
+        self.processes = []
+        self.log_callback = None
+        self.log_batch_callback = None
+        self.running = False
+        # 共享给工作进程的上游配置：当前上游链和粘性上游池
+        self.state = {'chain': [], 'pool': [], 'index': []}
+    
+    def set_log_callback(self, callback, batch_callback=None):
+        """设置日志回调函数（参数同 ProxyServer.set_log_callback）"""
+        self.log_callback = callback
+        self.log_batch_callback = batch_callback
+    
+    def set_upstream_chain(self, chain):
+        """
+        设置所有工作进程共用的上游代理链
+        
+        Args:
+            chain: 代理列表，每项为 (proxy_address, proxy_protocol)，单层代理时只有一项
+        """
+        self._publish({**self.state, 'chain': [list(hop) for hop in chain or []]})
+    
+    def set_upstream_pool(self, chains):
+        """设置所有工作进程共用的粘性上游池（参数同 ProxyServer.set_upstream_pool）"""
+        self._publish({**self.state, 'pool': [[list(hop) for hop in chain] for chain in chains or []]})
+    
+    def set_pool_index(self, items):
+        """设置所有工作进程共用的代理池索引（参数同 ProxyServer.set_pool_index）"""
+        self._publish({**self.state, 'index': items})
+    
+    def _publish(self, state):
+        """写入共享内存并递增版本号，工作进程检测到版本变化后应用"""
+        payload = json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if len(payload) >= len(self.upstream_state):
+            raise ValueError("上游配置过长")
+        self.state = state
+        with self.upstream_state.get_lock():
+            self.upstream_state.value = payload
+            self.upstream_version.value += 1
+    
+    def start(self):
+        """启动所有工作进程"""
+        if self.running:
+            return False
+        
+        self.stop_event.clear()
+        for worker_id in range(self.workers):
+            process = self.context.Process(
+                target=_proxy_worker_main,
+                args=(worker_id, self.upstream_state, self.upstream_version, self.stop_event,
+                      self.log_queue, self.metrics_queue),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        
+        self.running = True
+        metrics.clear_worker_snapshots()
+        threading.Thread(target=self._drain_logs, daemon=True).start()
+        threading.Thread(target=self._drain_metrics, daemon=True).start()
+        
+        # 等待工作进程完成监听，任一进程退出视为启动失败
+        time.sleep(0.5)
+        if not all(process.is_alive() for process in self.processes):
+            self.stop()
+            return False
+        return True
+    
+    def stop(self):
+        """停止所有工作进程"""
+        if not self.running:
+            return
+        
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=3)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.running = False
+    
+    def _drain_logs(self):
+        """把工作进程的日志批量转发到主进程的日志回调（级别过滤和采样已在工作进程中完成）"""
+        while self.running:
+            try:
+                messages = [self.log_queue.get(timeout=0.5)]
+            except Exception:
+                continue
+            while len(messages) < 500:
+                try:
+                    messages.append(self.log_queue.get_nowait())
+                except Exception:
+                    break
+            
+            for message in messages:
+                logging.info(message)
+            if self.log_batch_callback:
+                self.log_batch_callback(messages)
+            elif self.log_callback:
+                for message in messages:
+                    self.log_callback(message)
+            time.sleep(0.2)
+    
+    def _drain_metrics(self):
+        """接收工作进程上报的指标快照（供指标端点汇总）和被动健康事件"""
+        while self.running:
+            try:
+                worker_id, snapshot, health_events = self.metrics_queue.get(timeout=0.5)
+            except Exception:
+                continue
+            metrics.update_worker_snapshot(worker_id, snapshot)
+            HEALTH.apply_events(health_events)
 
 
 # 全局代理服务器实例
 _socks5_server_instance = None
 _http_server_instance = None
+_worker_pool_instance = None
+_pinned_server_instance = None
 
 def get_server_ports():
     """获取服务器端口配置"""
     return SOCKS5_PORT, HTTP_PORT
 
-def start_proxy_server(upstream_proxy_address, proxy_protocol='socks5', log_callback=None):
+def start_proxy_server(upstream_proxy_address, proxy_protocol='socks5', log_callback=None, upstream_chain=None,
+                       log_batch_callback=None):
     """
     启动代理服务器（同时启动SOCKS5和HTTP）
     
@@ -523,43 +2403,121 @@ def start_proxy_server(upstream_proxy_address, proxy_protocol='socks5', log_call
         upstream_proxy_address: 上游代理地址，格式为 "host:port"
         proxy_protocol: 代理协议
         log_callback: 日志回调函数
+        log_batch_callback: 批量日志回调函数，接收消息列表；设置后优先于 log_callback
+        upstream_chain: 多层代理链，每项为 (proxy_address, proxy_protocol)；
+                        提供时忽略 upstream_proxy_address 和 proxy_protocol
     
     Returns:
         成功返回True，失败返回False
     """
-    global _socks5_server_instance, _http_server_instance
+    global _socks5_server_instance, _http_server_instance, _worker_pool_instance, _pinned_server_instance
+    
+    def notify(message):
+        logging.info(message)
+        if log_batch_callback:
+            log_batch_callback([message])
+        elif log_callback:
+            log_callback(message)
+    
+    def stop_pinned():
+        # 主监听端口启动失败时，已启动的端口固定出口一并停止
+        global _pinned_server_instance
+        if _pinned_server_instance:
+            _pinned_server_instance.stop()
+            _pinned_server_instance = None
     
     if (_socks5_server_instance and _socks5_server_instance.running) or \
-       (_http_server_instance and _http_server_instance.running):
-        if log_callback:
-            log_callback("[服务器] 代理服务器已在运行")
+       (_http_server_instance and _http_server_instance.running) or \
+       (_worker_pool_instance and _worker_pool_instance.running):
+        notify("代理服务器已在运行")
         return False
     
+    if METRICS_PORT:
+        if metrics.start_metrics_server(METRICS_PORT):
+            notify(f"指标端点: http://127.0.0.1:{METRICS_PORT}/metrics")
+        else:
+            notify(f"指标端点启动失败，端口 {METRICS_PORT} 可能被占用")
+    
+    if PINNED_PORTS:
+        # 端口固定出口在主进程中运行，上游由 set_pinned_pool 分配
+        _pinned_server_instance = PinnedPortServer(ports=parse_port_range(PINNED_PORTS))
+        _pinned_server_instance.set_log_callback(log_callback, log_batch_callback)
+        if not _pinned_server_instance.start():
+            _pinned_server_instance = None
+    
+    # 多进程模式：所有工作进程共享同一份上游配置
+    if WORKERS > 1:
+        if reuse_port_supported():
+            _worker_pool_instance = ProxyWorkerPool(WORKERS)
+            _worker_pool_instance.set_log_callback(log_callback, log_batch_callback)
+            _worker_pool_instance.set_upstream_chain(
+                upstream_chain or ([(upstream_proxy_address, proxy_protocol)] if upstream_proxy_address else [])
+            )
+            if _worker_pool_instance.start():
+                notify(f"已启动 {WORKERS} 个工作进程")
+                return True
+            _worker_pool_instance = None
+            stop_pinned()
+            return False
+        notify("当前平台不支持 SO_REUSEPORT，使用单进程模式")
+    
+    def configure(instance):
+        instance.set_log_callback(log_callback, log_batch_callback)
+        if upstream_chain:
+            instance.set_upstream_chain(upstream_chain)
+        else:
+            instance.set_upstream_proxy(upstream_proxy_address, proxy_protocol)
+    
     # 启动SOCKS5服务器
     _socks5_server_instance = ProxyServer(local_port=SOCKS5_PORT)
-    _socks5_server_instance.set_log_callback(log_callback)
-    _socks5_server_instance.set_upstream_proxy(upstream_proxy_address, proxy_protocol)
+    configure(_socks5_server_instance)
     
     socks5_success = _socks5_server_instance.start()
     if not socks5_success:
+        stop_pinned()
         return False
     
     # 启动HTTP服务器
     _http_server_instance = HTTPProxyServer(local_port=HTTP_PORT)
-    _http_server_instance.set_log_callback(log_callback)
-    _http_server_instance.set_upstream_proxy(upstream_proxy_address, proxy_protocol)
+    configure(_http_server_instance)
     
     http_success = _http_server_instance.start()
     if not http_success:
         # 如果HTTP启动失败，停止SOCKS5
         _socks5_server_instance.stop()
+        stop_pinned()
         return False
     
     return True
 
+def start_proxy_chain(upstream_chain, log_callback=None, log_batch_callback=None):
+    """
+    以多层代理模式启动代理服务器
+    
+    Args:
+        upstream_chain: 代理链，每项为 (proxy_address, proxy_protocol)，2-3跳
+        log_callback: 日志回调函数
+        log_batch_callback: 批量日志回调函数
+    
+    Returns:
+        成功返回True，失败返回False
+    """
+    return start_proxy_server(None, log_callback=log_callback, upstream_chain=upstream_chain,
+                              log_batch_callback=log_batch_callback)
+
 def stop_proxy_server():
     """停止代理服务器"""
-    global _socks5_server_instance, _http_server_instance
+    global _socks5_server_instance, _http_server_instance, _worker_pool_instance, _pinned_server_instance
+    global _pool_index_items
+    
+    _pool_index_items = None
+    if _pinned_server_instance:
+        _pinned_server_instance.stop()
+        _pinned_server_instance = None
+    
+    if _worker_pool_instance:
+        _worker_pool_instance.stop()
+        _worker_pool_instance = None
     
     if _socks5_server_instance:
         _socks5_server_instance.stop()
@@ -568,20 +2526,52 @@ def stop_proxy_server():
     if _http_server_instance:
         _http_server_instance.stop()
         _http_server_instance = None
+    
+    metrics.stop_metrics_server()
 
-def switch_upstream_proxy(upstream_proxy_address, proxy_protocol='socks5'):
+def validate_upstream(upstream_chain):
     """
-    动态切换上游代理
+    切换前验证新上游：经新上游连接探测目标，同时预热域名解析
+    
+    Args:
+        upstream_chain: 代理列表，每项为 (proxy_address, proxy_protocol)
+    
+    Returns:
+        可以切换返回True；未启用验证或切换为直连时总是返回True
+    """
+    hops = [proxy for proxy in (parse_proxy_address(a, p) for a, p in upstream_chain or []) if proxy]
+    if not VALIDATE_ON_SWITCH or not hops:
+        return True
+    ok, detail = probe_upstream(hops[:MAX_CHAIN_HOPS])
+    if ok:
+        logging.info(f"新上游验证通过: {upstream_label(hops)} ({detail}ms)")
+    else:
+        logging.warning(f"新上游验证失败，保留当前上游: {upstream_label(hops)} - {detail}")
+    return ok
+
+def switch_upstream_proxy(upstream_proxy_address, proxy_protocol='socks5', validate=True):
+    """
+    动态切换上游代理：先验证新上游，通过后原子切换，旧上游上的连接继续完成后排空
     
     Args:
         upstream_proxy_address: 新的上游代理地址
         proxy_protocol: 代理协议
+        validate: 是否先验证新上游（config.yaml 中 validate_on_switch 为 false 时不验证）
     
     Returns:
-        成功返回True，失败返回False
+        成功返回True；服务器未运行或新上游验证失败时返回False
     """
     global _socks5_server_instance, _http_server_instance
     
+    if validate and upstream_proxy_address and not validate_upstream([(upstream_proxy_address, proxy_protocol)]):
+        return False
+    
+    if _worker_pool_instance and _worker_pool_instance.running:
+        _worker_pool_instance.set_upstream_chain(
+            [(upstream_proxy_address, proxy_protocol)] if upstream_proxy_address else []
+        )
+        return True
+    
     success = False
     if _socks5_server_instance and _socks5_server_instance.running:
         _socks5_server_instance.set_upstream_proxy(upstream_proxy_address, proxy_protocol)
@@ -592,3 +2582,137 @@ def switch_upstream_proxy(upstream_proxy_address, proxy_protocol='socks5'):
         success = True
     
     return success
+
+def switch_upstream_chain(upstream_chain, validate=True):
+    """
+    动态切换多层代理链（先验证，再原子切换并排空旧链路）
+    
+    Args:
+        upstream_chain: 新的代理链，每项为 (proxy_address, proxy_protocol)
+        validate: 是否先验证新代理链
+    
+    Returns:
+        成功返回True；服务器未运行或新代理链验证失败时返回False
+    """
+    if validate and not validate_upstream(upstream_chain):
+        return False
+    
+    if _worker_pool_instance and _worker_pool_instance.running:
+        _worker_pool_instance.set_upstream_chain(upstream_chain)
+        return True
+    
+    success = False
+    for instance in (_socks5_server_instance, _http_server_instance):
+        if instance and instance.running:
+            instance.set_upstream_chain(upstream_chain)
+            success = True
+    
+    return success
+
+def get_upstream_chain():
+    """
+    当前上游代理链
+    
+    Returns:
+        [(proxy_address, proxy_protocol), ...]，直连时为空列表；代理服务器未运行时返回 None
+    """
+    if _worker_pool_instance and _worker_pool_instance.running:
+        return [tuple(hop) for hop in _worker_pool_instance.state['chain']]
+    if _socks5_server_instance and _socks5_server_instance.running:
+        return [(f"{hop['host']}:{hop['port']}", hop['protocol']) for hop in _socks5_server_instance.upstream_chain]
+    return None
+
+# 下发给工作进程的粘性上游池条目上限（取前 N 个），受共享内存大小限制；单进程模式不限制
+MAX_POOL_ITEMS = 1000
+
+def set_upstream_pool(chains):
+    """
+    设置粘性模式（config.yaml 中的 affinity_mode）使用的上游池
+    
+    Args:
+        chains: 上游列表，每项为一条代理链 [(proxy_address, proxy_protocol), ...]；为空时取消
+    
+    Returns:
+        成功返回True，代理服务器未运行时返回False
+    """
+    if _worker_pool_instance and _worker_pool_instance.running:
+        try:
+            # 共享内存大小有限，工作进程只取前 N 个（调用方按分数从高到低传入）
+            _worker_pool_instance.set_upstream_pool((chains or [])[:MAX_POOL_ITEMS])
+        except ValueError as e:
+            logging.warning(f"下发粘性上游池失败: {e}")
+            return False
+        return True
+    
+    success = False
+    for instance in (_socks5_server_instance, _http_server_instance):
+        if instance and instance.running:
+            instance.set_upstream_pool(chains)
+            success = True
+    
+    return success
+
+def set_pinned_pool(chains):
+    """
+    更新端口固定出口（config.yaml 中的 pinned_ports）的候选上游
+    
+    Args:
+        chains: 按优先顺序排列的上游列表，每项为一条代理链 [(proxy_address, proxy_protocol), ...]
+    
+    Returns:
+        成功返回True，未启用端口固定出口时返回False
+    """
+    if _pinned_server_instance and _pinned_server_instance.running:
+        _pinned_server_instance.set_candidates(chains)
+        return True
+    return False
+
+# 上次下发的代理池索引条目，未变化时不重建索引
+_pool_index_items = None
+# 下发给工作进程的索引条目上限（按分数取前 N 个），受共享内存大小限制；单进程模式不限制
+MAX_INDEX_ITEMS = 300
+
+def set_pool_index(items):
+    """
+    设置按认证用户名选择上游时使用的代理池（内容未变化时直接返回）
+    
+    Args:
+        items: 代理池条目（pool.json 中的字典）
+    
+    Returns:
+        成功返回True，代理服务器未运行时返回False
+    """
+    global _pool_index_items
+    
+    keys = ('status', 'address', 'protocol', 'country', 'anonymity', 'score')
+    compact = [{key: item.get(key) for key in keys} for item in items or [] if item.get('status') == '可用']
+    compact.sort(key=lambda item: item.get('score') or 0, reverse=True)
+    if compact == _pool_index_items:
+        return True
+    
+    if _worker_pool_instance and _worker_pool_instance.running:
+        try:
+            # 共享内存大小有限，工作进程只取分数最高的前 N 个
+            _worker_pool_instance.set_pool_index(compact[:MAX_INDEX_ITEMS])
+        except ValueError as e:
+            logging.warning(f"下发代理池索引失败: {e}")
+            return False
+        _pool_index_items = compact
+        return True
+    
+    success = False
+    for instance in (_socks5_server_instance, _http_server_instance):
+        if instance and instance.running:
+            instance.set_pool_index(compact)
+            success = True
+    if success:
+        _pool_index_items = compact
+    return success
+
+def affinity_enabled():
+    """是否启用了粘性模式"""
+    return AFFINITY_MODE in AFFINITY_MODES and AFFINITY_MODE != 'off'
+
+def get_metrics_summary():
+    """获取代理服务器流量指标摘要（含多进程模式下各工作进程），供界面展示"""
+    return metrics.summary()
@@ -0,0 +1,164 @@
+import logging
+import socket
+
+# 监听端口的 TCP Fast Open 队列长度
+FASTOPEN_QUEUE = 256
+
+# 预设参数；自定义配置以某个预设为基础覆盖其中的项
+PRESETS = {
+    # 保持系统默认
+    "default": {},
+    # 交互式流量：关闭 Nagle、快速发现断开的隧道
+    "low-latency": {
+        "nodelay": True,
+        "keepalive": True,
+        "keepalive_idle": 60,
+        "keepalive_interval": 10,
+        "keepalive_count": 3,
+    },
+    # 大文件传输：允许合并小包，加大收发缓冲区
+    "bulk-throughput": {
+        "nodelay": False,
+        "keepalive": True,
+        "keepalive_idle": 300,
+        "keepalive_interval": 30,
+        "keepalive_count": 4,
+        "rcvbuf": 4 * 1024 * 1024,
+        "sndbuf": 4 * 1024 * 1024,
+    },
+}
+
+OPTION_KEYS = ("nodelay", "keepalive", "keepalive_idle", "keepalive_interval", "keepalive_count",
+               "rcvbuf", "sndbuf", "fastopen")
+
+
+class SocketProfile:
+    """
+    一组套接字参数
+
+    - nodelay: TCP_NODELAY
+    - keepalive / keepalive_idle / keepalive_interval / keepalive_count: SO_KEEPALIVE 及探测参数（秒、次）
+    - rcvbuf / sndbuf: SO_RCVBUF / SO_SNDBUF（字节），需要在连接建立前设置才影响窗口缩放
+    - fastopen: 监听端口接受 TCP Fast Open（需显式开启，预设中不包含）。主动连接不使用 Fast Open：
+      TCP_FASTOPEN_CONNECT 下 connect 在发出 SYN 之前就返回成功，无法据此判断上游是否可达
+
+    系统不支持的参数直接跳过（只记录一次日志），不影响连接。
+    """
+
+    def __init__(self, name="default", **options):
+        unknown = set(options) - set(OPTION_KEYS)
+        if unknown:
+            raise ValueError(f"未知的套接字参数: {', '.join(sorted(unknown))}")
+        self.name = name
+        self.options = {key: value for key, value in options.items() if value is not None}
+        self._unsupported = set()
+
+    @classmethod
+    def from_config(cls, spec):
+        """
+        由配置创建：预设名称，或 {preset: 预设名称, 参数: 值, ...}
+
+        Raises:
+            ValueError: 预设名称或参数无效
+        """
+        if spec is None or spec == "":
+            return cls()
+        if isinstance(spec, str):
+            if spec not in PRESETS:
+                raise ValueError(f"未知的套接字参数预设: {spec}")
+            return cls(spec, **PRESETS[spec])
+        if not isinstance(spec, dict):
+            raise ValueError(f"无效的套接字参数配置: {spec!r}")
+        overrides = dict(spec)
+        preset = overrides.pop("preset", "default")
+        if preset not in PRESETS:
+            raise ValueError(f"未知的套接字参数预设: {preset}")
+        return cls(f"{preset}+custom" if overrides else preset, **{**PRESETS[preset], **overrides})
+
+    def __repr__(self):
+        return f"SocketProfile({self.name!r}, {self.options!r})"
+
+    def _set(self, sock, level, option, value, key):
+        if option is None or key in self._unsupported:
+            return
+        try:
+            sock.setsockopt(level, option, value)
+        except (OSError, TypeError):
+            self._unsupported.add(key)
+            logging.debug(f"套接字参数 {key} 不受支持，已跳过")
+
+    def _apply_buffers(self, sock):
+        options = self.options
+        if "rcvbuf" in options:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, int(options["rcvbuf"]), "rcvbuf")
+        if "sndbuf" in options:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, int(options["sndbuf"]), "sndbuf")
+
+    def apply(self, sock):
+        """设置已建立连接（或即将连接）的 TCP 套接字"""
+        options = self.options
+        if not options:
+            return
+        if "nodelay" in options:
+            self._set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(options["nodelay"])), "nodelay")
+        if "keepalive" in options:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(options["keepalive"])), "keepalive")
+            if options["keepalive"]:
+                for key, name in (("keepalive_idle", "TCP_KEEPIDLE"), ("keepalive_interval", "TCP_KEEPINTVL"),
+                                  ("keepalive_count", "TCP_KEEPCNT")):
+                    if key in options:
+                        self._set(sock, socket.IPPROTO_TCP, getattr(socket, name, None), int(options[key]), key)
+        self._apply_buffers(sock)
+
+    def apply_listener(self, sock):
+        """监听前调用：缓冲区大小由接受的连接继承，并启用服务端 Fast Open"""
+        self._apply_buffers(sock)
+        if self.options.get("fastopen"):
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, "TCP_FASTOPEN", None), FASTOPEN_QUEUE, "fastopen")
+
+
+class SocketOptions:
+    """
+    按用途划分的套接字参数
+
+    配置（config.yaml 的 socket_options）：
+      listener: 所有监听端口接受的客户端连接
+      socks5 / http / pinned: 按监听端口覆盖 listener
+      upstream: 到上游代理（第一跳）的连接
+      upstreams: 按上游地址覆盖 upstream，如 {"1.2.3.4:1080": bulk-throughput}
+      direct: 直连目标的连接
+    每项为预设名称（default / low-latency / bulk-throughput）或以预设为基础的参数字典。
+    """
+
+    def __init__(self, config=None):
+        config = config if isinstance(config, dict) else {}
+        self.listener_default = self._load(config, "listener")
+        self.listeners = {name: self._load(config, name, self.listener_default) for name in ("socks5", "http", "pinned")}
+        self.upstream_default = self._load(config, "upstream")
+        self.direct = self._load(config, "direct")
+        self.upstreams = {}
+        for address, spec in (config.get("upstreams") or {}).items():
+            try:
+                self.upstreams[str(address).strip()] = SocketProfile.from_config(spec)
+            except ValueError as e:
+                logging.warning(f"上游 {address} 的套接字参数无效，使用默认值: {e}")
+
+    @staticmethod
+    def _load(config, key, fallback=None):
+        if config.get(key) in (None, ""):
+            return fallback or SocketProfile()
+        try:
+            return SocketProfile.from_config(config[key])
+        except ValueError as e:
+            logging.warning(f"socket_options.{key} 无效，使用默认值: {e}")
+            return fallback or SocketProfile()
+
+    def listener(self, name):
+        return self.listeners.get(name, self.listener_default)
+
+    def upstream(self, host, port):
+        if self.upstreams:
+            profile = self.upstreams.get(f"{host}:{port}")
+            if profile is not None:
+                return profile
+        return self.upstream_default
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from script.health import pool_key
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS proxies (
+    key TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT '',
+    country TEXT NOT NULL DEFAULT '',
+    score REAL NOT NULL DEFAULT 0,
+    tested_at REAL NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_proxies_status_score ON proxies (status, score DESC);
+CREATE INDEX IF NOT EXISTS idx_proxies_country_score ON proxies (country, score DESC);
+CREATE INDEX IF NOT EXISTS idx_proxies_score ON proxies (score DESC);
+CREATE INDEX IF NOT EXISTS idx_proxies_tested_at ON proxies (tested_at);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _fingerprint(item):
+    """条目内容的指纹，用于判断是否需要重新写入（比序列化整个条目快得多）"""
+    try:
+        return hash(tuple(item.items()))
+    except TypeError:
+        return hash(json.dumps(item, sort_keys=True, ensure_ascii=False))
+
+
+def _row(item):
+    data = json.dumps(item, ensure_ascii=False, separators=(",", ":"))
+    return (
+        pool_key(item), item.get("status", ""), item.get("country", ""),
+        float(item.get("score", 0) or 0), float(item.get("tested_at", 0) or 0), data,
+    )
+
+
+class PoolStore:
+    """
+    SQLite 代理池存储（WAL 模式），每个代理一行，以 protocol://address 为主键
+
+    - upsert / delete：测试结果逐条写入，进程中途退出时已写入的结果不会丢失
+    - sync：把内存中的整个代理池写回，只写入内容有变化的行并删除已移除的代理
+    - query：按状态、地区、分数和测试时间查询（均有索引），供不加载整个代理池的工具使用
+
+    同一个连接由锁串行使用，可以在多个线程中调用。
+    """
+
+    def __init__(self, path, legacy_file=None):
+        """
+        Args:
+            path: 数据库文件
+            legacy_file: 旧版 pool.json，第一次打开数据库时导入
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        # 已写入的行：主键 -> 内容的指纹，sync 时跳过未变化的行
+        self._written = {}
+        if legacy_file:
+            self._migrate(legacy_file)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _migrate(self, legacy_file):
+        """从 pool.json 导入（只进行一次，记录在 meta 表中；原文件保留不动）"""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE name = 'migrated_from'").fetchone():
+                return
+        items = []
+        if os.path.exists(legacy_file) and os.path.getsize(legacy_file):
+            try:
+                with open(legacy_file, encoding="utf-8") as f:
+                    items = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"读取 {legacy_file} 失败，未导入代理池: {e}")
+                return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO proxies (key, status, country, score, tested_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    [_row(item) for item in items if item.get("address")],
+                )
+                self._conn.execute("INSERT INTO meta (name, value) VALUES ('migrated_from', ?)", (legacy_file,))
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+        if items:
+            logging.info(f"已从 {legacy_file} 导入 {len(items)} 条代理到 {self.path}")
+
+    def load(self):
+        """读取整个代理池（按分数从高到低）"""
+        with self._lock:
+            # 按主键顺序读取后在内存中排序，比按分数索引逐行回表快
+            rows = self._conn.execute("SELECT key, score, data FROM proxies").fetchall()
+            rows.sort(key=lambda row: row[1], reverse=True)
+            data = [json.loads(row[2]) for row in rows]
+            self._written = {row[0]: _fingerprint(item) for row, item in zip(rows, data)}
+        return data
+
+    def query(self, status=None, country=None, min_score=None, tested_before=None, limit=None):
+        """按条件查询代理（按分数从高到低）；country 按包含关系匹配地区名称"""
+        clauses, params = [], []
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        if country:
+            clauses.append("country LIKE ?")
+            params.append(f"%{country}%")
+        if min_score is not None:
+            clauses.append("score >= ?")
+            params.append(min_score)
+        if tested_before is not None:
+            clauses.append("tested_at < ?")
+            params.append(tested_before)
+        sql = "SELECT data FROM proxies"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY score DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def _write(self, upserts, deletes):
+        """在锁内调用：在一个事务中写入和删除，upserts 为 (_row(item), 指纹) 列表"""
+        if not upserts and not deletes:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if upserts:
+                self._conn.executemany(
+                    "INSERT INTO proxies (key, status, country, score, tested_at, data) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET status = excluded.status, country = excluded.country, "
+                    "score = excluded.score, tested_at = excluded.tested_at, data = excluded.data",
+                    [row for row, _ in upserts],
+                )
+            if deletes:
+                self._conn.executemany("DELETE FROM proxies WHERE key = ?", [(key,) for key in deletes])
+            self._conn.execute("COMMIT")
+        except sqlite3.Error:
+            self._conn.execute("ROLLBACK")
+            raise
+        for row, fingerprint in upserts:
+            self._written[row[0]] = fingerprint
+        for key in deletes:
+            self._written.pop(key, None)
+
+    def upsert(self, items):
+        """写入或更新代理"""
+        with self._lock:
+            self._write([(_row(item), _fingerprint(item)) for item in items], [])
+
+    def delete(self, items):
+        """删除代理"""
+        with self._lock:
+            self._write([], [pool_key(item) for item in items])
+
+    def sync(self, data):
+        """
+        把整个代理池写回：只写入内容有变化的行，删除不在 data 中的代理
+
+        Returns:
+            (写入的行数, 删除的行数)
+        """
+        with self._lock:
+            written = self._written
+            keys = set()
+            upserts = []
+            for item in data:
+                if not item.get("address"):
+                    continue
+                key = pool_key(item)
+                keys.add(key)
+                fingerprint = _fingerprint(item)
+                if written.get(key) != fingerprint:
+                    upserts.append((_row(item), fingerprint))
+            deletes = [key for key in written if key not in keys]
+            self._write(upserts, deletes)
+        return len(upserts), len(deletes)
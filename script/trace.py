@@ -0,0 +1,311 @@
+"""
+连接轨迹的记录与回放
+
+记录：代理服务器在 trace_file 中逐行（JSON）写入每个连接的时间、目标主机哈希、端口、上下行字节数、
+建立连接耗时和持续时间。主机名用每次启动随机生成、不落盘的盐做 HMAC，同一轨迹内同一主机的哈希相同，
+但无法从轨迹反查访问过的站点；不记录客户端地址和任何报文内容。
+
+回放：在本机启动源站、模拟上游和代理端口（同 script.bench），按轨迹中的时间间隔以 1-10 倍速重新发起连接，
+每个连接传输与记录相同的字节数并保持相同（按倍速缩短）的时长，失败的连接回放为上游拒绝：
+  python -m script.trace trace.jsonl --speed 4 --upstream socks5 --output replay.json
+"""
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+# 写入间隔（秒）
+FLUSH_INTERVAL = 1.0
+# 未写入的事件上限，超出时丢弃并计数
+MAX_PENDING = 100000
+# 回放倍速范围
+MIN_SPEED = 1
+MAX_SPEED = 10
+
+
+class TraceRecorder:
+    """
+    连接轨迹记录器
+
+    热路径只做一次 deque.append，由后台线程批量追加写入文件；
+    多进程模式下各工作进程共用 fork 前生成的盐，并以追加方式写同一个文件。
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dropped = 0
+        self._salt = os.urandom(16)
+        self._queue = collections.deque()
+        self._host_cache = {}
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._writer_started = False
+        self._start_lock = threading.Lock()
+        self._queue.clear()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def host_hash(self, host):
+        """目标主机的匿名标识（HMAC-SHA256 前 16 位十六进制）"""
+        digest = self._host_cache.get(host)
+        if digest is None:
+            digest = hmac.new(self._salt, host.lower().encode("utf-8", "replace"), hashlib.sha256).hexdigest()[:16]
+            if len(self._host_cache) >= 65536:
+                self._host_cache.clear()
+            self._host_cache[host] = digest
+        return digest
+
+    def record(self, listener, kind, host, port, started, connect_seconds, up=0, down=0, ok=True):
+        """
+        记录一个结束的连接
+
+        Args:
+            listener: 监听端口名称（socks5 / http / pinned）
+            kind: tunnel（SOCKS5 / HTTP CONNECT 隧道）或 http（普通 HTTP 请求）
+            started: 开始时间（time.time()）
+            connect_seconds: 建立上游连接耗时
+        """
+        if not self.path:
+            return
+        if len(self._queue) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self._queue.append((started, listener, kind, host, port, connect_seconds, up, down, time.time(), ok))
+        if not self._writer_started:
+            self._start_writer()
+
+    def _start_writer(self):
+        with self._start_lock:
+            if self._writer_started:
+                return
+            self._writer_started = True
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """把已记录的事件写入文件"""
+        lines = []
+        while self._queue:
+            started, listener, kind, host, port, connect, up, down, ended, ok = self._queue.popleft()
+            lines.append(json.dumps({
+                "t": round(started, 3), "listener": listener, "kind": kind, "host": self.host_hash(host),
+                "port": port, "connect_ms": round(connect * 1000, 1), "up": up, "down": down,
+                "duration": round(ended - started, 3), "ok": ok,
+            }, separators=(",", ":")))
+        if not lines:
+            return
+        try:
+            # 一次 write 追加整批，多个工作进程写同一文件时行不会交错
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            self.dropped += len(lines)
+            logging.warning(f"写入连接轨迹失败: {e}")
+
+
+# ---------- 回放 ----------
+
+def load_trace(path):
+    """读取轨迹文件，按开始时间排序，时间改为相对第一个连接的秒数"""
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    events.sort(key=lambda event: event["t"])
+    if events:
+        first = events[0]["t"]
+        for event in events:
+            event["t"] -= first
+    return events
+
+
+def _target(event):
+    """回放使用的目标：主机哈希作为域名（模拟上游把所有目标转到本地源站），失败的连接指向 fail. 前缀"""
+    prefix = "" if event.get("ok", True) else "fail."
+    return f"{prefix}{event['host']}.trace.invalid", event.get("port", 443)
+
+
+def _open_tunnel(event, ports):
+    from script import bench
+
+    host, port = _target(event)
+    if event.get("listener") == "http":
+        sock = socket.create_connection(("127.0.0.1", ports["proxy_http"]), timeout=bench.CLIENT_TIMEOUT)
+        sock.sendall(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+        head = bench._read_head(sock)
+        if head is None or b" 200" not in head.split(b"\r\n", 1)[0]:
+            sock.close()
+            raise OSError("HTTP CONNECT 失败")
+        return sock
+    sock = socket.create_connection(("127.0.0.1", ports["proxy_socks5"]), timeout=bench.CLIENT_TIMEOUT)
+    try:
+        sock.sendall(b"\x05\x01\x00")
+        if bench._recv_exact(sock, 2) != b"\x05\x00":
+            raise OSError("SOCKS5 认证协商失败")
+        name = host.encode()
+        sock.sendall(b"\x05\x01\x00\x03" + bytes([len(name)]) + name + struct.pack("!H", port))
+        reply = bench._recv_exact(sock, 10)
+        if reply[1] != 0:
+            raise OSError(f"SOCKS5 连接失败: {reply[1]}")
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _replay_one(event, ports, speed, results):
+    """按记录的字节数和（缩短后的）时长回放一个连接"""
+    from script import bench
+
+    start = time.perf_counter()
+    hold_ms = int(event.get("duration", 0) * 1000 / speed)
+    try:
+        if event.get("kind") == "http":
+            host, port = _target(event)
+            sock = socket.create_connection(("127.0.0.1", ports["proxy_http"]), timeout=bench.CLIENT_TIMEOUT)
+            connected = time.perf_counter()
+            sock.sendall(f"GET http://{host}:{port}/bytes/{event.get('down', 0)} HTTP/1.1\r\n"
+                         f"Host: {host}:{port}\r\nConnection: close\r\n\r\n".encode())
+        else:
+            sock = _open_tunnel(event, ports)
+            connected = time.perf_counter()
+            sock.sendall(b"TRACE %d %d %d\n" % (event.get("up", 0), event.get("down", 0), hold_ms))
+            threading.Thread(target=bench._send_bytes, args=(sock, event.get("up", 0)), daemon=True).start()
+        sent = time.perf_counter()
+        received, first, ok = 0, None, True
+        try:
+            while True:
+                data = sock.recv(bench.CHUNK)
+                if not data:
+                    break
+                if first is None:
+                    first = time.perf_counter()
+                    # 普通 HTTP 请求失败时代理回复 502
+                    ok = event.get("kind") != "http" or data[9:12] == b"200"
+                received += len(data)
+        finally:
+            sock.close()
+        if not ok:
+            raise OSError("HTTP 请求失败")
+        results.append((True, connected - start, (first or sent) - sent, received, event.get("ok", True)))
+    except (OSError, ValueError):
+        results.append((False, None, None, 0, event.get("ok", True)))
+
+
+def replay(events, ports, speed):
+    """按轨迹时间（除以倍速）发起连接，返回统计结果"""
+    results = []
+    threads = []
+    lags = []
+    start = time.perf_counter()
+    for event in events:
+        due = start + event["t"] / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        lags.append(max(time.perf_counter() - due, 0))
+        thread = threading.Thread(target=_replay_one, args=(event, ports, speed, results), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    from script.bench import _latency_summary
+
+    succeeded = [result for result in results if result[0]]
+    # 记录中失败的连接回放时也应失败，两者一致才算符合预期
+    mismatched = sum(1 for result in results if result[0] != result[4])
+    return {
+        "events": len(events),
+        "speed": speed,
+        "elapsed_s": round(elapsed, 3),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "unexpected": mismatched,
+        "connections_per_s": round(len(results) / elapsed, 1) if elapsed else 0,
+        "throughput_mb_s": round(sum(result[3] for result in succeeded) / elapsed / 1024 / 1024, 2) if elapsed else 0,
+        "connect_ms": _latency_summary([result[1] for result in succeeded]),
+        "ttfb_ms": _latency_summary([result[2] for result in succeeded]),
+        "schedule_lag_ms": _latency_summary(lags),
+    }
+
+
+def main(argv=None):
+    from script import bench
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description="在本机回放连接轨迹")
+    parser.add_argument("trace", help="代理服务器记录的轨迹文件（trace_file）")
+    parser.add_argument("--speed", type=float, default=1, help=f"回放倍速（{MIN_SPEED}-{MAX_SPEED}）")
+    parser.add_argument("--upstream", choices=("socks5", "http"), default="socks5", help="模拟上游的协议")
+    parser.add_argument("--latency-ms", type=float, default=0, help="模拟上游每次握手增加的延迟（毫秒）")
+    parser.add_argument("--socket-profile", default=None, help="代理使用的套接字参数预设，默认按配置文件")
+    parser.add_argument("--socks-port", type=int, default=1080, help="SOCKS5 代理端口")
+    parser.add_argument("--http-port", type=int, default=1081, help="HTTP 代理端口")
+    parser.add_argument("--output", help="把 JSON 结果写入文件")
+    args = parser.parse_args(argv)
+    if not MIN_SPEED <= args.speed <= MAX_SPEED:
+        parser.error(f"倍速应在 {MIN_SPEED}-{MAX_SPEED} 之间")
+
+    events = load_trace(args.trace)
+    if not events:
+        parser.error("轨迹文件中没有连接记录")
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    ports = manager.dict()
+    stop = context.Event()
+    origin_ready, proxy_ready = context.Event(), context.Event()
+    origin = context.Process(target=bench.run_origin, daemon=True,
+                             args=(ports, origin_ready, stop, args.latency_ms / 1000, 0, True))
+    origin.start()
+    if not origin_ready.wait(30):
+        parser.error("源站启动失败")
+    upstream = (args.upstream, f"127.0.0.1:{ports[args.upstream]}")
+    proxy = context.Process(target=bench.run_proxy, daemon=True,
+                            args=(args.socks_port, args.http_port, upstream, args.socket_profile, proxy_ready, stop,
+                                  False))
+    proxy.start()
+    if not proxy_ready.wait(30):
+        stop.set()
+        parser.error("代理端口启动失败（端口是否被占用？）")
+
+    try:
+        report = replay(events, dict(ports, proxy_socks5=args.socks_port, proxy_http=args.http_port), args.speed)
+    finally:
+        stop.set()
+        proxy.join(5)
+        origin.join(5)
+        manager.shutdown()
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import concurrent.futures
+import ipaddress
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from script import dialer
+from script.metrics import METRICS
+
+# 单个 UDP 数据报的最大长度
+MAX_DATAGRAM = 65535
+# 每个关联缓存的目标地址（应答头部和分流决定）数量上限
+MAX_CACHED_TARGETS = 1024
+# 解析目标域名的线程数，解析不在转发线程中进行
+RESOLVER_THREADS = 4
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+def parse_udp_header(data):
+    """
+    解析 SOCKS5 UDP 请求头（RFC 1928 第 7 节）：RSV(2) FRAG(1) ATYP DST.ADDR DST.PORT
+
+    Returns:
+        (目标主机, 目标端口, 数据起始位置)；格式错误或分片（FRAG 不为 0）时返回 None
+    """
+    if len(data) < 10 or data[2] != 0:
+        return None
+    address_type = data[3]
+    if address_type == 1:
+        host = socket.inet_ntoa(bytes(data[4:8]))
+        offset = 8
+    elif address_type == 4:
+        if len(data) < 22:
+            return None
+        host = socket.inet_ntop(socket.AF_INET6, bytes(data[4:20]))
+        offset = 20
+    elif address_type == 3:
+        length = data[4]
+        offset = 5 + length
+        if len(data) < offset + 2:
+            return None
+        host = bytes(data[5:offset]).decode("utf-8", errors="replace")
+    else:
+        return None
+    port = struct.unpack("!H", bytes(data[offset:offset + 2]))[0]
+    return host, port, offset + 2
+
+
+def build_udp_header(host, port):
+    """构造返回给客户端的 UDP 头部（来源为 IP 地址）"""
+    ip = ipaddress.ip_address(host)
+    address = (b"\x01" if ip.version == 4 else b"\x04") + ip.packed
+    return b"\x00\x00\x00" + address + struct.pack("!H", port)
+
+
+class UDPAssociation:
+    """
+    一个 UDP ASSOCIATE 关联：客户端侧的 UDP 套接字，以及经上游 SOCKS5 转发或直连的出口
+
+    只接受来自建立关联的客户端 IP 的数据报；客户端端口取请求中声明的端口，未声明时取第一个数据报的来源端口。
+    """
+
+    def __init__(self, client_sock, client_ip, client_port=None, upstream_relay=None, decide=None):
+        """
+        Args:
+            client_sock: 已绑定的 UDP 套接字，客户端向它发送数据报
+            upstream_relay: 上游 SOCKS5 代理的 UDP 中继地址 (ip, port)，None 表示直连
+            decide: 分流函数 decide(host) -> 'reject' / 'direct' / 其他，None 表示不分流
+        """
+        self.client_sock = client_sock
+        self.client_ip = client_ip
+        self.client_addr = (client_ip, client_port) if client_port else None
+        self.upstream_relay = upstream_relay
+        self.decide = decide
+        self.upstream_sock = None
+        # 直连出口：地址族 -> UDP 套接字（按需创建）
+        self.direct_socks = {}
+        self.last_active = time.monotonic()
+        self.closed = False
+        self._headers = {}
+        self._actions = {}
+
+    def header_for(self, addr):
+        header = self._headers.get(addr)
+        if header is None:
+            if len(self._headers) >= MAX_CACHED_TARGETS:
+                self._headers.clear()
+            header = self._headers[addr] = build_udp_header(addr[0], addr[1])
+        return header
+
+    def action_for(self, host):
+        if self.decide is None:
+            return None
+        action = self._actions.get(host)
+        if action is None:
+            if len(self._actions) >= MAX_CACHED_TARGETS:
+                self._actions.clear()
+            action = self._actions[host] = self.decide(host) or ""
+        return action
+
+    def sockets(self):
+        upstream = [self.upstream_sock] if self.upstream_sock else []
+        return [self.client_sock] + upstream + list(self.direct_socks.values())
+
+
+class UDPRelay:
+    """
+    UDP 数据报转发：所有关联共用一个事件循环线程（selectors），数据报接收到预分配缓冲区后直接转发
+
+    - 经上游：客户端数据报原样（含 SOCKS5 UDP 头部）发往上游的 UDP 中继，上游返回的数据报原样发回客户端
+    - 直连：去掉头部后发往目标，目标返回的数据加上来源地址头部后发回客户端；目标为域名时在解析线程中解析
+    """
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._selector = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wakeup = None
+        self._resolver = None
+        self._up = self._down = 0
+        self.associations = 0
+
+    def _ensure_started(self):
+        """在锁内调用：首次使用时创建事件循环线程"""
+        if self._selector is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = socket.socketpair()
+        self._wakeup[0].setblocking(False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ, None)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def register(self, association):
+        """开始转发一个关联的数据报"""
+        if association.upstream_relay:
+            family = socket.AF_INET6 if ":" in association.upstream_relay[0] else socket.AF_INET
+            association.upstream_sock = socket.socket(family, socket.SOCK_DGRAM)
+            association.upstream_sock.connect(association.upstream_relay)
+        for sock in association.sockets():
+            sock.setblocking(False)
+        with self._lock:
+            self._ensure_started()
+            self._pending.append(("add", association))
+            self.associations += 1
+        METRICS.gauge_add('peanut_udp_associations', None, 1)
+        self._wake()
+
+    def unregister(self, association):
+        """停止转发并关闭关联的 UDP 套接字"""
+        with self._lock:
+            if association.closed:
+                return
+            association.closed = True
+            self._pending.append(("remove", association))
+            self.associations -= 1
+        METRICS.gauge_add('peanut_udp_associations', None, -1)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup[1].send(b"\x00")
+        except (OSError, TypeError):
+            pass
+
+    def _apply_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for operation, association in pending:
+            if operation == "send":
+                # 解析线程完成解析后交回事件循环发送
+                association, ip, port, payload = association
+                if not association.closed:
+                    try:
+                        self._send_direct(association, ip, port, payload)
+                    except OSError:
+                        pass
+            elif operation == "add":
+                if association.closed:
+                    continue
+                self._watch(association, association.client_sock, "client")
+                if association.upstream_sock:
+                    self._watch(association, association.upstream_sock, "upstream")
+            else:
+                for sock in association.sockets():
+                    try:
+                        self._selector.unregister(sock)
+                    except (KeyError, ValueError):
+                        pass
+                    try:
+                        sock.close()
+                    except OSError:
+                        pass
+
+    def _watch(self, association, sock, role):
+        try:
+            self._selector.register(sock, selectors.EVENT_READ, (association, role))
+        except (KeyError, ValueError):
+            pass
+
+    def _loop(self):
+        buffer = bytearray(MAX_DATAGRAM)
+        view = memoryview(buffer)
+        selector = self._selector
+        last_flush = time.monotonic()
+        while True:
+            try:
+                events = selector.select(timeout=1.0)
+            except OSError:
+                continue
+            now = time.monotonic()
+            if now - last_flush >= 1:
+                # 数据报计数在本线程累加，每秒写入一次指标
+                self._flush_counts()
+                last_flush = now
+            for key, _ in events:
+                if key.data is None:
+                    try:
+                        self._wakeup[0].recv(4096)
+                    except OSError:
+                        pass
+                    self._apply_pending()
+                    continue
+                association, role = key.data
+                if association.closed:
+                    continue
+                # 每次最多处理一批数据报，避免单个关联占满循环
+                for _ in range(64):
+                    try:
+                        size, addr = key.fileobj.recvfrom_into(buffer)
+                    except OSError:
+                        break
+                    association.last_active = time.monotonic()
+                    try:
+                        if role == "client":
+                            self._from_client(association, view, size, addr)
+                        elif role == "upstream":
+                            self._to_client(association, view[:size])
+                        else:
+                            self._to_client(association, view[:size], association.header_for(addr[:2]))
+                    except (OSError, ValueError, RuntimeError):
+                        # 单个数据报出错（目标不可达、格式异常、解析线程池已关闭）不影响其他关联
+                        pass
+
+    def _from_client(self, association, view, size, addr):
+        if addr[0] != association.client_ip:
+            return
+        if association.client_addr is None:
+            association.client_addr = addr[:2]
+        elif addr[:2] != association.client_addr:
+            return
+        parsed = parse_udp_header(view[:size])
+        if parsed is None:
+            return
+        host, port, offset = parsed
+        action = association.action_for(host)
+        if action == "reject":
+            return
+        self._up += 1
+        if association.upstream_sock and action != "direct":
+            association.upstream_sock.send(view[:size])
+            return
+        payload = bytes(view[offset:size])
+        if dialer._is_ip_literal(host):
+            self._send_direct(association, host, port, payload)
+        else:
+            self._resolve_pool().submit(self._resolve, association, host, port, payload)
+
+    def _resolve_pool(self):
+        with self._lock:
+            if self._resolver is None:
+                self._resolver = concurrent.futures.ThreadPoolExecutor(RESOLVER_THREADS)
+            return self._resolver
+
+    def _resolve(self, association, host, port, payload):
+        try:
+            infos = dialer.RESOLVER.resolve(host, port)
+        except OSError:
+            return
+        if infos and not association.closed:
+            with self._lock:
+                self._pending.append(("send", (association, infos[0][4][0], port, payload)))
+            self._wake()
+
+    def _send_direct(self, association, ip, port, payload):
+        """在事件循环线程中调用：按地址族取（或创建）直连出口并发送"""
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        sock = association.direct_socks.get(family)
+        if sock is None:
+            sock = association.direct_socks[family] = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._watch(association, sock, "direct")
+        sock.sendto(payload, (ip, port))
+
+    def _flush_counts(self):
+        up, down = self._up, self._down
+        self._up = self._down = 0
+        if up:
+            METRICS.inc('peanut_udp_datagrams_total', {'direction': 'up'}, up)
+        if down:
+            METRICS.inc('peanut_udp_datagrams_total', {'direction': 'down'}, down)
+
+    def _to_client(self, association, data, header=None):
+        if association.client_addr is None:
+            return
+        self._down += 1
+        if header is None:
+            association.client_sock.sendto(data, association.client_addr)
+        elif _HAS_SENDMSG:
+            association.client_sock.sendmsg([header, data], [], 0, association.client_addr)
+        else:
+            association.client_sock.sendto(header + bytes(data), association.client_addr)
+
+
+# 所有监听端口共用的 UDP 转发
+UDP_RELAY = UDPRelay()